@@ -0,0 +1,501 @@
+"""
+Offline benchmark of the reward pipeline.
+
+Pages and DuckDuckGo results are served from recorded fixtures by a
+local stand-in server, and scoring goes to a fake LLM with configurable
+latency, so no browser, network or API key is needed. Each stage is
+timed on its own, across batch sizes, top_k and concurrency, and the
+results are saved as JSON to compare between versions.
+
+    python benchmark.py record fixtures/ queries.txt
+    python benchmark.py synthesize fixtures/
+    python benchmark.py run fixtures/ --out results.json
+    python benchmark.py compare before.json after.json
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from cache import ScoreCache
+from curler import AsyncHTTPCurler, HTTPCurler
+from ddg_querier import DDGQuerier, SearchCache
+from metrics import METRICS
+from reward_model import RewardModel
+from scheduler import HostPolicy, Scheduler
+from textractor import StackExchangeTextractor, WikipediaTextractor
+
+
+class FakeLLM:
+    """Stands in for autocrit.generate_openai, replying after `latency`
+    (+ up to `jitter`) seconds."""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0, reply: str = '1'):
+        self.latency = latency
+        self.jitter = jitter
+        self.reply = reply
+        self.calls = 0
+        self.__lock = threading.Lock()
+
+    def __call__(self, prompt: str, **kwargs) -> str:
+        with self.__lock:
+            self.calls += 1
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        return self.reply
+
+
+class Fixtures:
+    """
+    Recorded DuckDuckGo results pages and the pages they link to.
+
+    manifest.json lists each results page as {"query", "kind", "file"},
+    where kind is "html" for the static results page and "js" for the
+    JavaScript one, and maps each linked url to the file of its page.
+    """
+
+    def __init__(self, fixtures_dir: str):
+        self.fixtures_dir = fixtures_dir
+        with open(os.path.join(fixtures_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.serps = manifest['serps']
+        self.pages = manifest['pages']
+
+    def read(self, file: str) -> str:
+        with open(os.path.join(self.fixtures_dir, file), encoding='utf-8') as f:
+            return f.read()
+
+    @property
+    def queries(self) -> list[str]:
+        return list(dict.fromkeys(serp['query'] for serp in self.serps if serp['kind'] == 'html'))
+
+
+class StandInServer:
+    """
+    Local HTTP server standing in for DuckDuckGo, Wikipedia and
+    StackOverflow. Serves the static results page for a query at
+    /html/?q=..., with links rewritten to point back at the server, and
+    each page at /<host>/<path>, after `latency` seconds.
+    """
+
+    def __init__(self, fixtures: Fixtures, latency: float = 0.0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.hosts = sorted({urllib.parse.urlparse(url).netloc for url in fixtures.pages})
+        self.__server = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.__server.server_port}'
+
+    def rewrite(self, serp: str) -> str:
+        for host in self.hosts:
+            local = f'{self.base_url}/{host}'
+            serp = serp.replace(f'https://{host}', local)
+            serp = serp.replace(
+                urllib.parse.quote(f'https://{host}', safe=''), urllib.parse.quote(local, safe='')
+            )
+        return serp
+
+    def serp_for(self, query: str) -> str:
+        html_serps = [serp for serp in self.fixtures.serps if serp['kind'] == 'html']
+        normalized = SearchCache.normalize(query)
+        for serp in html_serps:
+            if SearchCache.normalize(serp['query']) == normalized:
+                return self.fixtures.read(serp['file'])
+        return self.fixtures.read(html_serps[hash(normalized) % len(html_serps)]['file'])
+
+    def __enter__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status: int, body: str = ''):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                time.sleep(server.latency)
+                parsed = urllib.parse.urlparse(self.path)
+                if parsed.path.rstrip('/') == '/html':
+                    query = urllib.parse.parse_qs(parsed.query).get('q', [''])[0]
+                    return self.respond(200, server.rewrite(server.serp_for(query)))
+                host, _, path = parsed.path.lstrip('/').partition('/')
+                url = f'https://{host}/{path}' + (f'?{parsed.query}' if parsed.query else '')
+                if url not in server.fixtures.pages:
+                    return self.respond(404)
+                self.respond(200, server.fixtures.read(server.fixtures.pages[url]))
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+def summarize(stage: str, params: dict, latencies: list[float], items: int, errors: int = 0) -> dict:
+    """Latency percentiles in seconds and throughput in items per second."""
+    latencies = np.array(latencies) if latencies else np.array([np.nan])
+    total = float(np.nansum(latencies))
+    result = {
+        'stage': stage,
+        'params': params,
+        'n': int(np.count_nonzero(~np.isnan(latencies))),
+        'errors': errors,
+        'mean': float(np.nanmean(latencies)),
+        'p50': float(np.nanpercentile(latencies, 50)),
+        'p95': float(np.nanpercentile(latencies, 95)),
+        'p99': float(np.nanpercentile(latencies, 99)),
+        'throughput': items / total if total else 0.0,
+    }
+    print(
+        f"{stage:<40} {json.dumps(params):<55} p50={result['p50'] * 1000:9.2f}ms "
+        f"p95={result['p95'] * 1000:9.2f}ms p99={result['p99'] * 1000:9.2f}ms "
+        f"throughput={result['throughput']:9.2f}/s errors={errors}"
+    )
+    return result
+
+
+def time_calls(calls, repeat: int) -> tuple[list[float], int]:
+    latencies, errors = [], 0
+    for _ in range(repeat):
+        for call in calls:
+            start = time.perf_counter()
+            try:
+                call()
+            except Exception as e:
+                errors += 1
+                print(f'  error: {e!r}')
+                continue
+            latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def bench_parsing(fixtures: Fixtures, top_k: int, repeat: int) -> list[dict]:
+    querier = DDGQuerier(top_k=top_k, use_cache=False)
+    results = []
+    for kind, parse in (
+        ('html', querier.get_links_from_ddg_html_source),
+        ('js', querier.get_links_from_ddg_source),
+    ):
+        sources = [fixtures.read(serp['file']) for serp in fixtures.serps if serp['kind'] == kind]
+        if not sources:
+            continue
+        latencies, errors = time_calls([lambda s=s: parse(s) for s in sources], repeat)
+        results.append(summarize(parse.__name__, {'top_k': top_k}, latencies, len(latencies), errors))
+    return results
+
+
+def bench_textract(fixtures: Fixtures, repeat: int) -> list[dict]:
+    results = []
+    for textractor, site in (
+        (WikipediaTextractor(use_cache=False), 'wikipedia.org'),
+        (StackExchangeTextractor(use_cache=False), 'stackoverflow.com'),
+    ):
+        sources = [fixtures.read(file) for url, file in fixtures.pages.items() if site in url]
+        if not sources:
+            continue
+        for method in ('textract', 'textract_soup'):
+            extract = getattr(textractor, method)
+            latencies, errors = time_calls([lambda s=s: extract(s) for s in sources], repeat)
+            results.append(summarize(
+                f'{type(textractor).__name__}.{method}', {}, latencies, len(latencies), errors
+            ))
+    return results
+
+
+def unlimited_scheduler(concurrency: int) -> Scheduler:
+    """Scheduler without rate limits, so runs measure the pipeline
+    rather than the politeness policy."""
+    return Scheduler(policies={}, default_policy=HostPolicy(rate=None, max_concurrency=concurrency))
+
+
+def make_querier(server: StandInServer, top_k: int, concurrency: int) -> DDGQuerier:
+    scheduler = unlimited_scheduler(concurrency)
+    curler = AsyncHTTPCurler(max_per_host=concurrency, scheduler=scheduler)
+    querier = DDGQuerier(top_k=top_k, use_cache=False, page_curler=curler, scheduler=scheduler)
+    querier.ddg_html_url = server.base_url + '/html/?q={query}'
+    return querier
+
+
+def bench_get_documents(server: StandInServer, queries: list[str], top_k: int,
+                        concurrency: int, repeat: int) -> dict:
+    querier = make_querier(server, top_k, concurrency)
+    try:
+        latencies, errors = time_calls(
+            [lambda q=q: querier.fetch_documents(querier(q)) for q in queries], repeat
+        )
+    finally:
+        querier.page_curler.close()
+    return summarize(
+        'get_documents', {'top_k': top_k, 'concurrency': concurrency},
+        latencies, len(latencies), errors,
+    )
+
+
+def bench_get_rewards(server: StandInServer, queries: list[str], batch_size: int, top_k: int,
+                      concurrency: int, llm: FakeLLM, repeat: int) -> dict:
+    querier = make_querier(server, top_k, concurrency)
+    model = RewardModel(
+        top_k=top_k, max_workers=concurrency, doc_querier=querier, generate=llm,
+        score_cache=ScoreCache(max_entries=0), scheduler=querier.scheduler,
+    )
+    samples = itertools.cycle(queries)
+    batches = []
+    for i in range(max(1, len(queries) // batch_size)):
+        prompts = [next(samples) for _ in range(batch_size)]
+        # distinct completions, so every sample is scored
+        completions = [f' completion {i}-{j}' for j in range(batch_size)]
+        batches.append((prompts, completions))
+    try:
+        latencies, errors = time_calls(
+            [lambda b=b: model.get_rewards(*b) for b in batches], repeat
+        )
+    finally:
+        model.executor.shutdown()
+        querier.page_curler.close()
+    return summarize(
+        'RewardModel.get_rewards',
+        {'batch_size': batch_size, 'top_k': top_k, 'concurrency': concurrency},
+        latencies, len(latencies) * batch_size, errors,
+    )
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    fixtures = Fixtures(args.fixtures_dir)
+    llm = FakeLLM(latency=args.llm_latency, jitter=args.llm_jitter)
+    results = []
+    results += bench_parsing(fixtures, max(args.top_k), args.repeat)
+    results += bench_textract(fixtures, args.repeat)
+    queries = fixtures.queries
+    with StandInServer(fixtures, latency=args.page_latency) as server:
+        for top_k, concurrency in itertools.product(args.top_k, args.concurrency):
+            results.append(bench_get_documents(server, queries, top_k, concurrency, args.repeat))
+        for batch_size, top_k, concurrency in itertools.product(
+            args.batch_size, args.top_k, args.concurrency
+        ):
+            results.append(bench_get_rewards(
+                server, queries, batch_size, top_k, concurrency, llm, args.repeat
+            ))
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'fixtures': os.path.abspath(args.fixtures_dir),
+            'llm_latency': args.llm_latency,
+            'llm_jitter': args.llm_jitter,
+            'page_latency': args.page_latency,
+            'repeat': args.repeat,
+        },
+        'results': results,
+        'metrics': METRICS.snapshot(),
+    }
+
+
+def compare(before: dict, after: dict):
+    """Print the p50 speedup and throughput ratio of every result in both runs."""
+    key = lambda result: (result['stage'], json.dumps(result['params'], sort_keys=True))
+    before_results = {key(result): result for result in before['results']}
+    for result in after['results']:
+        old = before_results.get(key(result))
+        if old is None:
+            continue
+        speedup = old['p50'] / result['p50'] if result['p50'] else float('nan')
+        ratio = result['throughput'] / old['throughput'] if old['throughput'] else float('nan')
+        print(f"{result['stage']:<40} {key(result)[1]:<55} p50 speedup={speedup:6.2f}x throughput={ratio:6.2f}x")
+
+
+def record(fixtures_dir: str, queries: list[str], top_k: int = 10, selenium: bool = False):
+    """
+    Record results pages for the queries and every page they link to.
+    Needs network access, and Chrome when selenium is set, in which case
+    the JavaScript results page is recorded too and StackOverflow pages
+    are loaded in the browser.
+    """
+    os.makedirs(os.path.join(fixtures_dir, 'serp'), exist_ok=True)
+    os.makedirs(os.path.join(fixtures_dir, 'pages'), exist_ok=True)
+    querier = DDGQuerier(top_k=top_k, use_cache=False)
+    http_curler = HTTPCurler()
+    serps, pages = [], {}
+
+    def save(subdir: str, source: str) -> str:
+        file = os.path.join(subdir, f'{len(serps) + len(pages)}.html')
+        with open(os.path.join(fixtures_dir, file), 'w', encoding='utf-8') as f:
+            f.write(source)
+        return file
+
+    for query in queries:
+        prepped = querier.prep_query(query)[0]
+        source = http_curler.urlget(querier.ddg_html_url.format(query=prepped))
+        serps.append({'query': query, 'kind': 'html', 'file': save('serp', source)})
+        links = querier.get_links_from_ddg_html_source(source)
+        if selenium:
+            source = querier.curler.urlget(querier.ddg_url.format(query=prepped))
+            serps.append({'query': query, 'kind': 'js', 'file': save('serp', source)})
+        for link in links:
+            if link in pages:
+                continue
+            if selenium and 'stackoverflow.com' in link:
+                source = querier.curler.urlget(link)
+            else:
+                source = http_curler.urlget(link)
+            pages[link] = save('pages', source)
+        print(f'Recorded {query!r}: {len(links)} links')
+    with open(os.path.join(fixtures_dir, 'manifest.json'), 'w') as f:
+        json.dump({'serps': serps, 'pages': pages}, f, indent=2)
+
+
+def synthesize(fixtures_dir: str, n_queries: int = 16, n_pages: int = 60,
+               results_per_serp: int = 30, paragraphs: int = 200, seed: int = 0):
+    """
+    Write fixtures with the markup of the real pages but generated text,
+    for when there is no network to record from. Results pages draw
+    from a shared pool of pages, so batches see repeated documents.
+    """
+    rng = random.Random(seed)
+    words = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 10))) for _ in range(5000)]
+    sentence = lambda n: ' '.join(rng.choices(words, k=n))
+    os.makedirs(os.path.join(fixtures_dir, 'serp'), exist_ok=True)
+    os.makedirs(os.path.join(fixtures_dir, 'pages'), exist_ok=True)
+
+    pages = {}
+    for i in range(n_pages):
+        if i % 3:
+            url = f'https://en.wikipedia.org/wiki/Article_{i}'
+            body = ''.join(
+                f'<p>{sentence(60)}<sup class="reference"><a>[{j}]</a></sup> {sentence(40)}</p>\n'
+                for j in range(paragraphs)
+            )
+            body += f'<table class="infobox"><tr><td>{sentence(20)}</td></tr></table>\n'
+            body += f'<div class="hatnote">{sentence(10)}</div>\n'
+            body += '<h2><span class="mw-headline" id="See_also">See also</span></h2>\n'
+            body += f'<ul><li>{sentence(5)}</li></ul>\n<div class="reflist"><ol><li>{sentence(10)}</li></ol></div>'
+            source = (
+                f'<!DOCTYPE html><html><head><link rel="canonical" href="{url}"></head><body>'
+                f'<div id="mw-content-text"><div class="mw-parser-output">{body}</div></div></body></html>'
+            )
+        else:
+            url = f'https://stackoverflow.com/questions/{i}/question-{i}'
+            posts = ''.join(
+                f'<div class="s-prose js-post-body"><p>{sentence(80)}</p>\n'
+                f'<pre><code>{sentence(15)}\n{sentence(15)}</code></pre>\n<p>{sentence(40)}</p></div>'
+                for _ in range(rng.randint(2, 8))
+            )
+            source = (
+                f'<html><head><link rel="canonical" href="{url}"></head><body>'
+                f'<div id="question-header"><h1><a class="question-hyperlink">{sentence(8)}</a></h1></div>'
+                f'{posts}</body></html>'
+            )
+        file = os.path.join('pages', f'{i}.html')
+        with open(os.path.join(fixtures_dir, file), 'w', encoding='utf-8') as f:
+            f.write(source)
+        pages[url] = file
+
+    serps = []
+    urls = list(pages)
+    for i in range(n_queries):
+        query = sentence(6)
+        links = rng.sample(urls, min(results_per_serp, len(urls)))
+        html = ''.join(
+            '<div class="result results_links web-result"><a class="result__a" href="//duckduckgo.com/l/?uddg='
+            f'{urllib.parse.quote(link, safe="")}">{sentence(5)}</a></div>'
+            for link in links
+        )
+        js = ''.join(
+            f'<li data-layout="organic"><a data-testid="result-title-a" href="{link}">{sentence(5)}</a></li>'
+            for link in links
+        )
+        for kind, source in (
+            ('html', f'<html><body><div class="results">{html}</div></body></html>'),
+            ('js', f'<html><body><ol class="react-results--main">{js}</ol></body></html>'),
+        ):
+            file = os.path.join('serp', f'{i}-{kind}.html')
+            with open(os.path.join(fixtures_dir, file), 'w', encoding='utf-8') as f:
+                f.write(source)
+            serps.append({'query': query, 'kind': kind, 'file': file})
+    with open(os.path.join(fixtures_dir, 'manifest.json'), 'w') as f:
+        json.dump({'serps': serps, 'pages': pages}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='Record fixtures from the live sites')
+    record_parser.add_argument('fixtures_dir', type=str)
+    record_parser.add_argument('queries_path', type=str, help='Text file with one query per line')
+    record_parser.add_argument('--top_k', type=int, default=10)
+    record_parser.add_argument('--selenium', action='store_true')
+
+    synthesize_parser = subparsers.add_parser('synthesize', help='Generate fixtures without network')
+    synthesize_parser.add_argument('fixtures_dir', type=str)
+    synthesize_parser.add_argument('--n_queries', type=int, default=16)
+    synthesize_parser.add_argument('--n_pages', type=int, default=60)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmark')
+    run_parser.add_argument('fixtures_dir', type=str)
+    run_parser.add_argument('--out', type=str, default=None)
+    run_parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 8, 64])
+    run_parser.add_argument('--top_k', type=int, nargs='+', default=[5, 10])
+    run_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    run_parser.add_argument('--llm_latency', type=float, default=0.05)
+    run_parser.add_argument('--llm_jitter', type=float, default=0.0)
+    run_parser.add_argument('--page_latency', type=float, default=0.02)
+    run_parser.add_argument('--repeat', type=int, default=3)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two saved runs')
+    compare_parser.add_argument('before', type=str)
+    compare_parser.add_argument('after', type=str)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        with open(args.queries_path) as f:
+            queries = [line.strip() for line in f if line.strip()]
+        record(args.fixtures_dir, queries, top_k=args.top_k, selenium=args.selenium)
+    elif args.command == 'synthesize':
+        synthesize(args.fixtures_dir, n_queries=args.n_queries, n_pages=args.n_pages)
+    elif args.command == 'run':
+        results = run(args)
+        if args.out is not None:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+    else:
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        compare(before, after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import METRICS
+from shared import process_wide
+
+
+def default_cache_dir() -> str:
+    """Directory for on-disk caches. Set DOC_RETRIEVAL_CACHE_DIR to override."""
+    return os.environ.get(
+        'DOC_RETRIEVAL_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'doc-retrieval-rlaif'),
+    )
+
+
+class DiskCache:
+    """
+    Key -> text store in a SQLite database. The database runs in WAL
+    mode, so any number of threads and processes can read and write the
+    same file at once. Entries older than `ttl` seconds are treated as
+    missing, and once the stored values exceed `max_bytes` the least
+    recently used entries are evicted, down to `evict_to` of max_bytes,
+    so the eviction scan runs once per batch of inserts rather than on
+    every insert into a full cache.
+
+    The total size of the stored values is kept in a meta row that
+    triggers update, so inserts don't have to sum the whole table. A
+    hit only records its access time when the last one is more than
+    `touch_interval` seconds old, so reads rarely write.
+    """
+
+    def __init__(self,
+                 path: str,
+                 max_bytes: int = 2**30,
+                 ttl: float = 7 * 24 * 60 * 60,
+                 touch_interval: float = 60.0,
+                 evict_to: float = 0.9):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_to = evict_to
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.__local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self.connection as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                'created REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)'
+            )
+            connection.execute("INSERT OR IGNORE INTO meta VALUES ('total_bytes', 0)")
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN '
+                "UPDATE meta SET value = value + new.size WHERE name = 'total_bytes'; END"
+            )
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN '
+                "UPDATE meta SET value = value - old.size WHERE name = 'total_bytes'; END"
+            )
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN '
+                "UPDATE meta SET value = value - old.size + new.size WHERE name = 'total_bytes'; END"
+            )
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """SQLite connections can't be shared between threads, so each
+        thread opens its own."""
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.__local.connection = connection
+        return connection
+
+    def get(self, key: str) -> str | None:
+        """Return the value stored under key, or None if it is missing or
+        has expired."""
+        now = time.time()
+        with self.connection as connection:
+            row = connection.execute(
+                'SELECT value, created, accessed FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created, accessed = row
+            if now - created > self.ttl:
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            if now - accessed > self.touch_interval:
+                connection.execute(
+                    'UPDATE entries SET accessed = ? WHERE key = ?', (now, key)
+                )
+        return value
+
+    def put(self, key: str, value: str):
+        """Store value under key, evicting least recently used entries if
+        the cache has grown past max_bytes."""
+        now = time.time()
+        with self.connection as connection:
+            # an upsert rather than INSERT OR REPLACE, whose implicit
+            # delete would not fire the delete trigger
+            connection.execute(
+                'INSERT INTO entries VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                'value = excluded.value, size = excluded.size, '
+                'created = excluded.created, accessed = excluded.accessed',
+                (key, value, len(value.encode()), now, now),
+            )
+            if self.__total_bytes(connection) > self.max_bytes:
+                connection.execute(
+                    'DELETE FROM entries WHERE key IN ('
+                    'SELECT key FROM (SELECT key, SUM(size) OVER '
+                    '(ORDER BY accessed DESC, key) AS running FROM entries) '
+                    'WHERE running > ?)',
+                    (self.max_bytes * self.evict_to,),
+                )
+
+    @staticmethod
+    def __total_bytes(connection: sqlite3.Connection) -> int:
+        return connection.execute(
+            "SELECT value FROM meta WHERE name = 'total_bytes'"
+        ).fetchone()[0]
+
+    @property
+    def total_bytes(self) -> int:
+        """Total size of the stored values."""
+        return self.__total_bytes(self.connection)
+
+    def delete_expired(self):
+        """Remove every entry older than ttl."""
+        with self.connection as connection:
+            connection.execute(
+                'DELETE FROM entries WHERE created < ?', (time.time() - self.ttl,)
+            )
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+
+class DocumentCache(DiskCache):
+    """
+    Cache of url -> extracted text. Entries are keyed on the url and the
+    version of the extractor that produced them, so bumping an
+    extractor's version invalidates its old entries.
+    """
+
+    def __init__(self, path: str = None, **kwargs):
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'documents.sqlite')
+        super().__init__(path, **kwargs)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url: str, version: str) -> str:
+        return f'{version}\t{url}'
+
+    def get_document(self, url: str, version: str) -> str | None:
+        """
+        Args:
+            url (str)
+            version (str): The extractor version.
+
+        Returns:
+            str | None: The extracted text, or None on a miss.
+        """
+        text = self.get(self.key(url, version))
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        METRICS.cache_request('document', hit=text is not None)
+        return text
+
+    def put_document(self, url: str, version: str, text: str):
+        self.put(self.key(url, version), text)
+
+    def stats(self) -> dict:
+        """Hit and miss counts for this process."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class ScoreCache:
+    """
+    Memoizes document scores, keyed on a content hash of the scoring
+    prompt version, prompt, completion and document. Holds at most
+    `max_entries` scores in memory, evicting the least recently used,
+    and if a path is given also spills every score to a DiskCache there
+    so scores survive restarts and are shared between processes.
+    """
+
+    def __init__(self, max_entries: int = 100_000, path: str = None, **disk_kwargs):
+        self.max_entries = max_entries
+        self.disk = DiskCache(path, **disk_kwargs) if path is not None else None
+        self.hits = 0
+        self.misses = 0
+        self.__scores = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(version: str, prompt: str, completion: str, document: str) -> str:
+        digest = hashlib.sha256()
+        for part in (str(version), prompt, completion, document):
+            digest.update(part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def __remember(self, key: str, score: float):
+        with self.__lock:
+            self.__scores[key] = score
+            self.__scores.move_to_end(key)
+            while len(self.__scores) > self.max_entries:
+                self.__scores.popitem(last=False)
+
+    def get(self, key: str) -> float | None:
+        """Return the cached score, or None on a miss."""
+        with self.__lock:
+            score = self.__scores.get(key)
+            if score is not None:
+                self.__scores.move_to_end(key)
+                self.hits += 1
+                METRICS.cache_request('score', hit=True)
+                return score
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                score = float(value)
+                self.__remember(key, score)
+                self.hits += 1
+                METRICS.cache_request('score', hit=True)
+                return score
+        self.misses += 1
+        METRICS.cache_request('score', hit=False)
+        return None
+
+    def put(self, key: str, score: float):
+        self.__remember(key, score)
+        if self.disk is not None:
+            self.disk.put(key, repr(score))
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.__scores)}
+
+
+@process_wide
+def shared_document_cache() -> DocumentCache:
+    """The process-wide DocumentCache, created on first use."""
+    return DocumentCache()
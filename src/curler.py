@@ -1,14 +1,32 @@
+import asyncio
+import atexit
+import queue
+import threading
 import time
-from typing import Callable
-from selenium import webdriver
-from selenium.webdriver.chrome.webdriver import WebDriver
-import selenium.common.exceptions
-from selenium.webdriver.common.by import By
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable
+
+from metrics import METRICS
+from scheduler import Scheduler, retry_after, shared_scheduler
+from shared import process_wide
+
+# requests, aiohttp and selenium are imported by the curlers that use
+# them, so importing this module does not pull them all in
+if TYPE_CHECKING:
+    import aiohttp
+    from selenium.webdriver.chrome.webdriver import WebDriver
 
 
 class Curler:
-    def __init__(self):
-        pass
+    def __init__(self, scheduler: Scheduler = None):
+        # rate limits and coalesces requests; None uses the process-wide scheduler
+        self.__scheduler = scheduler
+
+    @property
+    def scheduler(self) -> Scheduler:
+        if self.__scheduler is None:
+            self.__scheduler = shared_scheduler()
+        return self.__scheduler
 
     def urlget(self, url: str) -> str:
         """Get the page source of the given url.
@@ -20,62 +38,498 @@ class Curler:
             str: page source"""
         raise NotImplementedError
 
+    def submit(self, url: str) -> Future:
+        """Start getting the url's page source. Runs urlget on the shared
+        curler executor; curlers with their own concurrency override it.
+
+        Args:
+            url (str)
+
+        Returns:
+            Future: resolves to the page source"""
+        return shared_curler_executor().submit(self.urlget, url)
+
+    def map(self, urls: list[str]) -> list[str]:
+        """Get the urls concurrently, returning page sources in order."""
+        return [future.result() for future in [self.submit(url) for url in urls]]
+
+
+class HTTPCurler(Curler):
+    """
+    Curler that fetches pages with plain HTTP requests over a keep-alive
+    session. Much faster than a browser, but only suitable for pages
+    that do not need JavaScript to render. Connection errors, timeouts
+    and retryable statuses are retried with backoff by the scheduler.
+    """
+
+    default_headers = {
+        'User-Agent': (
+            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+            '(KHTML, like Gecko) Chrome/116.0 Safari/537.36'
+        ),
+        'Accept-Language': 'en-US,en;q=0.9',
+    }
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout: float = 10.0, headers: dict = None, scheduler: Scheduler = None):
+        import requests
+
+        super().__init__(scheduler)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers or self.default_headers)
+
+    def should_retry(self, error: Exception) -> bool:
+        import requests
+
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code in self.retry_statuses
+        return isinstance(error, (requests.Timeout, requests.ConnectionError))
+
+    def fetch(self, url: str) -> str:
+        """Make a single attempt at fetching the url."""
+        import requests
+
+        with METRICS.span('fetch', curler='http'):
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except requests.Timeout:
+                METRICS.inc('timeouts_total', curler='http')
+                raise
+            if response.status_code == 429:
+                self.scheduler.throttled(url, retry_after(response.headers.get('Retry-After')))
+            response.raise_for_status()
+            return response.text
+
+    def urlget(self, url: str) -> str:
+        """Get the page source of the given url.
+
+        Raises:
+            requests.RequestException: On connection errors, timeouts
+                and non-2xx responses that persist through the retries."""
+        return self.scheduler.coalesce(
+            ('http', url),
+            lambda: self.scheduler.call(url, lambda: self.fetch(url), retry_on=self.should_retry),
+        )
+
+
+class AsyncHTTPCurler(Curler):
+    """
+    Curler that fetches pages with plain HTTP on a background asyncio
+    event loop. All fetches share one pooled aiohttp session of up to
+    max_per_host connections per host, are rate limited and capped by
+    the scheduler, time out after `timeout` seconds, and are retried
+    with the scheduler's backoff on connection errors, timeouts and
+    retryable statuses.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_connections: int = 64,
+        max_per_host: int = 8,
+        timeout: float = 10.0,
+        retries: int = 2,
+        headers: dict = None,
+        scheduler: Scheduler = None,
+    ):
+        super().__init__(scheduler)
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.headers = headers or HTTPCurler.default_headers
+        self.__loop = None
+        self.__session = None
+        self.__lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Event loop running in a daemon thread, started on first use."""
+        with self.__lock:
+            if self.__loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name='async-http-curler', daemon=True
+                ).start()
+                self.__loop = loop
+        return self.__loop
+
+    def _session(self) -> 'aiohttp.ClientSession':
+        # only called from the event loop thread
+        if self.__session is None:
+            import aiohttp
+
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, limit_per_host=self.max_per_host
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers=self.headers,
+            )
+        return self.__session
+
+    async def fetch(self, url: str) -> str:
+        """Fetch the page source of the url. Must run on self.loop.
+        Concurrent fetches of the same url share one request."""
+        return await self.scheduler.acoalesce(('http', url), lambda: self._fetch(url))
+
+    async def _fetch(self, url: str) -> str:
+        import aiohttp
+
+        with METRICS.span('fetch', curler='async_http'):
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self.scheduler.aslot(url):
+                        async with self._session().get(url) as response:
+                            if response.status == 429:
+                                self.scheduler.throttled(
+                                    url, retry_after(response.headers.get('Retry-After'))
+                                )
+                            response.raise_for_status()
+                            return await response.text()
+                except aiohttp.ClientResponseError as e:
+                    if e.status not in self.retry_statuses or attempt == self.retries:
+                        raise
+                except asyncio.TimeoutError:
+                    METRICS.inc('timeouts_total', curler='async_http')
+                    if attempt == self.retries:
+                        raise
+                except aiohttp.ClientError:
+                    if attempt == self.retries:
+                        raise
+                METRICS.inc('retries_total', curler='async_http')
+                await asyncio.sleep(self.scheduler.backoff_delay(attempt))
+
+    async def fetch_all(self, urls: list[str]) -> list[str]:
+        """Fetch all urls at once, returning page sources in order."""
+        return await asyncio.gather(*(self.fetch(url) for url in urls))
+
+    def submit(self, url: str) -> Future:
+        """Start fetching the url.
+
+        Args:
+            url (str)
+
+        Returns:
+            Future: resolves to the page source"""
+        return asyncio.run_coroutine_threadsafe(self.fetch(url), self.loop)
+
+    def urlget(self, url: str) -> str:
+        return self.submit(url).result()
+
+    def map(self, urls: list[str]) -> list[str]:
+        """Fetch the urls concurrently, returning page sources in order."""
+        return asyncio.run_coroutine_threadsafe(self.fetch_all(urls), self.loop).result()
+
+    def close(self):
+        """Close the session and stop the event loop."""
+        with self.__lock:
+            loop, self.__loop = self.__loop, None
+        if loop is None:
+            return
+        if self.__session is not None:
+            asyncio.run_coroutine_threadsafe(self.__session.close(), loop).result()
+            self.__session = None
+        loop.call_soon_threadsafe(loop.stop)
+
 
 class SeleniumCurler(Curler):
     def __init__(
         self,
-        page_source_wait: float = 0.25,
+        ready_timeout: float = 10.0,
+        scheduler: Scheduler = None,
     ):
-        super().__init__()
-        self.page_source_wait = page_source_wait
+        super().__init__(scheduler)
+        self.ready_timeout = ready_timeout
+        self.pages_loaded = 0
         self.__selenium_webdriver = None
+        # a webdriver shows one page at a time, so loading a page and
+        # reading its source must not interleave with another load
+        self.__lock = threading.Lock()
+        self.__executor = None
+        self.__executor_lock = threading.Lock()
 
     @property
     def selenium_webdriver(self):
         if self.__selenium_webdriver is None:
+            from selenium import webdriver
+
             options = webdriver.ChromeOptions()
             options.headless = True
             options.add_argument('--no-sandbox')
-            self.__selenium_webdriver = webdriver.Chrome(options=options)
-            self.__selenium_webdriver.maximize_window()
+            with METRICS.span('webdriver_start'):
+                self.__selenium_webdriver = webdriver.Chrome(options=options)
+                self.__selenium_webdriver.maximize_window()
+            self.pages_loaded = 0
         return self.__selenium_webdriver
+
+    @property
+    def is_running(self) -> bool:
+        return self.__selenium_webdriver is not None
     
     def delete_webdriver(self):
         """
-        Close webdriver and set to none
+        Quit webdriver and set to none
         """
-        if self.__selenium_webdriver is not None:
-            self.__selenium_webdriver.close()
-        self.__selenium_webdriver = None
+        driver, self.__selenium_webdriver = self.__selenium_webdriver, None
+        if driver is not None:
+            driver.quit()
     
     def reset_webdriver(self):
         """
-        Close webdriver, set to none, and reopen to https://en.wikipedia.org/
+        Quit webdriver, set to none, and reopen to https://en.wikipedia.org/
         """
-        if self.__selenium_webdriver is not None:
-            self.__selenium_webdriver.close()
-        self.__selenium_webdriver = None
+        METRICS.inc('webdriver_resets_total')
+        self.delete_webdriver()
         self.selenium_webdriver.get("https://en.wikipedia.org/")
 
-    def prep_for_scrape(self, buttons: tuple[tuple] = tuple()):
-        """Prepare the selenium webdriver for scraping. Assumes the webdriver is already on the page."""
-        # sleep for a bit to let the page load
-        time.sleep(self.page_source_wait)
+    def memory_usage_mb(self) -> float:
+        """JS heap used by the current page in MB, or 0 if the webdriver
+        is not running. Chrome only reports the heap of the renderer, so
+        this is a proxy for browser memory rather than an exact RSS."""
+        if self.__selenium_webdriver is None:
+            return 0.0
+        used = self.__selenium_webdriver.execute_script(
+            "return window.performance.memory ? window.performance.memory.usedJSHeapSize : 0;"
+        )
+        return (used or 0) / 2**20
+
+    def wait_until(self, condition: Callable[['WebDriver'], object]) -> bool:
+        """Wait up to ready_timeout for condition to hold on the webdriver.
+
+        Returns:
+            bool: False if the wait timed out."""
+        import selenium.common.exceptions
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        with METRICS.span('page_ready_wait'):
+            try:
+                WebDriverWait(self.selenium_webdriver, self.ready_timeout).until(condition)
+            except selenium.common.exceptions.TimeoutException:
+                METRICS.inc('timeouts_total', curler='selenium_ready')
+                return False
+        return True
+
+    def prep_for_scrape(
+        self,
+        buttons: tuple[tuple] = tuple(),
+        ready_condition: Callable[['WebDriver'], object] = None,
+    ):
+        """Prepare the selenium webdriver for scraping. Assumes the webdriver is already on the page.
+
+        Args:
+            buttons (tuple[tuple])
+            ready_condition (Callable[[WebDriver], object]): Optional
+                condition, such as a selenium expected condition, that
+                holds once the content to be scraped has rendered."""
+        # wait for the document to finish loading
+        self.wait_until(
+            lambda driver: driver.execute_script("return document.readyState;") == "complete"
+        )
         # scroll to the bottom of the page
         self.selenium_webdriver.execute_script(
             "window.scrollTo(0, document.body.scrollHeight);"
         )
-        # sleep for a bit to let the page load
-        time.sleep(self.page_source_wait)
+        # wait for the content we are after to render
+        if ready_condition is not None and not self.wait_until(ready_condition):
+            print(f"Timed out waiting for page to be ready after {self.ready_timeout}s")
         return
 
-    def urlget(self, url: str, buttons: tuple[tuple] = tuple()) -> str:
-        try:
-            self.selenium_webdriver.get(url)
-        except selenium.common.exceptions.TimeoutException:
-            print("Got timeout exception. Resetting and trying again")
-            self.reset_webdriver()
-            self.selenium_webdriver.get(url)
-        self.prep_for_scrape(buttons)
-        page_source = self.selenium_webdriver.page_source
+    def urlget(
+        self,
+        url: str,
+        buttons: tuple[tuple] = tuple(),
+        ready_condition: Callable[['WebDriver'], object] = None,
+    ) -> str:
+        import selenium.common.exceptions
+
+        with self.__lock, METRICS.span('fetch', curler='selenium'):
+            try:
+                with self.scheduler.slot(url):
+                    self.selenium_webdriver.get(url)
+            except selenium.common.exceptions.TimeoutException:
+                print("Got timeout exception. Resetting and trying again")
+                METRICS.inc('timeouts_total', curler='selenium')
+                METRICS.inc('retries_total', curler='selenium')
+                self.reset_webdriver()
+                time.sleep(self.scheduler.backoff_delay(0))
+                with self.scheduler.slot(url):
+                    self.selenium_webdriver.get(url)
+            self.pages_loaded += 1
+            self.prep_for_scrape(buttons, ready_condition)
+            page_source = self.selenium_webdriver.page_source
         return page_source
+
+    def submit(self, url: str) -> Future:
+        """Load the url on this curler's own thread, after any pages
+        already submitted. Use CurlerPool to load pages in parallel.
+
+        Args:
+            url (str)
+
+        Returns:
+            Future: resolves to the page source"""
+        with self.__executor_lock:
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='selenium')
+        return self.__executor.submit(self.urlget, url)
+
+
+class CurlerPool(Curler):
+    """
+    Pool of warm SeleniumCurlers. Each url is handed to whichever curler
+    is free, and urls submitted through `submit`/`map` are loaded
+    concurrently from a thread pool. A curler's webdriver is restarted
+    after it has loaded `max_pages` pages or its memory usage exceeds
+    `max_memory_mb`. Concurrent loads of the same url share one page
+    load. Waiting longer than `acquire_timeout` seconds for a free
+    curler raises RuntimeError rather than hanging.
+    """
+
+    def __init__(
+        self,
+        size: int = 4,
+        max_pages: int = 100,
+        max_memory_mb: float = 1024,
+        curler_factory: Callable[[], SeleniumCurler] = SeleniumCurler,
+        scheduler: Scheduler = None,
+        acquire_timeout: float | None = 300.0,
+    ):
+        super().__init__(scheduler)
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self.acquire_timeout = acquire_timeout
+        self.curlers = [curler_factory() for _ in range(size)]
+        self.__free = queue.Queue()
+        for curler in self.curlers:
+            self.__free.put(curler)
+        self.__executor = ThreadPoolExecutor(
+            max_workers=size, thread_name_prefix='curler-pool'
+        )
+        # separate from the fetch threads so restarts never queue behind
+        # fetches that are waiting for a free curler
+        self.__recycler = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='curler-pool-recycle'
+        )
+
+    def warm_up(self):
+        """Start every webdriver in the pool in parallel."""
+        futures = [
+            self.__executor.submit(lambda c: c.selenium_webdriver, curler)
+            for curler in self.curlers
+        ]
+        for future in futures:
+            future.result()
+
+    def needs_recycling(self, curler: SeleniumCurler) -> bool:
+        """Whether the curler's webdriver should be restarted."""
+        import selenium.common.exceptions
+
+        if curler.pages_loaded >= self.max_pages:
+            return True
+        try:
+            return curler.memory_usage_mb() >= self.max_memory_mb
+        except selenium.common.exceptions.WebDriverException:
+            return True
+
+    def _recycle(self, curler: SeleniumCurler):
+        import selenium.common.exceptions
+
+        METRICS.inc('webdriver_recycles_total')
+        try:
+            curler.delete_webdriver()
+            # restart now so the next page does not wait for it; if this
+            # fails, the next urlget on the curler starts it instead
+            curler.selenium_webdriver
+        except Exception as e:
+            print(f"Failed to restart webdriver: {e!r}")
+            METRICS.inc('webdriver_restart_errors_total')
+            try:
+                curler.delete_webdriver()
+            except selenium.common.exceptions.WebDriverException:
+                pass
+        finally:
+            # always hand the curler back, or urlget would wait for it forever
+            self.__free.put(curler)
+
+    def _release(self, curler: SeleniumCurler):
+        if curler.is_running and self.needs_recycling(curler):
+            # restart off the caller's thread so the page is returned now
+            self.__recycler.submit(self._recycle, curler)
+        else:
+            self.__free.put(curler)
+
+    def urlget(
+        self,
+        url: str,
+        buttons: tuple[tuple] = tuple(),
+        ready_condition: Callable[['WebDriver'], object] = None,
+    ) -> str:
+        return self.scheduler.coalesce(
+            ('selenium', url), lambda: self._urlget(url, buttons, ready_condition)
+        )
+
+    def _urlget(
+        self,
+        url: str,
+        buttons: tuple[tuple],
+        ready_condition: Callable[['WebDriver'], object],
+    ) -> str:
+        with METRICS.span('curler_pool_wait'):
+            try:
+                curler = self.__free.get(timeout=self.acquire_timeout)
+            except queue.Empty:
+                METRICS.inc('timeouts_total', stage='curler_pool_wait')
+                raise RuntimeError(
+                    f'No free curler after {self.acquire_timeout}s'
+                ) from None
+        try:
+            return curler.urlget(url, buttons, ready_condition)
+        finally:
+            self._release(curler)
+
+    def submit(self, url: str) -> Future:
+        """Load the url on the next free curler.
+
+        Args:
+            url (str)
+
+        Returns:
+            Future: resolves to the page source"""
+        return self.__executor.submit(self.urlget, url)
+
+    def close(self):
+        """Quit every webdriver and shut down the thread pool."""
+        self.__executor.shutdown(wait=True)
+        self.__recycler.shutdown(wait=True)
+        for curler in self.curlers:
+            curler.delete_webdriver()
+
+
+@process_wide
+def shared_curler_executor() -> ThreadPoolExecutor:
+    """The process-wide executor that Curler.submit runs urlget on,
+    created on first use and shut down at exit."""
+    executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='curler')
+    atexit.register(executor.shutdown)
+    return executor
+
+
+@process_wide
+def shared_curler_pool() -> CurlerPool:
+    """The process-wide CurlerPool, created on first use and closed at exit."""
+    pool = CurlerPool()
+    atexit.register(pool.close)
+    return pool
+
+
+@process_wide
+def shared_async_http_curler() -> AsyncHTTPCurler:
+    """The process-wide AsyncHTTPCurler, created on first use and closed at exit."""
+    curler = AsyncHTTPCurler()
+    atexit.register(curler.close)
+    return curler
@@ -1,10 +1,99 @@
 import pprint as pp
+import re
+import threading
+import time
 import urllib
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FuturesTimeoutError, as_completed
 
-from bs4 import BeautifulSoup
+from curler import Curler, HTTPCurler, shared_curler_pool
+from metrics import METRICS
+from registry import extractor_for
+from scheduler import Scheduler, shared_scheduler
+from shared import process_wide
 
-from curler import SeleniumCurler
-from textractor import WikipediaTextractor, StackExchangeTextractor
+
+class NoResultsError(RuntimeError):
+    """A search that ran and found no results, as opposed to one that
+    failed."""
+
+
+class SearchCache:
+    """
+    In-memory LRU cache of query -> links. Queries are normalized before
+    lookup so that whitespace, case and the site: suffixes added by
+    DDGQuerier.prep_query do not cause misses. Searches that found no
+    results at all are cached too, for the shorter `negative_ttl`, so
+    hopeless queries are not searched again and again. Failed searches
+    are not cached.
+    """
+
+    site_suffix = re.compile(
+        r'(\s+(or\s+)?site:(wikipedia\.org|stackoverflow\.com))+$'
+    )
+
+    def __init__(self,
+                 max_entries: int = 100_000,
+                 ttl: float = 24 * 60 * 60,
+                 negative_ttl: float = 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def normalize(cls, query: str) -> str:
+        query = ' '.join(query.lower().split())
+        return cls.site_suffix.sub('', query)
+
+    @classmethod
+    def key(cls, query: str, ensemble_results: bool, top_k: int) -> tuple:
+        return (cls.normalize(query), ensemble_results, top_k)
+
+    def get(self, key: tuple) -> tuple[list[str], str] | None:
+        """
+        Returns:
+            tuple[list[str], str] | None: None on a miss, otherwise the
+                cached links and, for a cached failure, the error message.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.__entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                METRICS.cache_request('search', hit=False)
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+        METRICS.cache_request('search', hit=True)
+        return entry[1], entry[2]
+
+    def __set(self, key: tuple, entry: tuple):
+        with self.__lock:
+            self.__entries[key] = entry
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def put(self, key: tuple, links: list[str]):
+        self.__set(key, (time.monotonic() + self.ttl, list(links), None))
+
+    def put_error(self, key: tuple, message: str):
+        self.__set(key, (time.monotonic() + self.negative_ttl, [], message))
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.__entries)}
+
+
+@process_wide
+def shared_search_cache() -> SearchCache:
+    """The process-wide SearchCache, created on first use."""
+    return SearchCache()
 
 
 class DDGQuerier:
@@ -13,20 +102,61 @@ class DDGQuerier:
     results. If ensemble_results is True, then the results from
     wikipedia.org and stackoverflow.com will be combined. Otherwise,
     they will be returned separately.
+
+    Searches go to the static HTML results page over plain HTTP first,
+    and only fall back to loading the JavaScript results page in
+    selenium when that yields no links. Concurrent calls for the same
+    query share one search.
     """
 
+    ddg_url = 'https://duckduckgo.com/?t=h_&q={query}&ia=web'
+    ddg_html_url = 'https://html.duckduckgo.com/html/?q={query}'
+
     def __init__(self,
                  ensemble_results: bool = True,
-                 top_k: int = 10):
+                 top_k: int = 10,
+                 curler: Curler = None,
+                 use_http: bool = True,
+                 search_cache: SearchCache = None,
+                 use_cache: bool = True,
+                 page_curler: Curler = None,
+                 scheduler: Scheduler = None):
         self.ensemble_results = ensemble_results
         self.top_k = top_k
-        self.__curler = None
+        self.use_http = use_http
+        self.use_cache = use_cache
+        # fetches result pages; None leaves it to each textractor
+        self.page_curler = page_curler
+        self.__curler = curler
+        self.__http_curler = None
+        self.__search_cache = search_cache
+        self.__scheduler = scheduler
 
     @property
     def curler(self):
         if self.__curler is None:
-            self.__curler = SeleniumCurler()
+            self.__curler = shared_curler_pool()
         return self.__curler
+
+    @property
+    def http_curler(self):
+        if self.__http_curler is None:
+            self.__http_curler = HTTPCurler(scheduler=self.scheduler)
+        return self.__http_curler
+
+    @property
+    def scheduler(self) -> Scheduler:
+        if self.__scheduler is None:
+            self.__scheduler = shared_scheduler()
+        return self.__scheduler
+
+    @property
+    def search_cache(self) -> SearchCache | None:
+        if not self.use_cache:
+            return None
+        if self.__search_cache is None:
+            self.__search_cache = shared_search_cache()
+        return self.__search_cache
     
     def get_links_from_ddg_source(self, ddg_source: str) -> list[str]:
         """
@@ -41,30 +171,107 @@ class DDGQuerier:
             list[str]: A list of the top links.
 
         Raises:
-            RuntimeError: If no results are found. Indicates that
+            NoResultsError: If no results are found. Indicates that
                 selenium is not correctly configured in the local
                 environment. Often this relates to issues with 
                 minimization.
         """
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(ddg_source, 'html.parser')
         ols = soup.find_all('ol', class_='react-results--main')
         if not ols:
-            raise RuntimeError('No results found (no OL)')
+            raise NoResultsError('No results found (no OL)')
         links = []
-        for ol in ols:
-            # iterate over li elements, stopping at self.top_k
-            for li in soup.find_all('li'):
-                if len(links) >= self.top_k:
-                    break
-                if li.get('data-layout') == 'ad':
-                    continue
-                link = li.find('a', attrs={'data-testid': 'result-title-a'})
-                if link is None: continue
-                link = link.get('href')
-                links.append(link)
-            else:
-                raise RuntimeError('No results found (no LIs)')
+        # iterate over the results' li elements, stopping at self.top_k
+        for li in soup.select('ol.react-results--main li'):
+            if len(links) >= self.top_k:
+                break
+            if li.get('data-layout') == 'ad':
+                continue
+            link = li.find('a', attrs={'data-testid': 'result-title-a'})
+            if link is None: continue
+            link = link.get('href')
+            links.append(link)
+        # a page with fewer than top_k results is still a result
+        if not links:
+            raise NoResultsError('No results found (no LIs)')
+        return links
+
+    def get_links_from_ddg_html_source(self, ddg_source: str) -> list[str]:
+        """
+        Given the source of a static DuckDuckGo HTML results page,
+        return a list of the top links.
+
+        Args:
+            ddg_source (str): The source of a DuckDuckGo HTML results
+                page.
+
+        Returns:
+            list[str]: A list of the top links.
+
+        Raises:
+            NoResultsError: If no results are found, including when
+                DuckDuckGo serves a challenge page instead of results.
+        """
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(ddg_source, 'html.parser')
+        links = []
+        for result in soup.select('div.result'):
+            if len(links) >= self.top_k:
+                break
+            if 'result--ad' in result.get('class', []):
+                continue
+            link = result.select_one('a.result__a')
+            if link is None or not link.get('href'):
+                continue
+            links.append(self.unwrap_ddg_redirect(link.get('href')))
+        if not links:
+            raise NoResultsError('No results found (no HTML results)')
         return links
+
+    @staticmethod
+    def unwrap_ddg_redirect(href: str) -> str:
+        """
+        Links on the HTML results page go through a DuckDuckGo redirect
+        (//duckduckgo.com/l/?uddg=<target>). Return the target url.
+        """
+        parsed = urllib.parse.urlparse(href)
+        if parsed.path == '/l/':
+            target = urllib.parse.parse_qs(parsed.query).get('uddg')
+            if target:
+                return target[0]
+        return href
+
+    def search(self, query: str) -> list[str]:
+        """
+        Search DuckDuckGo for a single prepped query, returning a list
+        of links to the top results.
+        """
+        import requests
+
+        with METRICS.span('search'):
+            if self.use_http:
+                try:
+                    ddg_source = self.http_curler.urlget(
+                        self.ddg_html_url.format(query=query)
+                    )
+                    with METRICS.span('parse_serp', kind='html'):
+                        return self.get_links_from_ddg_html_source(ddg_source)
+                except (requests.RequestException, RuntimeError):
+                    METRICS.inc('search_fallbacks_total')
+            from selenium.webdriver.common.by import By
+            from selenium.webdriver.support import expected_conditions
+
+            ddg_source = self.curler.urlget(
+                self.ddg_url.format(query=query),
+                ready_condition=expected_conditions.presence_of_element_located(
+                    (By.CSS_SELECTOR, 'ol.react-results--main li')
+                ),
+            )
+            with METRICS.span('parse_serp', kind='js'):
+                return self.get_links_from_ddg_source(ddg_source)
     
     def prep_query(self, query: str) -> list[str]:
         """
@@ -93,41 +300,180 @@ class DDGQuerier:
 
         Returns:
             list[str]: A list of links to the top results.
+
+        Raises:
+            NoResultsError: If no results are found. Cached for a while, so
+                repeating the query raises again without searching.
         """
+        cache = self.search_cache
+        key = SearchCache.key(query, self.ensemble_results, self.top_k)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                links, error = cached
+                if error is not None:
+                    raise NoResultsError(error)
+                return list(links)
+        try:
+            links = self.scheduler.coalesce(('search', key), lambda: self.search_all(query))
+        except NoResultsError as e:
+            if cache is not None:
+                cache.put_error(key, str(e))
+            raise
+        if cache is not None:
+            cache.put(key, links)
+        return list(links)
+
+    def fetch_documents(self, links: list[str]) -> list[str]:
+        """Return the document contents of links, in the same order."""
+        return fetch_documents(links, curler=self.page_curler, use_cache=self.use_cache)
+
+    def iter_documents(self, links: list[str], timeout: float = None):
+        """Yield (link, document) for each distinct link as soon as it is
+        extracted. See iter_documents."""
+        return iter_documents(
+            links, curler=self.page_curler, use_cache=self.use_cache, timeout=timeout
+        )
+
+    def search_all(self, query: str) -> list[str]:
+        """Search every prepped variant of the query, without caching.
+        Raises NoResultsError only if none of them found anything."""
         queries = self.prep_query(query)
-        links = []
+        links, error = [], None
         for query in queries:
-            ddg_url = f'https://duckduckgo.com/?t=h_&q={query}&ia=web'
-            ddg_source = self.curler.urlget(ddg_url)
-            links += self.get_links_from_ddg_source(ddg_source)
+            try:
+                links += self.search(query)
+            except NoResultsError as e:
+                error = e
+        if not links and error is not None:
+            raise error
         return links
     
 
+def _document_error(link: str, error: Exception, stage: str):
+    METRICS.inc('document_errors_total', stage=stage)
+    print(f'Skipping {link}: {error!r}')
+
+
+def iter_documents(links: list[str],
+                   curler: Curler = None,
+                   use_cache: bool = True,
+                   timeout: float = None):
+    """
+    Given a list of links, yield (link, document) for each distinct link
+    as soon as its document is extracted. Cached documents come first,
+    then the rest in the order their pages finish loading. Every fetch
+    is started before anything is yielded. Links that fail to fetch or
+    extract (a 404, an unknown domain) are counted and left out rather
+    than failing the others.
+
+    Args:
+        links (list[str]): Wikipedia or StackOverflow links.
+        curler (Curler): Fetch every page with this curler instead of
+            each textractor's default.
+        use_cache (bool): Whether to use the document cache.
+        timeout (float): Stop after this many seconds, leaving out the
+            pages that have not loaded yet.
+
+    Yields:
+        tuple[str, str]: A link and its document contents.
+    """
+    textractors, cached, pending = {}, {}, {}
+    for link in dict.fromkeys(links):
+        try:
+            textractor = textractors[link] = extractor_for(link, curler=curler, use_cache=use_cache)
+            document = textractor.lookup(link)
+            if document is None:
+                pending[textractor.curler.submit(link)] = link
+            else:
+                cached[link] = document
+        except Exception as e:
+            _document_error(link, e, 'fetch')
+    try:
+        yield from cached.items()
+        for page_source in as_completed(pending, timeout=timeout):
+            link = pending[page_source]
+            try:
+                document = textractors[link].extract(link, page_source.result())
+            except Exception as e:
+                _document_error(link, e, 'fetch' if page_source.exception() else 'extract')
+                continue
+            yield link, document
+    except FuturesTimeoutError:
+        METRICS.inc('timeouts_total', stage='iter_documents')
+    finally:
+        # the consumer stopped early or timed out, so drop what is left
+        for page_source in pending:
+            page_source.cancel()
+
+
+def fetch_documents(links: list[str],
+                    curler: Curler = None,
+                    use_cache: bool = True) -> list[str]:
+    """
+    Given a list of links, return their document contents in the same
+    order. Each distinct link is fetched at most once, and cached
+    documents are not fetched at all. Links that fail to fetch or
+    extract are left out.
+
+    Args:
+        links (list[str]): Wikipedia or StackOverflow links.
+        curler (Curler): Fetch every page with this curler instead of
+            each textractor's default.
+        use_cache (bool): Whether to use the document cache.
+
+    Returns:
+        list[str]: A list of document contents.
+    """
+    documents = dict(iter_documents(links, curler=curler, use_cache=use_cache))
+    return [documents[link] for link in links if link in documents]
+
+
 def get_documents(query: str,
                   ensemble_results: bool = True,
-                  top_k: int = 10) -> list[str]:
+                  top_k: int = 10,
+                  collapse_duplicates: bool = True) -> list[str]:
     """
     Given a query, return a list of documents.
 
     Args:
         query (str): The query to search for.
+        collapse_duplicates (bool): Keep only the first of documents that
+            are near duplicates of each other.
 
     Returns:
         list[str]: A list of document contents.
     """
     ddg_querier = DDGQuerier(ensemble_results=ensemble_results, top_k=top_k)
     links = ddg_querier(query)
-    documents = []
-    for link in links:
-        if 'wikipedia.org' in link:
-            documents.append(WikipediaTextractor()(link))
-        elif 'stackoverflow.com' in link:
-            documents.append(StackExchangeTextractor()(link))
-        else:
-            raise RuntimeError(f'Unknown link: {link}')
+    documents = ddg_querier.fetch_documents(links)
+    if collapse_duplicates:
+        from docstore import shared_document_store
+
+        documents = [ref.text for ref in shared_document_store().unique(documents)]
     return documents
 
 
+def stream_documents(query: str,
+                     ensemble_results: bool = True,
+                     top_k: int = 10,
+                     timeout: float = None):
+    """
+    Given a query, yield its documents as soon as each is extracted,
+    rather than once all of them are.
+
+    Args:
+        query (str): The query to search for.
+        timeout (float): Stop after this many seconds of fetching.
+
+    Yields:
+        tuple[str, str]: A link and its document contents.
+    """
+    ddg_querier = DDGQuerier(ensemble_results=ensemble_results, top_k=top_k)
+    links = ddg_querier(query)
+    yield from ddg_querier.iter_documents(links, timeout=timeout)
+
+
 def main():
     """Interactive session with DDG Querier"""
     ddg_querier = DDGQuerier(ensemble_results=True)
@@ -0,0 +1,242 @@
+"""
+Compressed, content-addressed store of extracted documents.
+
+Documents are kept zstd-compressed under the sha256 of their text and
+handed out as DocumentRefs, which only decompress when read. Each
+document also gets a MinHash signature, indexed with LSH, so that near
+duplicates (Wikipedia redirects, mobile and desktop variants of a page,
+duplicate StackOverflow questions) resolve to the same canonical
+document and are scored once.
+"""
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import zstandard
+
+from metrics import METRICS
+from shared import process_wide
+from passages import tokenize
+
+# a Mersenne prime above every 32-bit shingle hash, for the MinHash permutations
+MERSENNE_PRIME = np.uint64(2**61 - 1)
+SHINGLE_BASE = np.uint64(1_000_003)
+MASK_32 = np.uint64(2**32 - 1)
+
+
+class DocumentRef:
+    """
+    Handle on a stored document. Holds only the compressed text; read
+    it with `text` or str(). `canonical` is the digest of the document
+    it is a near duplicate of, or its own digest.
+    """
+
+    def __init__(self, digest: str, blob: bytes, size: int, canonical: str = None):
+        self.digest = digest
+        self.blob = blob
+        self.size = size
+        self.canonical = canonical or digest
+
+    @property
+    def text(self) -> str:
+        return _decompressor().decompress(self.blob).decode('utf-8')
+
+    def __str__(self) -> str:
+        return self.text
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __repr__(self) -> str:
+        return f'DocumentRef({self.digest[:12]}, size={self.size}, compressed={len(self.blob)})'
+
+
+_local = threading.local()
+
+
+def _compressor(level: int) -> zstandard.ZstdCompressor:
+    # zstandard contexts are not thread-safe, so each thread keeps its own
+    compressors = getattr(_local, 'compressors', None)
+    if compressors is None:
+        compressors = _local.compressors = {}
+    if level not in compressors:
+        compressors[level] = zstandard.ZstdCompressor(level=level)
+    return compressors[level]
+
+
+def _decompressor() -> zstandard.ZstdDecompressor:
+    decompressor = getattr(_local, 'decompressor', None)
+    if decompressor is None:
+        decompressor = _local.decompressor = zstandard.ZstdDecompressor()
+    return decompressor
+
+
+class DocumentStore:
+    """
+    In-memory store of DocumentRefs, keyed by content digest. Once the
+    compressed documents take more than `max_bytes`, the least recently
+    used are evicted. Refs already handed out stay readable after
+    their entry is evicted.
+
+    Near duplicates are found with `num_perm` MinHash permutations of
+    the document's `shingle_words`-word shingles, split into `bands`
+    LSH bands. A candidate is a near duplicate when the share of equal
+    signature values, an estimate of the Jaccard similarity of the two
+    shingle sets, is at least `threshold`. Words are hashed with crc32
+    rather than hash(), which is salted per process, so signatures are
+    the same in every process and across restarts.
+    """
+
+    def __init__(self,
+                 max_bytes: int = 2**28,
+                 level: int = 3,
+                 num_perm: int = 64,
+                 bands: int = 16,
+                 shingle_words: int = 5,
+                 threshold: float = 0.8,
+                 seed: int = 0):
+        if num_perm % bands:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+        self.max_bytes = max_bytes
+        self.level = level
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_words = shingle_words
+        self.threshold = threshold
+        rng = np.random.default_rng(seed)
+        self.__a = rng.integers(1, 2**32, num_perm, dtype=np.uint64)[:, None]
+        self.__b = rng.integers(0, 2**32, num_perm, dtype=np.uint64)[:, None]
+        self.duplicates = 0
+        self.near_duplicates = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        # compressed size of the documents currently stored
+        self.stored_bytes = 0
+        # digest -> (ref, signature)
+        self.__entries = OrderedDict()
+        # (band, band values) -> digests of canonical documents
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+
+    def signature(self, text: str) -> np.ndarray | None:
+        """MinHash signature of the text's word shingles, or None if it
+        has no words."""
+        words = tokenize(text)
+        if not words:
+            return None
+        hashes = np.array([zlib.crc32(word.encode('utf-8')) for word in words], dtype=np.uint64)
+        n = max(len(hashes) - self.shingle_words + 1, 1)
+        shingles = np.zeros(n, dtype=np.uint64)
+        for i in range(min(self.shingle_words, len(hashes))):
+            shingles = (shingles * SHINGLE_BASE + hashes[i:i + n]) & MASK_32
+        shingles = np.unique(shingles)
+        return ((self.__a * shingles + self.__b) % MERSENNE_PRIME).min(axis=1)
+
+    def band_keys(self, signature: np.ndarray) -> list[tuple]:
+        return [
+            (band, rows.tobytes())
+            for band, rows in enumerate(signature.reshape(self.bands, -1))
+        ]
+
+    def __find_canonical(self, signature: np.ndarray) -> str | None:
+        candidates = set()
+        for key in self.band_keys(signature):
+            candidates |= self.__buckets.get(key, set())
+        best, best_similarity = None, self.threshold
+        for digest in candidates:
+            similarity = float(np.mean(self.__entries[digest][1] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = digest, similarity
+        return best
+
+    def __evict(self):
+        while self.stored_bytes > self.max_bytes and self.__entries:
+            digest, (ref, signature) = self.__entries.popitem(last=False)
+            self.stored_bytes -= len(ref.blob)
+            if signature is None or ref.canonical != digest:
+                continue
+            for key in self.band_keys(signature):
+                bucket = self.__buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(digest)
+                    if not bucket:
+                        del self.__buckets[key]
+
+    def put(self, text: str) -> DocumentRef:
+        """
+        Store the text, unless a document with the same content is
+        already stored.
+
+        Args:
+            text (str): The document contents.
+
+        Returns:
+            DocumentRef: Handle on the document, whose `canonical` is the
+                digest of the first stored near duplicate, if any.
+        """
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        with self.__lock:
+            entry = self.__entries.get(digest)
+            if entry is not None:
+                self.__entries.move_to_end(digest)
+                self.duplicates += 1
+                METRICS.inc('docstore_documents_total', result='duplicate')
+                return entry[0]
+        blob = _compressor(self.level).compress(data)
+        signature = self.signature(text)
+        with self.__lock:
+            entry = self.__entries.get(digest)
+            if entry is not None:
+                return entry[0]
+            canonical = self.__find_canonical(signature) if signature is not None else None
+            ref = DocumentRef(digest, blob, len(text), canonical)
+            self.__entries[digest] = (ref, signature)
+            self.raw_bytes += len(data)
+            self.compressed_bytes += len(blob)
+            self.stored_bytes += len(blob)
+            if canonical is not None:
+                self.near_duplicates += 1
+                METRICS.inc('docstore_documents_total', result='near_duplicate')
+            else:
+                METRICS.inc('docstore_documents_total', result='new')
+                if signature is not None:
+                    for key in self.band_keys(signature):
+                        self.__buckets.setdefault(key, set()).add(digest)
+            self.__evict()
+        return ref
+
+    def get(self, digest: str) -> DocumentRef | None:
+        with self.__lock:
+            entry = self.__entries.get(digest)
+        return None if entry is None else entry[0]
+
+    def unique(self, documents: list[str]) -> list[DocumentRef]:
+        """Store the documents, returning one ref per distinct canonical
+        document, in order of first appearance."""
+        refs = {}
+        for document in documents:
+            ref = self.put(document)
+            refs.setdefault(ref.canonical, ref)
+        return list(refs.values())
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def stats(self) -> dict:
+        return {
+            'documents': len(self),
+            'duplicates': self.duplicates,
+            'near_duplicates': self.near_duplicates,
+            'compression_ratio': (
+                self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0.0
+            ),
+        }
+
+
+@process_wide
+def shared_document_store() -> DocumentStore:
+    """The process-wide DocumentStore, created on first use."""
+    return DocumentStore()
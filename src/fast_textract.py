@@ -0,0 +1,211 @@
+"""
+Single-pass text extraction for Wikipedia and StackExchange pages.
+
+Pages are parsed with lxml, which is several times faster than
+BeautifulSoup's html.parser, and unwanted nodes are skipped while the
+text is collected instead of being removed from the tree rule by rule.
+The output matches the BeautifulSoup extractors kept on the textractors
+as textract_soup; run this module on a directory of saved pages to check
+that and to time both. It deliberately differs from them where they
+do not do what an HTML parser is specified to do:
+
+- CR LF and lone CR are read as LF (lxml already does this, bs4's
+  html.parser keeps the CR), so page sources are normalized first.
+- CDATA sections outside SVG and MathML are comments to an HTML
+  parser, and lxml drops them even inside SVG, where bs4 keeps their
+  text. A section containing '>' ends there, so the rest of it is
+  kept as text.
+- A StackExchange post nested inside another is extracted on its own
+  as well, and its code blocks are fenced once rather than twice.
+
+Each of these is pinned by its own test in tests/test_textract.py.
+"""
+import argparse
+import os
+import re
+import time
+
+import lxml.html
+from lxml import etree
+
+# bs4's get_text leaves out strings inside these tags
+SKIP_TEXT_TAGS = frozenset(('script', 'style', 'template', 'rt', 'rp'))
+WIKIPEDIA_DROP_TAGS = frozenset(('table', 'img', 'figure'))
+
+PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def normalize_newlines(page_source: str) -> str:
+    """Read CR LF and lone CR as LF, as HTML parsers do."""
+    if '\r' not in page_source:
+        return page_source
+    return page_source.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def parse(page_source: str) -> etree._Element:
+    return lxml.html.document_fromstring(
+        normalize_newlines(page_source).encode('utf-8'), parser=PARSER
+    )
+
+
+def has_class(element: etree._Element, name: str) -> bool:
+    return name in (element.get('class') or '').split()
+
+
+def class_xpath(tag: str, name: str) -> str:
+    return f"{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {name} ')]"
+
+
+def collect_text(element: etree._Element, is_dropped, parts: list[str], wrap_code: bool = False):
+    """
+    Append the text of element to parts, the way bs4's get_text would
+    after removing every descendant for which is_dropped is true. Tails
+    of dropped elements are kept, as they belong to the parent.
+    """
+    if element.tag in SKIP_TEXT_TAGS:
+        return
+    if wrap_code and element.tag == 'code':
+        parts.append('```')
+    if element.text:
+        parts.append(element.text)
+    for child in element:
+        # comments and processing instructions have non-string tags
+        if isinstance(child.tag, str) and not is_dropped(child):
+            collect_text(child, is_dropped, parts, wrap_code)
+        if child.tail:
+            parts.append(child.tail)
+    if wrap_code and element.tag == 'code':
+        parts.append('```')
+
+
+def see_also_heading(main_content: etree._Element) -> etree._Element | None:
+    """
+    The element that starts the See also section, or None if the page
+    has none. Older markup puts a span#See_also inside the h2; newer
+    markup puts the id on the h2 and wraps it in a div.mw-heading.
+    """
+    span = main_content.find(".//span[@id='See_also']")
+    if span is not None:
+        for ancestor in span.iterancestors('h2'):
+            return ancestor
+        return None
+    h2 = main_content.find(".//h2[@id='See_also']")
+    if h2 is None:
+        return None
+    parent = h2.getparent()
+    if parent is not main_content and parent.tag == 'div' and has_class(parent, 'mw-heading'):
+        return parent
+    return h2
+
+
+def wikipedia_text(page_source: str) -> str:
+    """Extract the article text from a Wikipedia page.
+
+    Drops the first reflist, references, tables, images, figures,
+    hatnotes and everything from the See also heading on.
+
+    Args:
+        page_source (str)
+
+    Returns:
+        str: The extracted text.
+    """
+    root = parse(page_source)
+    matches = root.xpath(
+        "//div[@id='mw-content-text']/" + class_xpath('div', 'mw-parser-output')
+    )
+    if not matches:
+        raise RuntimeError('No article content found (no mw-parser-output)')
+    main_content = matches[0]
+    reflists = main_content.xpath('.//' + class_xpath('div', 'reflist'))
+    reflist = reflists[0] if reflists else None
+    see_also = set()
+    heading = see_also_heading(main_content)
+    if heading is not None:
+        see_also.add(heading)
+        see_also.update(heading.itersiblings())
+
+    def is_dropped(element):
+        tag = element.tag
+        return (
+            tag in WIKIPEDIA_DROP_TAGS
+            or (tag == 'sup' and has_class(element, 'reference'))
+            or (tag == 'div' and has_class(element, 'hatnote'))
+            or element is reflist
+            or element in see_also
+        )
+
+    parts = []
+    collect_text(main_content, is_dropped, parts)
+    # remove consecutive newlines
+    return re.sub(r'\n+', '\n', ''.join(parts))
+
+
+def stackexchange_text(page_source: str) -> str:
+    """Extract the question title and the question and answer bodies,
+    with code blocks surrounded by ```.
+
+    Args:
+        page_source (str)
+
+    Returns:
+        str: The extracted text.
+    """
+    root = parse(page_source)
+    text = []
+    title = root.xpath(
+        "//div[@id='question-header']//" + class_xpath('a', 'question-hyperlink')
+    )
+    if not title:
+        raise RuntimeError('No question found (no question-header)')
+    parts = []
+    collect_text(title[0], lambda element: False, parts)
+    text.append(''.join(parts))
+    for post in root.xpath('//' + class_xpath('div', 'js-post-body')):
+        parts = []
+        collect_text(post, lambda element: False, parts, wrap_code=True)
+        post_text = ''.join(parts).strip()
+        post_text = re.sub(r'\n+', '\n', post_text)
+        text.append(post_text)
+    return '\n\n'.join(text)
+
+
+def main():
+    """Check the fast extractors against the BeautifulSoup ones on a
+    directory of saved pages, and time both."""
+    from textractor import StackExchangeTextractor, WikipediaTextractor
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('pages_dir', type=str)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    soup_time = fast_time = 0.0
+    mismatches = 0
+    for name in sorted(os.listdir(args.pages_dir)):
+        # newline='' keeps carriage returns, so CR LF pages are checked as saved
+        with open(os.path.join(args.pages_dir, name), encoding='utf-8', newline='') as f:
+            page_source = f.read()
+        if 'mw-parser-output' in page_source:
+            textractor = WikipediaTextractor(use_cache=False)
+        elif 'question-header' in page_source:
+            textractor = StackExchangeTextractor(use_cache=False)
+        else:
+            continue
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            expected = textractor.textract_soup(page_source)
+        soup_time += time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            actual = textractor.textract(page_source)
+        fast_time += time.perf_counter() - start
+        if actual != expected:
+            mismatches += 1
+            print(f'MISMATCH {name}')
+    print(f'mismatches: {mismatches}')
+    print(f'bs4: {soup_time:.3f}s, lxml: {fast_time:.3f}s, speedup: {soup_time / max(fast_time, 1e-9):.1f}x')
+
+
+if __name__ == '__main__':
+    main()
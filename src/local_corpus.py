@@ -0,0 +1,470 @@
+import argparse
+import bisect
+import gzip
+import heapq
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import zlib
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from metrics import METRICS
+from passages import tokenize
+from textractor import StackExchangeTextractor, WikipediaTextractor
+
+CANONICAL_PATTERN = re.compile(r'<link[^>]+rel="canonical"[^>]+href="([^"]+)"')
+INDEX_VERSION = 3
+
+
+def iter_jsonl(path: str):
+    """Yield (url, text) from a JSONL dump with url and text fields, such
+    as the --json output of wikiextractor. Gzipped dumps are supported."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record['url'], record['text']
+
+
+def iter_html_dir(path: str):
+    """Yield (url, text) from a directory of saved Wikipedia and
+    StackOverflow pages, extracted with the usual textractors. The url
+    is read from each page's canonical link."""
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if not name.endswith(('.html', '.htm')):
+                continue
+            with open(os.path.join(root, name), encoding='utf-8') as f:
+                page_source = f.read()
+            match = CANONICAL_PATTERN.search(page_source)
+            if match is None:
+                print(f'Skipping {name}: no canonical link')
+                continue
+            url = match.group(1)
+            if 'wikipedia.org' in url:
+                textractor = WikipediaTextractor(use_cache=False)
+            elif 'stackoverflow.com' in url:
+                textractor = StackExchangeTextractor(use_cache=False)
+            else:
+                print(f'Skipping {name}: unknown link {url}')
+                continue
+            yield url, textractor.textract(page_source)
+
+
+def iter_sources(sources: list[str]):
+    for source in sources:
+        if os.path.isdir(source):
+            yield from iter_html_dir(source)
+        else:
+            yield from iter_jsonl(source)
+
+
+class TermTable:
+    """
+    The sorted terms of an index, stored as one UTF-8 blob and the
+    offsets into it. Both are memory-mapped, and terms are found by
+    binary search, so opening an index doesn't load the vocabulary.
+    """
+
+    def __init__(self, directory: str):
+        self.offsets = np.load(os.path.join(directory, 'term_text_offsets.npy'), mmap_mode='r')
+        self.text = np.memmap(os.path.join(directory, 'terms.bin'), dtype=np.uint8, mode='r') \
+            if self.offsets[-1] else np.array([], dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.text[int(self.offsets[i]):int(self.offsets[i + 1])].tobytes()
+
+    def find(self, term: str) -> int | None:
+        """The id of the term, or None if it is not in the index."""
+        key = term.encode('utf-8')
+        i = bisect.bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return i
+        return None
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """LEB128-encode unsigned integers below 2**35: seven bits per byte,
+    low bits first, with the high bit set on every byte but the last."""
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for bits in (7, 14, 21, 28):
+        lengths += values >= 1 << bits
+    starts = np.cumsum(lengths) - lengths
+    encoded = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max(initial=0))):
+        has_byte = lengths > k
+        byte = (values[has_byte] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        byte |= np.where(lengths[has_byte] > k + 1, 0x80, 0).astype(np.uint64)
+        encoded[starts[has_byte] + k] = byte
+    return encoded
+
+
+def decode_varints(encoded: np.ndarray) -> np.ndarray:
+    """Decode a run of varints written by encode_varints, as uint32s."""
+    encoded = np.asarray(encoded)
+    ends = np.flatnonzero(encoded < 0x80)
+    lengths = np.diff(ends, prepend=-1)
+    starts = ends - lengths + 1
+    values = (encoded[starts] & 0x7f).astype(np.uint32)
+    # one pass per byte position, over the varints at least that long
+    for k in range(1, int(lengths.max(initial=0))):
+        longer = np.flatnonzero(lengths > k)
+        values[longer] |= (encoded[starts[longer] + k] & 0x7f).astype(np.uint32) << np.uint32(7 * k)
+    return values
+
+
+class Postings:
+    """
+    Memory-mapped postings of an index or of one block of it. Each
+    term's doc ids are stored as varint-encoded gaps, and its term
+    frequencies (capped at 255, where BM25 has long saturated) as one
+    byte each.
+    """
+
+    def __init__(self, directory: str):
+        self.terms = TermTable(directory)
+        load = lambda name: np.load(os.path.join(directory, name), mmap_mode='r')
+        # posting offsets, so term_offsets[i + 1] - term_offsets[i] is the document frequency
+        self.term_offsets = load('term_offsets.npy')
+        # byte offsets into the encoded doc id gaps
+        self.term_doc_offsets = load('term_doc_offsets.npy')
+        self.doc_gaps = self.__load_bytes(os.path.join(directory, 'postings_docs.bin'))
+        self.tfs = self.__load_bytes(os.path.join(directory, 'postings_tfs.bin'))
+
+    @staticmethod
+    def __load_bytes(path: str) -> np.ndarray:
+        if not os.path.getsize(path):
+            return np.array([], dtype=np.uint8)
+        return np.memmap(path, dtype=np.uint8, mode='r')
+
+    def document_frequency(self, term_id: int) -> int:
+        return int(self.term_offsets[term_id + 1] - self.term_offsets[term_id])
+
+    def encoded_docs(self, term_id: int) -> np.ndarray:
+        return self.doc_gaps[int(self.term_doc_offsets[term_id]):int(self.term_doc_offsets[term_id + 1])]
+
+    def postings(self, term_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """The term's doc ids, in order, and their term frequencies."""
+        docs = np.cumsum(decode_varints(self.encoded_docs(term_id)), dtype=np.uint32)
+        tfs = self.tfs[int(self.term_offsets[term_id]):int(self.term_offsets[term_id + 1])]
+        return docs, tfs
+
+
+POSTINGS_FILES = (
+    'terms.bin', 'term_text_offsets.npy', 'term_offsets.npy', 'term_doc_offsets.npy',
+    'postings_docs.bin', 'postings_tfs.bin',
+)
+
+
+def write_block(block: dict[str, tuple[array, array]], directory: str):
+    """Write in-memory postings (term -> doc ids, term frequencies) to
+    directory in the layout Postings reads."""
+    os.makedirs(directory)
+    terms = sorted(term.encode('utf-8') for term in block)
+    with open(os.path.join(directory, 'terms.bin'), 'wb') as f:
+        f.write(b''.join(terms))
+    np.save(os.path.join(directory, 'term_text_offsets.npy'),
+            np.cumsum([0] + [len(term) for term in terms], dtype=np.uint64))
+    postings = [block[term.decode('utf-8')] for term in terms]
+    term_offsets = np.cumsum([0] + [len(docs) for docs, _ in postings], dtype=np.uint64)
+    np.save(os.path.join(directory, 'term_offsets.npy'), term_offsets)
+    docs = np.concatenate([np.frombuffer(docs, dtype=np.uint32) for docs, _ in postings] or [[]]).astype(np.int64)
+    # the first doc id of each term is a gap from 0
+    gaps = np.diff(docs, prepend=0)
+    firsts = term_offsets[:-1][np.diff(term_offsets) > 0].astype(np.int64)
+    gaps[firsts] = docs[firsts]
+    encoded = encode_varints(gaps)
+    # byte offset of each posting, and of the end
+    byte_offsets = np.concatenate(([0], np.flatnonzero(encoded < 0x80) + 1)).astype(np.uint64)
+    np.save(os.path.join(directory, 'term_doc_offsets.npy'), byte_offsets[term_offsets.astype(np.int64)])
+    with open(os.path.join(directory, 'postings_docs.bin'), 'wb') as f:
+        f.write(encoded.tobytes())
+    with open(os.path.join(directory, 'postings_tfs.bin'), 'wb') as f:
+        for _, tfs in postings:
+            f.write(tfs.tobytes())
+
+
+def merge_blocks(block_dirs: list[str], directory: str):
+    """
+    Merge blocks written by write_block into one set of postings in
+    directory. Blocks hold consecutive ranges of doc ids, so each term's
+    postings are its postings in every block, in block order; only the
+    first gap of each block's postings is re-encoded, as a gap from the
+    term's last doc id in the blocks before. Terms are merged as a
+    stream, so memory use does not grow with the index.
+    """
+    if len(block_dirs) == 1:
+        for name in POSTINGS_FILES:
+            os.replace(os.path.join(block_dirs[0], name), os.path.join(directory, name))
+        return
+    blocks = [Postings(block_dir) for block_dir in block_dirs]
+
+    def iter_terms(n: int, block: Postings):
+        for term_id in range(len(block.terms)):
+            yield block.terms[term_id], n, term_id
+
+    text_offsets, term_offsets, doc_offsets = array('Q', [0]), array('Q', [0]), array('Q', [0])
+    with open(os.path.join(directory, 'terms.bin'), 'wb') as terms, \
+            open(os.path.join(directory, 'postings_docs.bin'), 'wb') as doc_gaps, \
+            open(os.path.join(directory, 'postings_tfs.bin'), 'wb') as tfs:
+        merged = heapq.merge(*(iter_terms(n, block) for n, block in enumerate(blocks)))
+        for term, group in itertools.groupby(merged, key=lambda entry: entry[0]):
+            last, n_postings, n_bytes = 0, 0, 0
+            for _, n, term_id in group:
+                encoded = np.asarray(blocks[n].encoded_docs(term_id))
+                gaps = decode_varints(encoded)
+                first_length = int(np.argmax(encoded < 0x80)) + 1
+                first = encode_varints([int(gaps[0]) - last])
+                doc_gaps.write(first.tobytes())
+                doc_gaps.write(encoded[first_length:].tobytes())
+                tfs.write(np.asarray(blocks[n].postings(term_id)[1]).tobytes())
+                last = int(gaps.sum())
+                n_postings += len(gaps)
+                n_bytes += len(first) + len(encoded) - first_length
+            terms.write(term)
+            text_offsets.append(text_offsets[-1] + len(term))
+            term_offsets.append(term_offsets[-1] + n_postings)
+            doc_offsets.append(doc_offsets[-1] + n_bytes)
+    del blocks
+    np.save(os.path.join(directory, 'term_text_offsets.npy'), np.frombuffer(text_offsets, dtype=np.uint64))
+    np.save(os.path.join(directory, 'term_offsets.npy'), np.frombuffer(term_offsets, dtype=np.uint64))
+    np.save(os.path.join(directory, 'term_doc_offsets.npy'), np.frombuffer(doc_offsets, dtype=np.uint64))
+
+
+def build_index(sources: list[str],
+                index_dir: str,
+                k1: float = 1.5,
+                b: float = 0.75,
+                block_postings: int = 10_000_000):
+    """
+    Build a BM25 inverted index over the documents in sources.
+
+    Postings are collected in blocks of up to block_postings entries,
+    each written to disk once full and merged at the end, so memory use
+    is bounded by the block size rather than the corpus. The index
+    directory holds the sorted terms, postings (varint doc id gaps and
+    one-byte term frequencies, see Postings) and zlib-compressed
+    document texts, all as flat arrays that LocalCorpusQuerier
+    memory-maps. A url seen again is skipped, so each link names one
+    document.
+
+    Args:
+        sources (list[str]): JSONL dumps and/or directories of saved pages.
+        index_dir (str): Where to write the index.
+        k1 (float): BM25 term frequency saturation.
+        b (float): BM25 length normalization.
+        block_postings (int): Postings to hold in memory before writing
+            a block.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    blocks_dir = tempfile.mkdtemp(prefix='blocks-', dir=index_dir)
+    try:
+        block, block_size, block_dirs = {}, 0, []
+
+        def spill():
+            block_dirs.append(os.path.join(blocks_dir, str(len(block_dirs))))
+            write_block(block, block_dirs[-1])
+
+        urls, lengths, doc_offsets = [], [], [0]
+        seen, duplicates = set(), 0
+        with open(os.path.join(index_dir, 'docs.bin'), 'wb') as docs:
+            for url, text in iter_sources(sources):
+                if url in seen:
+                    duplicates += 1
+                    continue
+                seen.add(url)
+                doc_id = len(urls)
+                tokens = tokenize(text)
+                for term, tf in Counter(tokens).items():
+                    if term not in block:
+                        block[term] = array('I'), array('B')
+                    block[term][0].append(doc_id)
+                    block[term][1].append(min(tf, 255))
+                    block_size += 1
+                if block_size >= block_postings:
+                    spill()
+                    block, block_size = {}, 0
+                urls.append(url)
+                lengths.append(len(tokens))
+                compressed = zlib.compress(text.encode('utf-8'))
+                docs.write(compressed)
+                doc_offsets.append(doc_offsets[-1] + len(compressed))
+        if duplicates:
+            print(f'Skipped {duplicates} duplicate urls')
+        if block or not block_dirs:
+            spill()
+        merge_blocks(block_dirs, index_dir)
+    finally:
+        shutil.rmtree(blocks_dir, ignore_errors=True)
+
+    np.save(os.path.join(index_dir, 'doc_lengths.npy'), np.array(lengths, dtype=np.uint32))
+    np.save(os.path.join(index_dir, 'doc_offsets.npy'), np.array(doc_offsets, dtype=np.uint64))
+    with open(os.path.join(index_dir, 'urls.json'), 'w') as f:
+        json.dump(urls, f)
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': INDEX_VERSION,
+            'n_docs': len(urls),
+            'avg_length': float(np.mean(lengths)) if lengths else 0.0,
+            'k1': k1,
+            'b': b,
+        }, f)
+
+
+class LocalCorpusQuerier:
+    """
+    Drop-in replacement for DDGQuerier that ranks a local corpus built
+    with build_index using BM25, with no browser and no network. Links
+    are the urls the documents were saved from, and fetch_documents
+    reads them back out of the index.
+
+    Query terms in more than max_df of the documents are skipped like
+    stopwords, unless every term of the query is that common. Their
+    postings are the longest to decode and their BM25 weight is the
+    smallest, so this bounds query time on large corpora at little cost
+    to the ranking; None scores every term.
+    """
+
+    def __init__(self,
+                 index_dir: str,
+                 ensemble_results: bool = True,
+                 top_k: int = 10,
+                 max_df: float | None = 0.1):
+        self.index_dir = index_dir
+        self.ensemble_results = ensemble_results
+        self.top_k = top_k
+        self.max_df = max_df
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != INDEX_VERSION:
+            raise RuntimeError(
+                f'Index version {self.meta["version"]} is not {INDEX_VERSION}, rebuild it'
+            )
+        with open(os.path.join(index_dir, 'urls.json')) as f:
+            self.urls = json.load(f)
+        self.doc_ids = {url: i for i, url in enumerate(self.urls)}
+        self.postings = Postings(index_dir)
+        load = lambda name: np.load(os.path.join(index_dir, name), mmap_mode='r')
+        self.doc_lengths = load('doc_lengths.npy')
+        self.doc_offsets = load('doc_offsets.npy')
+        self.docs = np.memmap(os.path.join(index_dir, 'docs.bin'), dtype=np.uint8, mode='r') \
+            if self.doc_offsets[-1] else np.array([], dtype=np.uint8)
+
+    def scores(self, query: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        BM25 scores of the documents that share a term with the query,
+        leaving out terms more common than max_df.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Document ids and their scores.
+        """
+        k1, b = self.meta['k1'], self.meta['b']
+        n_docs, avg_length = self.meta['n_docs'], max(self.meta['avg_length'], 1.0)
+        terms = {}
+        for term, count in Counter(tokenize(query)).items():
+            term_id = self.postings.terms.find(term)
+            if term_id is not None:
+                terms[term_id] = count
+        if self.max_df is not None:
+            rare = {
+                term_id: count for term_id, count in terms.items()
+                if self.postings.document_frequency(term_id) <= self.max_df * n_docs
+            }
+            terms = rare or terms
+        doc_ids, contributions = [], []
+        for term_id, count in terms.items():
+            docs, tf = self.postings.postings(term_id)
+            tf = tf.astype(np.float64)
+            idf = np.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = k1 * (1 - b + b * self.doc_lengths[docs] / avg_length)
+            doc_ids.append(docs)
+            contributions.append(count * idf * tf * (k1 + 1) / (tf + norm))
+        if not doc_ids:
+            return np.array([], dtype=np.int64), np.array([])
+        docs, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        return docs, np.bincount(inverse, weights=np.concatenate(contributions))
+
+    def top_links(self, docs: np.ndarray, scores: np.ndarray, k: int) -> list[str]:
+        if len(docs) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            docs, scores = docs[best], scores[best]
+        order = np.lexsort((docs, -scores))
+        return [self.urls[i] for i in docs[order]]
+
+    def __call__(self, query: str) -> list[str]:
+        """
+        Given a query, return a list of links to the top results. Unlike
+        DDGQuerier, no matches is not an error and gives no links.
+
+        Args:
+            query (str): The query to search for.
+
+        Returns:
+            list[str]: A list of links to the top results.
+        """
+        docs, scores = self.scores(query)
+        if self.ensemble_results:
+            return self.top_links(docs, scores, self.top_k)
+        links = []
+        for site in ('wikipedia.org', 'stackoverflow.com'):
+            on_site = np.array([site in self.urls[i] for i in docs], dtype=bool)
+            links += self.top_links(docs[on_site], scores[on_site], self.top_k)
+        return links
+
+    def iter_documents(self, links: list[str], timeout: float = None):
+        """Yield (link, document) for each distinct link. Documents are
+        read straight from the index, so timeout is never reached. Links
+        not in the index are counted and left out, as DDGQuerier leaves
+        out links that fail to fetch."""
+        for link in dict.fromkeys(links):
+            if link not in self.doc_ids:
+                METRICS.inc('document_errors_total', stage='fetch')
+                print(f'Skipping {link}: not in the index')
+                continue
+            yield link, self.fetch_documents([link])[0]
+
+    def fetch_documents(self, links: list[str]) -> list[str]:
+        """Return the document contents of links, in the same order."""
+        documents = []
+        for link in links:
+            if link not in self.doc_ids:
+                raise RuntimeError(f'Unknown link: {link}')
+            i = self.doc_ids[link]
+            compressed = self.docs[int(self.doc_offsets[i]):int(self.doc_offsets[i + 1])]
+            documents.append(zlib.decompress(compressed.tobytes()).decode('utf-8'))
+        return documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query a local corpus index.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Build an index from JSONL dumps or directories of saved pages')
+    build.add_argument('index_dir', type=str)
+    build.add_argument('sources', type=str, nargs='+')
+    query = subparsers.add_parser('query', help='Interactive session with a built index')
+    query.add_argument('index_dir', type=str)
+    query.add_argument('--top_k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_index(args.sources, args.index_dir)
+    else:
+        querier = LocalCorpusQuerier(args.index_dir, top_k=args.top_k)
+        while True:
+            print(querier(input('Query: ')))
+
+
+if __name__ == '__main__':
+    main()
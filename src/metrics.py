@@ -0,0 +1,182 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds, from a cache hit to a slow page load
+DEFAULT_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum."""
+
+    def __init__(self, buckets: tuple[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate the q-quantile by interpolating within its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def snapshot(self) -> dict:
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': buckets,
+        }
+
+
+def escape_label_value(value: str) -> str:
+    # backslash first, so the escapes added after it are left alone
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: tuple) -> str:
+    return ','.join(f'{key}="{escape_label_value(value)}"' for key, value in labels)
+
+
+class Metrics:
+    """
+    Counters and timing histograms for the reward pipeline. Every
+    update is a dict lookup and a few additions under one lock, so it
+    is cheap enough to leave on in hot loops; set `enabled` to False to
+    turn it off entirely.
+
+    Stage timings go to the stage_seconds histogram, labelled by stage
+    (search, fetch, extract, score, ...). Counters are labelled the same
+    way, e.g. cache_requests_total{cache="document",result="hit"}.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.__counters = {}
+        self.__histograms = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Add value to the counter."""
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Record value in the histogram."""
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """Time the body of the with statement as a stage. Failed spans
+        are timed too, and counted in stage_errors_total."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc('stage_errors_total', stage=stage, **labels)
+            raise
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def cache_request(self, cache: str, hit: bool):
+        """Count a cache lookup."""
+        self.inc('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+    def reset(self):
+        with self.__lock:
+            self.__counters = {}
+            self.__histograms = {}
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+            dict: {'counters': [...], 'histograms': [...]}, each entry
+                holding its name, labels and value(s).
+        """
+        with self.__lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.__counters.items())
+            ]
+            histograms = [
+                {'name': name, 'labels': dict(labels), **histogram.snapshot()}
+                for (name, labels), histogram in sorted(self.__histograms.items())
+            ]
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix: str = 'doc_retrieval_') -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            histograms = sorted(
+                (key, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                for key, histogram in self.__histograms.items()
+            )
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {prefix}{name} counter')
+                typed.add(name)
+            lines.append(f'{prefix}{name}{{{format_labels(labels)}}} {value}')
+        for (name, labels), buckets, counts, total, count in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = format_labels(labels + (('le', le),))
+                lines.append(f'{prefix}{name}_bucket{{{bucket_labels}}} {cumulative}')
+            lines.append(f'{prefix}{name}_sum{{{format_labels(labels)}}} {total}')
+            lines.append(f'{prefix}{name}_count{{{format_labels(labels)}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+# process-wide metrics that the pipeline reports to
+METRICS = Metrics()
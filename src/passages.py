@@ -0,0 +1,201 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import METRICS
+from shared import process_wide
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased word tokens of the text."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def count_tokens(text: str) -> int:
+    """Rough LLM token count, at ~4 characters per token."""
+    return (len(text) + 3) // 4
+
+
+def split_passages(document: str, passage_words: int = 120) -> list[str]:
+    """
+    Split a document into passages of about passage_words words. Short
+    consecutive lines are merged into one passage and long lines are
+    cut into windows, so passages follow paragraph boundaries where they
+    can.
+
+    Args:
+        document (str)
+        passage_words (int)
+
+    Returns:
+        list[str]: The passages, in document order.
+    """
+    passages = []
+    current, current_words = [], 0
+    for line in document.split('\n'):
+        words = line.split()
+        if not words:
+            continue
+        if current and current_words + len(words) > passage_words:
+            passages.append('\n'.join(current))
+            current, current_words = [], 0
+        while len(words) > passage_words:
+            passages.append(' '.join(words[:passage_words]))
+            words = words[passage_words:]
+        current.append(' '.join(words))
+        current_words += len(words)
+    if current:
+        passages.append('\n'.join(current))
+    return passages
+
+
+class BM25:
+    """
+    BM25 index over a small collection of passages, such as the chunks
+    of one document. Only term ids and passage ids are stored, and
+    scoring builds term frequencies for the query terms alone, so both
+    indexing and scoring are a handful of NumPy operations.
+    """
+
+    def __init__(self, passages: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        tokens = [tokenize(passage) for passage in passages]
+        self.n_passages = len(passages)
+        self.lengths = np.array([len(t) for t in tokens], dtype=np.float64)
+        self.avg_length = max(self.lengths.mean(), 1.0) if self.n_passages else 1.0
+        flat = np.array([token for t in tokens for token in t], dtype=object)
+        self.passage_ids = np.repeat(np.arange(self.n_passages), self.lengths.astype(np.int64))
+        if len(flat):
+            self.vocab, self.term_ids = np.unique(flat.astype(str), return_inverse=True)
+        else:
+            self.vocab, self.term_ids = np.array([], dtype=str), np.array([], dtype=np.int64)
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every passage against the query."""
+        scores = np.zeros(self.n_passages)
+        query_terms, query_counts = np.unique(np.array(tokenize(query), dtype=str), return_counts=True)
+        if not len(query_terms) or not len(self.vocab):
+            return scores
+        positions = np.searchsorted(self.vocab, query_terms)
+        positions = np.minimum(positions, len(self.vocab) - 1)
+        present = self.vocab[positions] == query_terms
+        query_ids, query_counts = positions[present], query_counts[present]
+        if not len(query_ids):
+            return scores
+        mask = np.isin(self.term_ids, query_ids)
+        tf = np.zeros((self.n_passages, len(query_ids)))
+        np.add.at(tf, (self.passage_ids[mask], np.searchsorted(query_ids, self.term_ids[mask])), 1)
+        df = (tf > 0).sum(axis=0)
+        idf = np.log(1 + (self.n_passages - df + 0.5) / (df + 0.5))
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / self.avg_length)
+        weights = tf * (self.k1 + 1) / (tf + norm[:, None])
+        return weights @ (idf * query_counts)
+
+
+class PassageIndexCache:
+    """
+    The passages of recently seen documents and their BM25 index, keyed
+    on the document's sha256 digest, so a document shared by several
+    samples is split and indexed once and only the queries are scored
+    per sample. Holds at most `max_entries` documents, evicting the
+    least recently used.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__indexes = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, document: str, passage_words: int = 120, digest: str = None) -> tuple[list[str], BM25]:
+        """
+        Args:
+            document (str)
+            passage_words (int)
+            digest (str): The sha256 hex digest of the document, if the
+                caller already has it.
+
+        Returns:
+            tuple[list[str], BM25]: The passages and their index.
+        """
+        if digest is None:
+            digest = hashlib.sha256(document.encode('utf-8')).hexdigest()
+        key = (digest, passage_words)
+        with self.__lock:
+            index = self.__indexes.get(key)
+            if index is not None:
+                self.__indexes.move_to_end(key)
+                self.hits += 1
+        METRICS.cache_request('passages', hit=index is not None)
+        if index is not None:
+            return index
+        # built outside the lock; two threads missing at once both build it
+        passages = split_passages(document, passage_words)
+        index = passages, BM25(passages)
+        with self.__lock:
+            self.misses += 1
+            self.__indexes[key] = index
+            while len(self.__indexes) > self.max_entries:
+                self.__indexes.popitem(last=False)
+        return index
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.__indexes)}
+
+
+@process_wide
+def shared_passage_index_cache() -> PassageIndexCache:
+    """The process-wide PassageIndexCache, created on first use."""
+    return PassageIndexCache()
+
+
+def select_passages(document: str,
+                    query: str,
+                    token_budget: int = 1000,
+                    passage_words: int = 120,
+                    digest: str = None,
+                    index_cache: PassageIndexCache = None) -> str:
+    """
+    Return the passages of the document most relevant to the query, up
+    to token_budget tokens, in document order. Documents that already
+    fit in the budget are returned unchanged. The document's passages
+    and index are cached, so scoring it against further queries only
+    ranks the passages.
+
+    Args:
+        document (str): The extracted document.
+        query (str): What the passages are ranked against, typically the
+            prompt and completion.
+        token_budget (int): Approximate number of tokens to keep.
+        passage_words (int): Approximate passage length in words.
+        digest (str): The sha256 hex digest of the document, if known.
+        index_cache (PassageIndexCache): Defaults to the shared one.
+
+    Returns:
+        str: The selected passages, separated by blank lines.
+    """
+    if count_tokens(document) <= token_budget:
+        return document
+    index_cache = index_cache or shared_passage_index_cache()
+    passages, index = index_cache.get(document, passage_words, digest)
+    scores = index.scores(query)
+    selected, used = [], 0
+    for i in np.argsort(-scores, kind='stable'):
+        tokens = count_tokens(passages[i])
+        if used + tokens > token_budget:
+            if selected:
+                continue
+            # always keep at least the best passage, cut to fit
+            selected.append(i)
+            break
+        selected.append(i)
+        used += tokens
+    text = '\n\n'.join(passages[i] for i in sorted(selected))
+    return text[:token_budget * 4]
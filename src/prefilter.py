@@ -0,0 +1,107 @@
+import threading
+import zlib
+
+import numpy as np
+
+from metrics import METRICS
+from passages import tokenize
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'do', 'does',
+    'for', 'from', 'has', 'have', 'he', 'her', 'his', 'how', 'i', 'if', 'in',
+    'into', 'is', 'it', 'its', 'just', 'me', 'my', 'no', 'not', 'of', 'on', 'or',
+    'our', 'she', 'so', 'such', 'than', 'that', 'the', 'their', 'them', 'then',
+    'there', 'these', 'they', 'this', 'to', 'was', 'we', 'were', 'what', 'when',
+    'which', 'who', 'will', 'with', 'would', 'you', 'your',
+))
+
+
+class RelevanceFilter:
+    """
+    CPU-only first stage of the scoring cascade. Compares the completion
+    with each document and marks the documents below `threshold` as
+    irrelevant, so they can be given a score of 0 without an LLM call.
+
+    Terms are hashed into `dim` buckets, so a batch of documents becomes
+    one NumPy matrix. With method='overlap' the similarity is the share
+    of the completion's content terms found in the document; with
+    method='cosine' it is the cosine similarity of log-scaled term
+    counts. A completion with no content terms (empty, or only
+    stopwords) can't be compared, so every document goes on to be
+    scored. The skipped and escalated counts are kept to tune the
+    threshold against.
+    """
+
+    def __init__(self, threshold: float = 0.2, method: str = 'overlap', dim: int = 2**18):
+        if method not in ('overlap', 'cosine'):
+            raise ValueError(f'Unknown method: {method}')
+        self.threshold = threshold
+        self.method = method
+        self.dim = dim
+        self.skipped = 0
+        self.escalated = 0
+        self.__lock = threading.Lock()
+
+    def hash_terms(self, text: str) -> np.ndarray:
+        terms = [term for term in tokenize(text) if term not in STOPWORDS]
+        return np.fromiter(
+            (zlib.crc32(term.encode()) % self.dim for term in terms),
+            dtype=np.int64, count=len(terms),
+        )
+
+    def similarities(self, completion: str, documents: list[str]) -> np.ndarray:
+        """Similarity of the completion to each document, in [0, 1]."""
+        query = self.hash_terms(completion)
+        if not len(query) or not documents:
+            return np.zeros(len(documents))
+        hashed = [self.hash_terms(document) for document in documents]
+        doc_ids = np.repeat(np.arange(len(documents)), [len(h) for h in hashed])
+        flat = doc_ids * self.dim + np.concatenate(hashed)
+        if self.method == 'overlap':
+            terms = np.unique(query)
+            present = np.isin(
+                np.arange(len(documents))[:, None] * self.dim + terms, flat
+            )
+            return present.mean(axis=1)
+        # cosine over the union of buckets either side uses, so the
+        # document matrix is never materialized at full width
+        buckets, inverse = np.unique(np.concatenate([query, flat % self.dim]), return_inverse=True)
+        query_counts = np.bincount(inverse[:len(query)], minlength=len(buckets))
+        doc_counts = np.bincount(
+            doc_ids * len(buckets) + inverse[len(query):],
+            minlength=len(documents) * len(buckets),
+        ).reshape(len(documents), len(buckets))
+        query_vector = np.log1p(query_counts)
+        doc_vectors = np.log1p(doc_counts)
+        norms = np.linalg.norm(doc_vectors, axis=1) * np.linalg.norm(query_vector)
+        return np.divide(doc_vectors @ query_vector, norms, out=np.zeros(len(documents)), where=norms > 0)
+
+    def __call__(self, completion: str, documents: list[str]) -> list[bool]:
+        """
+        Args:
+            completion (str): The assistant completion.
+            documents (list[str]): The documents to check.
+
+        Returns:
+            list[bool]: Whether each document should go on to be scored.
+        """
+        if not len(self.hash_terms(completion)):
+            relevant = [True] * len(documents)
+        else:
+            relevant = (self.similarities(completion, documents) >= self.threshold).tolist()
+        escalated = sum(relevant)
+        skipped = len(relevant) - escalated
+        with self.__lock:
+            self.escalated += escalated
+            self.skipped += skipped
+        METRICS.inc('prefilter_documents_total', escalated, result='escalated')
+        METRICS.inc('prefilter_documents_total', skipped, result='skipped')
+        return relevant
+
+    def stats(self) -> dict:
+        total = self.skipped + self.escalated
+        return {
+            'skipped': self.skipped,
+            'escalated': self.escalated,
+            'skip_rate': self.skipped / total if total else 0.0,
+        }
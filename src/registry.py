@@ -0,0 +1,147 @@
+"""
+Registry of the pluggable backends of the reward pipeline: curlers,
+queriers, extractors and scorers.
+
+Backends are registered as "module:attribute" paths and only imported
+when first created, so a worker that is configured for cached or local
+backends never imports selenium, aiohttp, bs4 or the LLM client. A
+backend is a factory: calling it with the backend's config returns the
+component. A scorer is a `prompt -> reply` function.
+
+    model = build_reward_model({
+        'querier': {'backend': 'local_corpus', 'index_dir': 'index/'},
+        'scorer': 'openai',
+        'reward_model': {'top_k': 5},
+    })
+"""
+import importlib
+import json
+import os
+import threading
+from typing import Callable
+
+BACKENDS = {
+    'curler': {
+        'selenium_pool': 'curler:shared_curler_pool',
+        'selenium': 'curler:SeleniumCurler',
+        'http': 'curler:HTTPCurler',
+        'async_http': 'curler:shared_async_http_curler',
+    },
+    'querier': {
+        'ddg': 'ddg_querier:DDGQuerier',
+        'local_corpus': 'local_corpus:LocalCorpusQuerier',
+    },
+    'extractor': {
+        'wikipedia': 'textractor:WikipediaTextractor',
+        'stackexchange': 'textractor:StackExchangeTextractor',
+    },
+    'scorer': {
+        'openai': 'registry:openai_scorer',
+        'constant': 'registry:constant_scorer',
+    },
+}
+
+# link domain -> extractor backend for its pages
+EXTRACTOR_DOMAINS = {
+    'wikipedia.org': 'wikipedia',
+    'stackoverflow.com': 'stackexchange',
+}
+
+_lock = threading.Lock()
+
+
+def register(kind: str, name: str, factory: str | Callable):
+    """
+    Add or replace a backend.
+
+    Args:
+        kind (str): 'curler', 'querier', 'extractor' or 'scorer'.
+        name (str): The name configs select it by.
+        factory (str | Callable): The factory, or its "module:attribute"
+            path to import it from when first used.
+    """
+    if kind not in BACKENDS:
+        raise ValueError(f'Unknown backend kind: {kind}')
+    with _lock:
+        BACKENDS[kind][name] = factory
+
+
+def resolve(kind: str, name: str) -> Callable:
+    """The factory of the backend, imported on first use."""
+    if kind not in BACKENDS:
+        raise ValueError(f'Unknown backend kind: {kind}')
+    with _lock:
+        factory = BACKENDS[kind].get(name)
+    if factory is None:
+        raise ValueError(f'Unknown {kind} backend: {name} (known: {", ".join(BACKENDS[kind])})')
+    if isinstance(factory, str):
+        module, attribute = factory.split(':')
+        factory = getattr(importlib.import_module(module), attribute)
+        with _lock:
+            BACKENDS[kind][name] = factory
+    return factory
+
+
+def create(kind: str, config: str | dict | None):
+    """
+    Build a component from its config: a backend name, or a dict with
+    the backend name under 'backend' and the factory's keyword
+    arguments. Returns None for a None config.
+    """
+    if config is None:
+        return None
+    if isinstance(config, str):
+        config = {'backend': config}
+    kwargs = dict(config)
+    return resolve(kind, kwargs.pop('backend'))(**kwargs)
+
+
+def extractor_for(link: str, **kwargs):
+    """Create the extractor for the link's domain.
+
+    Raises:
+        RuntimeError: If no extractor handles the link."""
+    for domain, name in EXTRACTOR_DOMAINS.items():
+        if domain in link:
+            return create('extractor', {'backend': name, **kwargs})
+    raise RuntimeError(f'Unknown link: {link}')
+
+
+def openai_scorer() -> Callable[[str], str]:
+    if os.environ.get('OPENAI_API_KEY', '') == '':
+        raise RuntimeError('Please set OPENAI_API_KEY environment variable.')
+    import autocrit
+
+    return autocrit.generate_openai
+
+
+def constant_scorer(reply: str = '0') -> Callable[[str], str]:
+    """Scorer that gives every prompt the same reply, for dry runs."""
+    return lambda prompt: reply
+
+
+def build_reward_model(config: dict):
+    """
+    Build a RewardModel from a config with optional 'querier', 'scorer'
+    and 'reward_model' entries. The querier's 'curler' and
+    'page_curler' entries may be curler configs themselves. Components
+    left out get RewardModel's defaults.
+    """
+    from reward_model import RewardModel
+
+    querier = config.get('querier')
+    if isinstance(querier, dict):
+        querier = dict(querier)
+        for key in ('curler', 'page_curler'):
+            if key in querier:
+                querier[key] = create('curler', querier[key])
+    return RewardModel(
+        doc_querier=create('querier', querier),
+        generate=create('scorer', config.get('scorer')),
+        **config.get('reward_model', {}),
+    )
+
+
+def load_config(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
@@ -1,10 +1,180 @@
-from typing import Tuple
-from ddg_querier import DDGQuerier
-import autocrit
+import json
+import logging
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING
+from cache import ScoreCache
+from metrics import METRICS
+from registry import create
+from scheduler import Scheduler, shared_scheduler
+
+# the querier, scorer and document store are imported when first used,
+# so a worker with local backends starts without selenium or the LLM client
+if TYPE_CHECKING:
+    from docstore import DocumentRef, DocumentStore
+    from prefilter import RelevanceFilter
+
+logger = logging.getLogger(__name__)
+
+# Bump SCORING_PROMPT_VERSION whenever the scoring prompt changes, so cached scores are not reused.
+SCORING_PROMPT_VERSION = 2
+# scores from the single and multi-document prompts are cached apart
+SCORE_CACHE_VERSION = f'{SCORING_PROMPT_VERSION}:single'
+SCORES_CACHE_VERSION = f'{SCORING_PROMPT_VERSION}:multi'
+SCORE_REQUEST = "Think about whether the assistant's response conflicts with information in the document, as it relates to the user query. Provide only a score from -1 to 1, where -1 indicates that the assistant's response is definitely contradictory, 0 indicates that the assistant's response is irrelevant, and 1 indicates that the assistant's response is definitely in accordance with the document."
+SCORES_REQUEST = "For each document, think about whether the assistant's response conflicts with information in that document, as it relates to the user query. Score each document from -1 to 1, where -1 indicates that the assistant's response is definitely contradictory, 0 indicates that the assistant's response is irrelevant, and 1 indicates that the assistant's response is definitely in accordance with the document. Respond with only a JSON object of the form {\"scores\": [score for document 1, score for document 2, ...]}, with one score per document, in order."
+
+NUMBER = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)'
+# a score leading the reply, e.g. "-1", "-1. The response..." or "0.5 - partially consistent"
+LEADING_SCORE_PATTERN = re.compile(rf'^[^\w+\-.]*(?:score[^\w+\-.]*)?({NUMBER})(?=[\s.,;:!)\]-]|$)', re.IGNORECASE)
+LABELLED_SCORE_PATTERN = re.compile(rf'score\s*[:=]\s*\[*\s*({NUMBER})', re.IGNORECASE)
+
+# LLM client errors worth retrying, matched by class name so the client
+# library need not be imported here
+TRANSIENT_ERRORS = frozenset((
+    'RateLimitError', 'Timeout', 'APITimeoutError', 'APIConnectionError',
+    'ServiceUnavailableError', 'InternalServerError', 'TryAgain',
+))
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether a failed LLM call is worth retrying."""
+    return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in TRANSIENT_ERRORS
+
+
+def to_score(value) -> float | None:
+    """The value as a score in [-1, 1], or None if it is not one."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        if not re.fullmatch(NUMBER, value.strip()):
+            return None
+        value = float(value)
+    if not isinstance(value, (int, float)) or not -1 <= value <= 1:
+        return None
+    return float(value)
+
+
+def parse_score(reply: str) -> float | None:
+    """
+    Parse a single score from a reply such as "1", "Score: -1" or
+    "-0.5. The response...", where the score leads the reply or follows
+    a "score:" label. Returns None when the reply holds no score in
+    [-1, 1], e.g. a comment about inappropriate contents.
+    """
+    match = LEADING_SCORE_PATTERN.match(reply.strip()) or LABELLED_SCORE_PATTERN.search(reply)
+    if match is None:
+        return None
+    return to_score(match.group(1))
+
+
+def parse_scores(reply: str, n_documents: int) -> list[float | None]:
+    """
+    Parse the {"scores": [...]} reply to a multi-document scoring
+    prompt. Tolerates text around the JSON and a bare list. Entries that
+    are missing or not a score in [-1, 1] come back as None.
+    """
+    scores = None
+    for start, end in (('{', '}'), ('[', ']')):
+        first, last = reply.find(start), reply.rfind(end)
+        if first == -1 or last < first:
+            continue
+        try:
+            parsed = json.loads(reply[first:last + 1])
+        except json.JSONDecodeError:
+            continue
+        if isinstance(parsed, dict):
+            parsed = parsed.get('scores')
+        if isinstance(parsed, list):
+            scores = parsed
+            break
+    if scores is None:
+        return [None] * n_documents
+    scores = [to_score(score) for score in scores[:n_documents]]
+    return scores + [None] * (n_documents - len(scores))
 
 class RewardModel:
-    def __init__(self, ensemble_results: bool = True, top_k: int = 10):
-        self.doc_querier = DDGQuerier(ensemble_results=ensemble_results, top_k=top_k)
+    def __init__(self,
+                 ensemble_results: bool = True,
+                 top_k: int = 10,
+                 max_workers: int = 16,
+                 score_cache: ScoreCache = None,
+                 score_cache_path: str = None,
+                 passage_token_budget: int | None = 1000,
+                 doc_querier=None,
+                 generate=None,
+                 min_documents: int | None = None,
+                 deadline: float | None = None,
+                 documents_per_prompt: int = 1,
+                 relevance_filter: 'RelevanceFilter | None' = None,
+                 scheduler: Scheduler = None,
+                 llm_host: str = 'api.openai.com',
+                 document_store: 'DocumentStore' = None):
+        self.ensemble_results = ensemble_results
+        self.top_k = top_k
+        # any querier with __call__(query) -> links and iter_documents(links), e.g. LocalCorpusQuerier
+        self.__doc_querier = doc_querier
+        self.max_workers = max_workers
+        # prompt -> completion used for scoring, openai unless given
+        self.__generate = generate
+        # scores are memoized in memory, and spilled to disk if a path is given
+        self.score_cache = score_cache or ScoreCache(path=score_cache_path)
+        # only the passages most relevant to the sample are scored; None scores whole documents
+        self.passage_token_budget = passage_token_budget
+        # stop waiting for pages once every sample has received min_documents documents,
+        # and for pages and scores after deadline seconds
+        self.min_documents = min_documents
+        self.deadline = deadline
+        # documents scored together in one prompt; 1 scores each document on its own
+        self.documents_per_prompt = documents_per_prompt
+        # documents this filter rejects score 0 without an LLM call
+        self.relevance_filter = relevance_filter
+        # LLM calls are rate limited, retried and coalesced as requests to llm_host
+        self.scheduler = scheduler or shared_scheduler()
+        self.llm_host = llm_host
+        # documents are held compressed until scored, and near duplicates are scored once per sample
+        self.__document_store = document_store
+        self.__executor = None
+        # the reward server runs several batches at once, so components are created under a lock
+        self.__lock = threading.Lock()
+
+    @property
+    def doc_querier(self):
+        with self.__lock:
+            if self.__doc_querier is None:
+                self.__doc_querier = create('querier', {
+                    'backend': 'ddg', 'ensemble_results': self.ensemble_results, 'top_k': self.top_k,
+                })
+        return self.__doc_querier
+
+    @property
+    def generate(self):
+        with self.__lock:
+            if self.__generate is None:
+                self.__generate = create('scorer', 'openai')
+        return self.__generate
+
+    @property
+    def document_store(self) -> 'DocumentStore':
+        with self.__lock:
+            if self.__document_store is None:
+                from docstore import shared_document_store
+
+                self.__document_store = shared_document_store()
+        return self.__document_store
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Bounded pool that searches and scoring calls are run on."""
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='reward-model'
+                )
+        return self.__executor
 
     def get_reward(self, prompt: str, completion: str) -> float:
         """
@@ -17,29 +187,192 @@ class RewardModel:
         Returns:
             float: The reward
         """
+        return self.get_rewards([prompt], [completion])[0]
 
-        # added error handling in case of no matching doc was found.
-        try:
-            documents = self.doc_querier(prompt + completion)
-        except RuntimeError as e:
-            # e.args be like (message, )
-            if e.args[0] == "No results found (no OL)":
-                return 0.0
-            raise
+    def get_rewards(self, prompts: list[str], completions: list[str]) -> list[float]:
+        """
+        Given a batch of queries and completions, return their rewards.
+        Searches for the whole batch run concurrently, and each distinct
+        document is fetched once for the whole batch. Documents are
+        streamed in as they are extracted, and every (sample, document)
+        pair is scored on the executor as soon as its document arrives,
+        so scoring overlaps the slower page loads. Documents wait for
+        scoring compressed in the document store, and a document that is
+        a near duplicate of one the sample already has is left out.
+
+        If min_documents or deadline is set, pages still loading once
+        every sample has received min_documents documents, or after
+        deadline seconds, are dropped. Scoring that has not finished by
+        the deadline is dropped too, and samples are averaged over the
+        documents scored in time.
+
+        A sample whose search finds nothing scores 0. A sample whose
+        search or scoring fails gets a NaN reward, so the failure is
+        not mistaken for an irrelevant completion; the other samples
+        are scored as usual.
+
+        Args:
+            prompts (list[str]): The user prompts.
+            completions (list[str]): The assistant completions, one per
+                prompt.
+
+        Returns:
+            list[float]: The rewards, in input order.
+        """
+        if len(prompts) != len(completions):
+            raise ValueError(
+                f'Got {len(prompts)} prompts but {len(completions)} completions'
+            )
+        METRICS.inc('rewards_total', len(prompts))
+        with METRICS.span('reward_batch'):
+            start = time.monotonic()
+            queries = [prompt + completion for prompt, completion in zip(prompts, completions)]
+            searches = [self.executor.submit(self.search, query) for query in queries]
+            failed = [False] * len(prompts)
+            links = []
+            for i, search in enumerate(searches):
+                try:
+                    links.append(search.result())
+                except Exception as e:
+                    METRICS.inc('search_errors_total')
+                    logger.warning('Search failed for sample %d: %r', i, e)
+                    failed[i] = True
+                    links.append([])
+
+            samples_by_link = {}
+            for i, sample_links in enumerate(links):
+                for link in sample_links:
+                    samples_by_link.setdefault(link, []).append(i)
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(self.deadline - (time.monotonic() - start), 0.0)
+
+            # Determine whether the answer conflicts with each of the documents and average them.
+            # Do this by asking openai whether the answer conflicts with the document.
+            # Each sample's documents are scored documents_per_prompt at a time.
+            scores = [[] for _ in prompts]
+            received = [[] for _ in prompts]
+            waiting = [[] for _ in prompts]
+            seen = [set() for _ in prompts]
+
+            def submit(i):
+                if waiting[i]:
+                    scores[i].append(self.executor.submit(
+                        self.score_passages, prompts[i], completions[i], waiting[i]
+                    ))
+                    waiting[i] = []
+
+            documents = self.doc_querier.iter_documents(list(samples_by_link), timeout=timeout)
+            try:
+                for link, document in documents:
+                    document = self.document_store.put(document)
+                    for i in samples_by_link[link]:
+                        received[i].append(link)
+                        if document.canonical in seen[i]:
+                            METRICS.inc('duplicate_documents_total')
+                            continue
+                        seen[i].add(document.canonical)
+                        waiting[i].append(document)
+                        if len(waiting[i]) >= self.documents_per_prompt:
+                            submit(i)
+                    if self.has_enough_documents(received, links):
+                        break
+            finally:
+                documents.close()
+            for i in range(len(prompts)):
+                submit(i)
+
+            if self.deadline is not None:
+                remaining = max(self.deadline - (time.monotonic() - start), 0.0)
+                batches = [batch for sample_scores in scores for batch in sample_scores]
+                pending = wait(batches, timeout=remaining).not_done
+                if pending:
+                    METRICS.inc('timeouts_total', len(pending), stage='score')
+                    for batch in pending:
+                        batch.cancel()
+                    scores = [[batch for batch in sample_scores if batch not in pending] for sample_scores in scores]
+
+            rewards = []
+            for i, sample_scores in enumerate(scores):
+                try:
+                    sample_scores = [score for batch in sample_scores for score in batch.result()]
+                except Exception as e:
+                    METRICS.inc('score_errors_total')
+                    logger.warning('Scoring failed for sample %d: %r', i, e)
+                    failed[i] = True
+                if failed[i]:
+                    rewards.append(math.nan)
+                    continue
+                if not sample_scores:
+                    rewards.append(0.0)
+                    continue
+                rewards.append(sum(sample_scores) / len(sample_scores))
+            return rewards
 
-        # Determine whether the answer conflicts with each of the documents and average them.
-        # Do this by asking openai whether the answer conflicts with the document.
+    def has_enough_documents(self, received: list[list[str]], links: list[list[str]]) -> bool:
+        """Whether every sample has received min_documents documents (or
+        all of its links)."""
+        if self.min_documents is None:
+            return False
+        return all(
+            len(sample_received) >= min(self.min_documents, len(set(sample_links)))
+            for sample_received, sample_links in zip(received, links)
+        )
 
-        reward = 0.0
-        for document in documents:
-            reward += self.score_document(prompt, completion, document)
-        reward /= len(documents)
-        return reward
+    def search(self, query: str) -> list[str]:
+        """
+        Return the links for the query, or no links if the search found
+        no results. Searches that fail raise.
+        """
+        from ddg_querier import NoResultsError
 
+        try:
+            return self.doc_querier(query)
+        except NoResultsError:
+            return []
     
+    def score_passages(self, prompt: str, completion: str, documents: list['str | DocumentRef']) -> list[float]:
+        """
+        Score the passages of each document most relevant to the prompt
+        and completion, up to passage_token_budget tokens per document.
+        Documents the relevance filter rejects score 0 without being sent
+        to the LLM.
+        """
+        # DocumentRefs already carry the digest their passage index is cached under
+        digests = [getattr(document, 'digest', None) for document in documents]
+        documents = [str(document) for document in documents]
+        scores = [None] * len(documents)
+        if self.relevance_filter is not None:
+            with METRICS.span('prefilter'):
+                relevant = self.relevance_filter(completion, documents)
+            scores = [None if keep else 0.0 for keep in relevant]
+        todo = [i for i, score in enumerate(scores) if score is None]
+        selected = [documents[i] for i in todo]
+        if self.passage_token_budget is not None:
+            from passages import select_passages
+
+            with METRICS.span('select_passages'):
+                query = prompt + '\n' + completion
+                selected = [
+                    select_passages(documents[i], query, self.passage_token_budget, digest=digests[i])
+                    for i in todo
+                ]
+        if len(selected) == 1:
+            generated = [self.score_document(prompt, completion, selected[0])]
+        elif selected:
+            generated = self.score_documents(prompt, completion, selected)
+        else:
+            generated = []
+        for i, score in zip(todo, generated):
+            scores[i] = score
+        return scores
+
     def score_document(self, prompt: str, completion: str, document: str) -> float:
         """
-        Given a query and completion, return a score.
+        Given a query and completion, return a score. Scores are cached,
+        so a triple that was already scored does not call openai again.
+        A reply with no score in it scores 0 and is not cached, so the
+        triple is asked about again next time.
 
         Args:
             prompt (str): The user prompt.
@@ -49,14 +382,85 @@ class RewardModel:
         Returns:
             float: The score.
         """
-        score_request = "Think about whether the assistant's response conflicts with information in the document, as it relates to the user query. Provide only a score from -1 to 1, where -1 indicates that the assistant's response is definitely contradictory, 0 indicates that the assistant's response is irrelevant, and 1 indicates that the assistant's response is definitely in accordance with the document."
-        scoring_prompt = "USER: " + prompt + "\nASSISTANT: " + completion + "\nDOCUMENT: " + document + "\nSCORE REQUEST: " + score_request + "\nSCORE:"
-        score = autocrit.generate_openai(scoring_prompt)
+        key = self.score_cache.key(SCORE_CACHE_VERSION, prompt, completion, document)
+        score = self.score_cache.get(key)
+        if score is None:
+            score = self.generate_score(prompt, completion, document)
+            if score is None:
+                METRICS.inc('unparseable_scores_total')
+                return 0.0
+            self.score_cache.put(key, score)
+        return score
+
+    def score_documents(self, prompt: str, completion: str, documents: list[str]) -> list[float]:
+        """
+        Given a query and completion, score several documents with one
+        request. Documents whose score is cached are left out of the
+        request, and any whose score can't be parsed from the reply are
+        scored on their own with score_document.
+
+        Args:
+            prompt (str): The user prompt.
+            completion (str): The assistant completion.
+            documents (list[str]): The documents to score.
+
+        Returns:
+            list[float]: The scores, in order.
+        """
+        keys = [
+            self.score_cache.key(SCORES_CACHE_VERSION, prompt, completion, document)
+            for document in documents
+        ]
+        scores = [self.score_cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if len(missing) > 1:
+            generated = self.generate_scores(prompt, completion, [documents[i] for i in missing])
+            for i, score in zip(missing, generated):
+                if score is not None:
+                    scores[i] = score
+                    self.score_cache.put(keys[i], score)
+        for i, score in enumerate(scores):
+            if score is None:
+                METRICS.inc('score_fallbacks_total')
+                scores[i] = self.score_document(prompt, completion, documents[i])
+        return scores
+
+    def complete(self, scoring_prompt: str) -> str:
+        """Send the prompt to the LLM, within llm_host's rate limits,
+        retrying transient errors. Identical prompts in flight at the
+        same time share one request."""
+        def attempt():
+            try:
+                return self.generate(scoring_prompt)
+            except Exception as e:
+                if type(e).__name__ == 'RateLimitError':
+                    self.scheduler.throttled(self.llm_host)
+                raise
+
+        return self.scheduler.coalesce(
+            ('generate', scoring_prompt),
+            lambda: self.scheduler.call(self.llm_host, attempt, retry_on=is_transient_error),
+        )
+
+    def generate_scores(self, prompt: str, completion: str, documents: list[str]) -> list[float | None]:
+        """Ask openai for the scores of several documents in one request,
+        without caching. Scores that could not be parsed are None."""
+        numbered = "".join(
+            f"\nDOCUMENT {i + 1}: " + document for i, document in enumerate(documents)
+        )
+        scoring_prompt = "USER: " + prompt + "\nASSISTANT: " + completion + numbered + "\nSCORE REQUEST: " + SCORES_REQUEST + "\nSCORES:"
+        with METRICS.span('score', documents=len(documents)):
+            reply = self.complete(scoring_prompt)
+        return parse_scores(reply, len(documents))
+
+    def generate_score(self, prompt: str, completion: str, document: str) -> float | None:
+        """Ask openai for the score of a single document, without caching.
+        None if the reply holds no score."""
+        scoring_prompt = "USER: " + prompt + "\nASSISTANT: " + completion + "\nDOCUMENT: " + document + "\nSCORE REQUEST: " + SCORE_REQUEST + "\nSCORE:"
+        with METRICS.span('score'):
+            reply = self.complete(scoring_prompt)
         # score is in the format "Score: num", but sometimes is a comment about inappropriate contents
-        score = score.split(':')[-1]
-        if not score.isdigit():
-            return 0.0
-        return float(score) #Idk what format this is in. Prob need to extract the output and make it a float.
+        return parse_score(reply)
         
 
 
@@ -0,0 +1,313 @@
+"""
+Long-lived reward service shared by many trainer processes.
+
+One server holds the warm curlers, caches and scoring executor, and
+serves get_reward/get_rewards over HTTP on a TCP port or a Unix socket.
+Requests that arrive within a short window are batched together into a
+single RewardModel.get_rewards call. RewardClient is a drop-in for
+RewardModel on the trainer side.
+
+    python reward_server.py --unix_socket /tmp/reward.sock
+    python revise.py --reward_server unix:///tmp/reward.sock
+"""
+import argparse
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import METRICS
+
+
+class RewardBatcher:
+    """
+    Collects get_rewards requests for up to `window` seconds (or until
+    max_batch_size samples are waiting) and scores them in one call to
+    the model, so documents and scores are shared across requests. If
+    a merged batch fails, its requests are retried one by one, so a
+    bad request only fails its own client.
+    """
+
+    def __init__(self,
+                 model,
+                 window: float = 0.05,
+                 max_batch_size: int = 512,
+                 max_concurrent_batches: int = 2):
+        self.model = model
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.__requests = queue.Queue()
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_batches, thread_name_prefix='reward-batch'
+        )
+        threading.Thread(target=self.__collect, name='reward-batcher', daemon=True).start()
+
+    def submit(self, prompts: list[str], completions: list[str]) -> Future:
+        """Queue the samples for the next batch.
+
+        Returns:
+            Future: resolves to their rewards, in order."""
+        if len(prompts) != len(completions):
+            raise ValueError(
+                f'Got {len(prompts)} prompts but {len(completions)} completions'
+            )
+        future = Future()
+        self.__requests.put((prompts, completions, future))
+        return future
+
+    def get_rewards(self, prompts: list[str], completions: list[str]) -> list[float]:
+        return self.submit(prompts, completions).result()
+
+    def __collect(self):
+        while True:
+            batch = [self.__requests.get()]
+            size = len(batch[0][0])
+            closes_at = time.monotonic() + self.window
+            while size < self.max_batch_size:
+                remaining = closes_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.__requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self.__executor.submit(self.__run, batch)
+
+    def __run(self, batch: list[tuple]):
+        prompts = [prompt for request in batch for prompt in request[0]]
+        completions = [completion for request in batch for completion in request[1]]
+        METRICS.observe('server_batch_size', len(prompts))
+        try:
+            rewards = self.model.get_rewards(prompts, completions)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][2].set_exception(e)
+                return
+            METRICS.inc('server_batch_splits_total')
+            for request in batch:
+                self.__run([request])
+            return
+        start = 0
+        for request_prompts, _, future in batch:
+            future.set_result(rewards[start:start + len(request_prompts)])
+            start += len(request_prompts)
+
+
+def make_handler(batcher: RewardBatcher):
+    class RewardHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def respond(self, status: int, body: str, content_type: str = 'application/json'):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.respond(200, json.dumps({'status': 'ok'}))
+            elif self.path == '/metrics':
+                self.respond(200, METRICS.to_prometheus(), 'text/plain; version=0.0.4')
+            elif self.path == '/metrics.json':
+                self.respond(200, METRICS.to_json())
+            else:
+                self.respond(404, json.dumps({'error': f'Unknown path: {self.path}'}))
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length))
+                if self.path == '/get_reward':
+                    rewards = batcher.submit([request['prompt']], [request['completion']])
+                elif self.path == '/get_rewards':
+                    rewards = batcher.submit(request['prompts'], request['completions'])
+                else:
+                    return self.respond(404, json.dumps({'error': f'Unknown path: {self.path}'}))
+            except (ValueError, KeyError, TypeError) as e:
+                return self.respond(400, json.dumps({'error': repr(e)}))
+            try:
+                rewards = rewards.result()
+            except Exception as e:
+                return self.respond(500, json.dumps({'error': repr(e)}))
+            if self.path == '/get_reward':
+                self.respond(200, json.dumps({'reward': rewards[0]}))
+            else:
+                self.respond(200, json.dumps({'rewards': rewards}))
+
+    return RewardHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+
+def make_server(batcher: RewardBatcher,
+                host: str = '127.0.0.1',
+                port: int = 8765,
+                unix_socket: str = None) -> socketserver.BaseServer:
+    """Build (but do not start) a server for the batcher, on a Unix
+    socket if one is given and otherwise on host:port."""
+    handler = make_handler(batcher)
+    if unix_socket is not None:
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        class UnixHandler(handler):
+            def address_string(self):
+                return unix_socket
+        return ThreadingUnixHTTPServer(unix_socket, UnixHandler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class RewardClient:
+    """
+    Drop-in for RewardModel that asks a reward server. Address is
+    http://host:port or unix:///path/to.sock. Each thread keeps its own
+    keep-alive connection.
+    """
+
+    def __init__(self, address: str, timeout: float = 600.0):
+        self.address = address
+        self.timeout = timeout
+        self.__local = threading.local()
+
+    def connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            parsed = urllib.parse.urlparse(self.address)
+            if parsed.scheme == 'unix':
+                connection = UnixHTTPConnection(parsed.path, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(
+                    parsed.hostname, parsed.port, timeout=self.timeout
+                )
+            self.__local.connection = connection
+        return connection
+
+    def post(self, path: str, body: dict) -> dict:
+        data = json.dumps(body)
+        for attempt in range(2):
+            connection = self.connection()
+            try:
+                connection.request('POST', path, data, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                result = json.loads(response.read())
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # the server may have closed an idle keep-alive connection
+                connection.close()
+                self.__local.connection = None
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise RuntimeError(f'Reward server error ({response.status}): {result.get("error")}')
+        return result
+
+    def get_reward(self, prompt: str, completion: str) -> float:
+        """
+        Given a query, return a reward.
+
+        Args:
+            prompt (str): The user prompt.
+            completion (str): The assistant completion.
+
+        Returns:
+            float: The reward
+        """
+        return self.post('/get_reward', {'prompt': prompt, 'completion': completion})['reward']
+
+    def get_rewards(self, prompts: list[str], completions: list[str]) -> list[float]:
+        """
+        Given a batch of queries and completions, return their rewards.
+
+        Args:
+            prompts (list[str]): The user prompts.
+            completions (list[str]): The assistant completions.
+
+        Returns:
+            list[float]: The rewards, in input order.
+        """
+        return self.post('/get_rewards', {'prompts': prompts, 'completions': completions})['rewards']
+
+
+def main():
+    from registry import build_reward_model, load_config
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix_socket', type=str, default=None)
+    parser.add_argument('--window', type=float, default=0.05, help='Seconds to collect a batch for')
+    parser.add_argument('--max_batch_size', type=int, default=512)
+    parser.add_argument('--config', type=str, default=None, help='JSON backend config (see registry.py); the flags below fill in what it leaves out')
+    parser.add_argument('--top_k', type=int, default=10)
+    parser.add_argument('--max_workers', type=int, default=32)
+    parser.add_argument('--score_cache_path', type=str, default=None)
+    parser.add_argument('--documents_per_prompt', type=int, default=1, help='Documents scored together in one LLM request')
+    parser.add_argument('--prefilter_threshold', type=float, default=None, help='Score documents less similar to the completion than this 0 without an LLM call')
+    parser.add_argument('--index_dir', type=str, default=None, help='Serve from a local corpus index instead of DuckDuckGo')
+    parser.add_argument('--scorer', type=str, default='openai', help='Scorer backend, e.g. openai or constant')
+    parser.add_argument('--warm_up', action='store_true', help='Start the selenium pool before serving')
+    args = parser.parse_args()
+
+    config = load_config(args.config) if args.config else {}
+    if args.index_dir is not None:
+        config.setdefault('querier', {'backend': 'local_corpus', 'index_dir': args.index_dir, 'top_k': args.top_k})
+    config.setdefault('scorer', args.scorer)
+    options = config.setdefault('reward_model', {})
+    options.setdefault('top_k', args.top_k)
+    options.setdefault('max_workers', args.max_workers)
+    options.setdefault('score_cache_path', args.score_cache_path)
+    options.setdefault('documents_per_prompt', args.documents_per_prompt)
+    if args.prefilter_threshold is not None and 'relevance_filter' not in options:
+        from prefilter import RelevanceFilter
+
+        options['relevance_filter'] = RelevanceFilter(args.prefilter_threshold)
+    if args.warm_up and 'querier' not in config:
+        from curler import shared_curler_pool
+
+        shared_curler_pool().warm_up()
+    model = build_reward_model(config)
+    batcher = RewardBatcher(model, window=args.window, max_batch_size=args.max_batch_size)
+    server = make_server(batcher, args.host, args.port, args.unix_socket)
+    print(f'Serving rewards on {args.unix_socket or f"{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+Resumable batch runner for long generation jobs such as revise.py.
+
+Prompts are generated in shards on `generate_threads` threads, so while
+one shard waits (e.g. on rewards requested during generation) another
+is generated. If a separate `score` step is given, scorer threads score
+the finished shards, and a bounded queue keeps generation at most
+`queue_size` shards ahead of them.
+
+Every finished result is appended to a JSONL file and flushed as soon
+as it is done, and prompts already in the file are skipped when the run
+is restarted. Generated results are first saved to a sidecar file next
+to it, so a result whose scoring fails (or is cut short by a crash) is
+rescored on the next run rather than generated again.
+"""
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from metrics import METRICS
+
+_DONE = object()
+
+
+class ConstantRewardModel:
+    """
+    Stand-in for RewardModel in dry runs and tests: every completion
+    gets `reward`, after `latency` seconds.
+    """
+
+    def __init__(self, reward: float = 0.0, latency: float = 0.0):
+        self.reward = reward
+        self.latency = latency
+
+    def get_reward(self, prompt: str, completion: str) -> float:
+        return self.get_rewards([prompt], [completion])[0]
+
+    def get_rewards(self, prompts: list[str], completions: list[str]) -> list[float]:
+        time.sleep(self.latency)
+        return [self.reward] * len(prompts)
+
+
+def read_done(path: str) -> set[str]:
+    """Prompts with a result in the JSONL file. A line cut short by a
+    crash is ignored."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['prompt'])
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue
+    return done
+
+
+def read_results(path: str) -> dict[str, dict]:
+    """Results in the JSONL file by prompt, the last one winning. A line
+    cut short by a crash is ignored."""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                results[result.pop('prompt')] = result
+            except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+                continue
+    return results
+
+
+def open_for_append(path: str):
+    """Open the JSONL file for appending, finishing a line cut short by
+    a crash so the next one parses."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    cut_short = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            cut_short = f.read(1) != b'\n'
+    f = open(path, 'a', encoding='utf-8')
+    if cut_short:
+        f.write('\n')
+    return f
+
+
+class CheckpointedRunner:
+    """
+    Args:
+        output_path (str): JSONL file that results are appended to, one
+            {"prompt": ..., **result} object per line.
+        generate (Callable[[list[str]], list[dict]]): Generates the
+            results for a shard of prompts, in order.
+        score (Callable[[str, dict], dict] | None): Scores the result
+            for a prompt, returning the result to save. None saves
+            generated results as they are.
+        shard_size (int): Prompts generated per call to generate.
+        queue_size (int): Generated shards that may wait for scoring.
+        scorer_threads (int): Threads scoring shards concurrently.
+        generate_threads (int): Shards generated concurrently.
+    """
+
+    def __init__(self,
+                 output_path: str,
+                 generate: Callable[[list[str]], list[dict]],
+                 score: Callable[[str, dict], dict] | None = None,
+                 shard_size: int = 8,
+                 queue_size: int = 4,
+                 scorer_threads: int = 2,
+                 generate_threads: int = 1):
+        self.output_path = output_path
+        self.generate = generate
+        self.score = score
+        self.shard_size = shard_size
+        self.queue_size = queue_size
+        self.scorer_threads = scorer_threads
+        self.generate_threads = generate_threads
+        self.written = 0
+        self.failed = 0
+        self.rescored = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def generated_path(self) -> str:
+        """Sidecar file of generated results that may not be scored yet."""
+        return self.output_path + '.generated'
+
+    def write(self, f, prompt: str, result: dict, count: bool = True):
+        line = json.dumps({'prompt': prompt, **result}) + '\n'
+        with self.__lock:
+            f.write(line)
+            f.flush()
+            if count:
+                self.written += 1
+
+    def __score_shards(self, shards: queue.Queue, f):
+        while True:
+            shard = shards.get()
+            if shard is _DONE:
+                return
+            for prompt, result in shard:
+                try:
+                    with METRICS.span('runner_score'):
+                        result = self.score(prompt, result)
+                except Exception:
+                    # left out of the file, so the next run rescores it
+                    traceback.print_exc()
+                    with self.__lock:
+                        self.failed += 1
+                    continue
+                self.write(f, prompt, result)
+
+    def __generate_shards(self, shards, f, generated, scored: queue.Queue | None):
+        while True:
+            with self.__lock:
+                shard = next(shards, None)
+            if shard is None:
+                return
+            try:
+                with METRICS.span('runner_generate'):
+                    results = self.generate(shard)
+            except BaseException:
+                # the other generators stop after their current shard
+                with self.__lock:
+                    for _ in shards:
+                        pass
+                raise
+            if scored is None:
+                for prompt, result in zip(shard, results):
+                    self.write(f, prompt, result)
+                continue
+            # saved before scoring, so a failed score doesn't lose the generation
+            for prompt, result in zip(shard, results):
+                self.write(generated, prompt, result, count=False)
+            with METRICS.span('runner_queue_wait'):
+                scored.put(list(zip(shard, results)))
+
+    def run(self, prompts: list[str]) -> dict:
+        """
+        Generate and score every prompt that has no result in the
+        output file yet. Prompts generated by an earlier run but not
+        scored are only scored.
+
+        Returns:
+            dict: Counts of skipped, written, rescored and failed prompts.
+        """
+        done = read_done(self.output_path)
+        generated = {} if self.score is None else read_results(self.generated_path)
+        todo = [prompt for prompt in dict.fromkeys(prompts) if prompt not in done]
+        rescore = [(prompt, generated[prompt]) for prompt in todo if prompt in generated]
+        todo = [prompt for prompt in todo if prompt not in generated]
+        print(f'{len(done)} prompts already done, {len(rescore)} to rescore, {len(todo)} to generate')
+        self.written = self.failed = 0
+        self.rescored = len(rescore)
+
+        shards = iter([todo[start:start + self.shard_size] for start in range(0, len(todo), self.shard_size)])
+        with open_for_append(self.output_path) as f:
+            scored, scorers, generated_file = None, [], None
+            if self.score is not None:
+                generated_file = open_for_append(self.generated_path)
+                scored = queue.Queue(maxsize=self.queue_size)
+                scorers = [
+                    threading.Thread(target=self.__score_shards, args=(scored, f), name=f'runner-score-{i}', daemon=True)
+                    for i in range(self.scorer_threads)
+                ]
+                for scorer in scorers:
+                    scorer.start()
+            try:
+                for start in range(0, len(rescore), self.shard_size):
+                    scored.put(rescore[start:start + self.shard_size])
+                with ThreadPoolExecutor(self.generate_threads, thread_name_prefix='runner-generate') as pool:
+                    generators = [
+                        pool.submit(self.__generate_shards, shards, f, generated_file, scored)
+                        for _ in range(self.generate_threads)
+                    ]
+                    for generator in generators:
+                        generator.result()
+            finally:
+                for _ in scorers:
+                    scored.put(_DONE)
+                for scorer in scorers:
+                    scorer.join()
+                if generated_file is not None:
+                    generated_file.close()
+        if self.score is not None and not self.failed:
+            # every generated result is scored, so the sidecar can go
+            finished = read_done(self.output_path)
+            if all(prompt in finished for prompt in read_results(self.generated_path)):
+                os.remove(self.generated_path)
+        return {'skipped': len(done), 'written': self.written, 'rescored': self.rescored, 'failed': self.failed}
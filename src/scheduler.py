@@ -0,0 +1,360 @@
+"""
+Host-aware scheduling for every outbound request: DuckDuckGo,
+Wikipedia, StackExchange and the LLM API.
+
+Each destination host gets a token bucket (requests per second, with
+bursts) and a cap on concurrent requests. Both are shared by threads
+and by asyncio code, and a freed slot is handed straight to the next
+waiter, whether it is a thread or a coroutine. Failed calls are retried with exponential backoff
+and full jitter, and a throttled response (429) pauses the whole host
+rather than only the caller that saw it. Concurrent requests for the
+same key (a URL, a query, a prompt) are coalesced into one in-flight
+call whose result they all share.
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+from metrics import METRICS
+from shared import process_wide
+
+
+class HostPolicy:
+    """
+    Limits for one destination: `rate` requests per second (None for no
+    limit) with bursts of up to `burst`, and at most `max_concurrency`
+    requests in flight.
+    """
+
+    def __init__(self, rate: float | None = 10.0, burst: int = 20, max_concurrency: int = 8):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+
+
+# conservative starting points; override with Scheduler.set_policy
+DEFAULT_POLICIES = {
+    'duckduckgo.com': HostPolicy(rate=1.0, burst=3, max_concurrency=2),
+    'html.duckduckgo.com': HostPolicy(rate=1.0, burst=3, max_concurrency=2),
+    'en.wikipedia.org': HostPolicy(rate=20.0, burst=40, max_concurrency=8),
+    'stackoverflow.com': HostPolicy(rate=5.0, burst=10, max_concurrency=4),
+    'api.openai.com': HostPolicy(rate=50.0, burst=50, max_concurrency=32),
+}
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations instead of blocking, so the
+    same bucket can be waited on with time.sleep or asyncio.sleep. The
+    token count may go negative: each reservation queues behind the
+    ones before it.
+    """
+
+    def __init__(self, rate: float | None, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = float(burst)
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def reserve(self) -> float:
+        """Take a token.
+
+        Returns:
+            float: Seconds to wait before using it."""
+        if self.rate is None:
+            return 0.0
+        with self.__lock:
+            self.__refill()
+            self.__tokens -= 1
+            return max(-self.__tokens / self.rate, 0.0)
+
+    def pause(self, seconds: float):
+        """Hold back every reservation for the next `seconds`."""
+        if self.rate is None:
+            return
+        with self.__lock:
+            self.__refill()
+            self.__tokens = min(self.__tokens, 0.0) - seconds * self.rate
+
+
+class ConcurrencyLimit:
+    """
+    Semaphore for threads and coroutines alike. Waiters queue in
+    arrival order and release hands the slot straight to the first of
+    them: a thread is woken through its event, a coroutine through its
+    event loop, so nobody polls.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.__in_use = 0
+        # (None, threading.Event) for threads, (loop, asyncio.Future) for coroutines
+        self.__waiters = deque()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a slot is free, and take it."""
+        with self.__lock:
+            if self.__in_use < self.limit and not self.__waiters:
+                self.__in_use += 1
+                return
+            event = threading.Event()
+            self.__waiters.append((None, event))
+        event.wait()
+
+    async def aacquire(self):
+        """acquire for asyncio code."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        with self.__lock:
+            if self.__in_use < self.limit and not self.__waiters:
+                self.__in_use += 1
+                return
+            future = loop.create_future()
+            self.__waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.__lock:
+                waiting = (loop, future) in self.__waiters
+                if waiting:
+                    self.__waiters.remove((loop, future))
+            # a slot handed to a cancelled future is passed on by __wake
+            if not waiting and not future.cancelled():
+                self.release()
+            raise
+
+    def __wake(self, future):
+        # runs on the waiter's event loop
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        """Free a slot, handing it to the first waiter if there is one."""
+        with self.__lock:
+            if not self.__waiters:
+                if self.__in_use == 0:
+                    raise ValueError('ConcurrencyLimit released too many times')
+                self.__in_use -= 1
+                return
+            loop, waiter = self.__waiters.popleft()
+        if loop is None:
+            waiter.set()
+            return
+        try:
+            loop.call_soon_threadsafe(self.__wake, waiter)
+        except RuntimeError:
+            # the waiter's loop is closed, so pass the slot on
+            self.release()
+
+
+def retry_after(value: str | None) -> float | None:
+    """Seconds to wait according to a Retry-After header, if it has any."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class Scheduler:
+    """
+    Rate limits, concurrency caps, retries and request coalescing per
+    destination host. Destinations are URLs or bare host names; hosts
+    without a policy of their own use their parent domain's, and
+    otherwise `default_policy`.
+    """
+
+    def __init__(self,
+                 policies: dict[str, HostPolicy] = None,
+                 default_policy: HostPolicy = None,
+                 retries: int = 2,
+                 backoff: float = 0.5,
+                 max_backoff: float = 30.0):
+        self.policies = dict(DEFAULT_POLICIES if policies is None else policies)
+        self.default_policy = default_policy or HostPolicy()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.__limits = {}
+        self.__flights = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def host(destination: str) -> str:
+        return urlparse(destination).netloc if '//' in destination else destination
+
+    def policy(self, host: str) -> HostPolicy:
+        parts = host.split('.')
+        for i in range(max(len(parts) - 1, 1)):
+            policy = self.policies.get('.'.join(parts[i:]))
+            if policy is not None:
+                return policy
+        return self.default_policy
+
+    def set_policy(self, host: str, policy: HostPolicy):
+        """Replace the limits of the host (and of its subdomains without
+        a policy of their own)."""
+        with self.__lock:
+            self.policies[host] = policy
+            self.__limits = {}
+
+    def limits(self, destination: str) -> tuple[str, TokenBucket, ConcurrencyLimit]:
+        host = self.host(destination)
+        with self.__lock:
+            limits = self.__limits.get(host)
+            if limits is None:
+                policy = self.policy(host)
+                limits = self.__limits[host] = (
+                    TokenBucket(policy.rate, policy.burst),
+                    ConcurrencyLimit(policy.max_concurrency),
+                )
+        return (host, *limits)
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given retry."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def throttled(self, destination: str, seconds: float = None):
+        """Report that the destination throttled us, pausing every
+        request to it for `seconds` (by default the base backoff)."""
+        host, bucket, _ = self.limits(destination)
+        METRICS.inc('throttled_total', host=host)
+        bucket.pause(self.backoff if seconds is None else seconds)
+
+    @contextmanager
+    def slot(self, destination: str):
+        """Wait for the destination's rate limit and a free concurrency
+        slot, holding the slot for the body of the with statement."""
+        host, bucket, concurrency = self.limits(destination)
+        with METRICS.span('rate_limit_wait', host=host):
+            delay = bucket.reserve()
+            if delay:
+                time.sleep(delay)
+            concurrency.acquire()
+        try:
+            yield
+        finally:
+            concurrency.release()
+
+    @asynccontextmanager
+    async def aslot(self, destination: str):
+        """slot for asyncio code, sharing the same limits without
+        blocking the event loop."""
+        import asyncio
+
+        host, bucket, concurrency = self.limits(destination)
+        with METRICS.span('rate_limit_wait', host=host):
+            delay = bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            await concurrency.aacquire()
+        try:
+            yield
+        finally:
+            concurrency.release()
+
+    def call(self,
+             destination: str,
+             fn: Callable[[], object],
+             retry_on: Callable[[Exception], bool] = lambda e: False,
+             retries: int = None):
+        """
+        Call fn within a slot for the destination, retrying with backoff
+        on the errors retry_on accepts.
+
+        Args:
+            destination (str): URL or host that fn sends a request to.
+            fn (Callable[[], object]): The request.
+            retry_on (Callable[[Exception], bool]): Whether an error is
+                worth retrying.
+            retries (int): Retries after the first attempt; defaults to
+                self.retries.
+
+        Returns:
+            object: What fn returned.
+        """
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                with self.slot(destination):
+                    return fn()
+            except Exception as e:
+                if attempt == retries or not retry_on(e):
+                    raise
+            METRICS.inc('retries_total', host=self.host(destination))
+            time.sleep(self.backoff_delay(attempt))
+
+    def __join(self, key) -> tuple[Future, bool]:
+        with self.__lock:
+            future = self.__flights.get(key)
+            if future is not None:
+                METRICS.inc('coalesced_requests_total')
+                return future, False
+            future = self.__flights[key] = Future()
+            return future, True
+
+    def __land(self, key, future: Future, result=None, error: BaseException = None):
+        with self.__lock:
+            del self.__flights[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def coalesce(self, key, fn: Callable[[], object]):
+        """Call fn, unless a call for the same key is already in flight,
+        in which case wait for and share its result."""
+        future, leader = self.__join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.__land(key, future, error=e)
+            raise
+        self.__land(key, future, result)
+        return result
+
+    async def acoalesce(self, key, fn: Callable[[], Awaitable]):
+        """coalesce for asyncio code. Calls in flight are shared with
+        threads and other event loops too."""
+        import asyncio
+
+        future, leader = self.__join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.__land(key, future, error=e)
+            raise
+        self.__land(key, future, result)
+        return result
+
+
+@process_wide
+def shared_scheduler() -> Scheduler:
+    """The process-wide Scheduler, created on first use."""
+    return Scheduler()
@@ -0,0 +1,30 @@
+"""
+Process-wide instances shared by every caller in the process: the
+scheduler, caches, curler pools and document store.
+"""
+import functools
+import threading
+from typing import Callable, TypeVar
+
+T = TypeVar('T')
+
+
+def process_wide(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    Decorator turning a factory into a getter of one shared instance,
+    created by the first call and returned by every later one. The
+    factory runs under a lock, so concurrent first calls create it once;
+    it may register the instance's cleanup with atexit.
+    """
+    instance = None
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get() -> T:
+        nonlocal instance
+        with lock:
+            if instance is None:
+                instance = factory()
+        return instance
+
+    return get
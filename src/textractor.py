@@ -1,24 +1,72 @@
 import pprint as pp
-import re, requests
+import re
+from typing import TYPE_CHECKING
 
-from bs4 import BeautifulSoup
-import requests
+from cache import DocumentCache, shared_document_cache
+from metrics import METRICS
 
-from curler import SeleniumCurler
+# curlers and parsers are imported when first used, so extracting saved
+# pages needs neither a browser nor bs4
+if TYPE_CHECKING:
+    from curler import Curler
 
 
 class Textractor:
-    """Base class for text extraction from url."""
+    """Base class for text extraction from url.
 
-    def __init__(self):
-        self.__curler = None
+    Extracted text is cached on disk per url. Bump `version` whenever a
+    subclass's textract output changes so stale entries are not reused.
+    """
+
+    version = 1
+
+    def __init__(self,
+                 curler: 'Curler' = None,
+                 cache: DocumentCache = None,
+                 use_cache: bool = True):
+        self.__curler = curler
+        self.__cache = cache
+        self.use_cache = use_cache
 
     @property
     def curler(self):
         if self.__curler is None:
-            self.__curler = SeleniumCurler()
+            self.__curler = self.default_curler()
         return self.__curler
+
+    def default_curler(self) -> 'Curler':
+        """Curler used when none is passed in. Pages are loaded in the
+        shared selenium pool unless a subclass needs something else."""
+        from curler import shared_curler_pool
+
+        return shared_curler_pool()
     
+    @property
+    def cache(self) -> DocumentCache | None:
+        if not self.use_cache:
+            return None
+        if self.__cache is None:
+            self.__cache = shared_document_cache()
+        return self.__cache
+
+    @property
+    def cache_version(self) -> str:
+        return f'{type(self).__name__}-{self.version}'
+
+    def lookup(self, url: str) -> str | None:
+        """Return the cached text for the url, or None on a miss."""
+        if self.cache is None:
+            return None
+        return self.cache.get_document(url, self.cache_version)
+
+    def extract(self, url: str, page_source: str) -> str:
+        """Extract text from the page source fetched from url, and cache it."""
+        with METRICS.span('extract', extractor=type(self).__name__):
+            text = self.textract(page_source)
+        if self.cache is not None:
+            self.cache.put_document(url, self.cache_version, text)
+        return text
+
     def urlget(self, url: str):
         """Wrapper around curler urlget."""
         return self.curler.urlget(url)
@@ -43,20 +91,36 @@ class Textractor:
         Returns:
             str: The extracted text.
         """
+        text = self.lookup(url)
+        if text is not None:
+            return text
         page_source = self.urlget(url)
-        return self.textract(page_source)
+        return self.extract(url, page_source)
     
 
 class WikipediaTextractor(Textractor):
     """Textractor for wikipedia"""
-    def urlget(self, url: str):
-        """Wrapper around requests urlget."""
-        return requests.get(url).text
+    def default_curler(self) -> 'Curler':
+        """Wikipedia renders without javascript, so fetch over plain HTTP."""
+        from curler import shared_async_http_curler
+
+        return shared_async_http_curler()
     
     def textract(self, page_source: str) -> str:
+        from fast_textract import wikipedia_text
+
+        return wikipedia_text(page_source)
+
+    def textract_soup(self, page_source: str) -> str:
+        """Reference BeautifulSoup implementation of textract. Slower, but
+        kept to check the fast extractor against."""
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(page_source, 'html.parser')
         main_content = soup.select_one('div#mw-content-text > div.mw-parser-output')
-        main_content.select_one('div.reflist').extract()
+        reflist = main_content.select_one('div.reflist')
+        if reflist is not None:
+            reflist.extract()
         for ref in main_content.select('sup.reference'):
             ref.extract()
         for table in main_content.select('table'):
@@ -73,21 +137,46 @@ class WikipediaTextractor(Textractor):
             hatnote.decompose()
         ## remove all text after See also header
         # get see also element
-        see_also_element = main_content.find('span', id='See_also').find_parent('h2')
-        for element in see_also_element.find_next_siblings():
-            element.decompose()
-        see_also_element.decompose()
+        see_also_element = self.see_also_heading(main_content)
+        if see_also_element is not None:
+            for element in see_also_element.find_next_siblings():
+                element.decompose()
+            see_also_element.decompose()
         # extract text
         text = main_content.get_text()
         # remove consecutive newlines
         text = re.sub(r'\n+', '\n', text)
         return text
+
+    @staticmethod
+    def see_also_heading(main_content):
+        """The See also heading, from older (span#See_also inside the h2)
+        or newer (h2#See_also inside div.mw-heading) markup, or None."""
+        span = main_content.find('span', id='See_also')
+        if span is not None:
+            return span.find_parent('h2')
+        h2 = main_content.find('h2', id='See_also')
+        if h2 is None:
+            return None
+        parent = h2.parent
+        if parent is not main_content and parent.name == 'div' and 'mw-heading' in parent.get('class', []):
+            return parent
+        return h2
     
 
 class StackExchangeTextractor(Textractor):
     """Textractor for stackexchange.com."""
 
     def textract(self, page_source: str) -> str:
+        from fast_textract import stackexchange_text
+
+        return stackexchange_text(page_source)
+
+    def textract_soup(self, page_source: str) -> str:
+        """Reference BeautifulSoup implementation of textract. Slower, but
+        kept to check the fast extractor against."""
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(page_source, 'html.parser')
         text = []
         # get title
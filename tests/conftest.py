@@ -0,0 +1,27 @@
+import os
+import sys
+
+# the modules in src/ import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import pytest  # noqa: E402
+
+import registry  # noqa: E402
+from textractor import Textractor  # noqa: E402
+
+
+class FakeTextractor(Textractor):
+    """Extractor for '<html>...' pages, failing on those containing
+    'broken'."""
+
+    def textract(self, page_source: str) -> str:
+        if 'broken' in page_source:
+            raise ValueError('no main content')
+        return page_source.removeprefix('<html>').removesuffix('</html>')
+
+
+@pytest.fixture
+def fake_extractor(monkeypatch):
+    """Extract example.org pages with FakeTextractor."""
+    monkeypatch.setitem(registry.BACKENDS['extractor'], 'fake', FakeTextractor)
+    monkeypatch.setattr(registry, 'EXTRACTOR_DOMAINS', {'example.org': 'fake'})
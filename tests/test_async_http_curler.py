@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from curler import AsyncHTTPCurler
+from scheduler import HostPolicy, Scheduler
+
+
+class Handler(BaseHTTPRequestHandler):
+    """/page?id=<id>&delay=<seconds> answers with the id after the
+    delay, /flaky answers 503 to its first request and /hang never
+    answers in time."""
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with server.lock:
+            server.hits[url.path] = server.hits.get(url.path, 0) + 1
+            hits = server.hits[url.path]
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if url.path == '/flaky' and hits == 1:
+                self.send_error(503)
+                return
+            time.sleep(float(query.get('delay', 0)) if url.path != '/hang' else 2.0)
+            body = f'<html>{query.get("id", url.path)}</html>'.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.hits = {}
+    server.active = 0
+    server.max_active = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def curler():
+    scheduler = Scheduler(policies={}, default_policy=HostPolicy(rate=None, max_concurrency=8), backoff=0.01)
+    curler = AsyncHTTPCurler(timeout=0.5, retries=1, scheduler=scheduler)
+    yield curler
+    curler.close()
+
+
+def base_url(server) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def test_fetches_concurrently_in_rank_order(server, curler):
+    # the first url is the slowest, so completion order is the reverse of rank order
+    urls = [f'{base_url(server)}/page?id={i}&delay={0.3 - 0.05 * i}' for i in range(4)]
+    start = time.monotonic()
+    pages = curler.map(urls)
+    elapsed = time.monotonic() - start
+    assert pages == [f'<html>{i}</html>' for i in range(4)]
+    assert server.max_active == 4
+    assert elapsed < 0.6
+
+
+def test_submit_resolves_to_page_source(server, curler):
+    future = curler.submit(f'{base_url(server)}/page?id=a')
+    assert future.result(timeout=5) == '<html>a</html>'
+
+
+def test_retries_503(server, curler):
+    assert curler.urlget(f'{base_url(server)}/flaky') == '<html>/flaky</html>'
+    assert server.hits['/flaky'] == 2
+
+
+def test_timeout(server, curler):
+    with pytest.raises(asyncio.TimeoutError):
+        curler.urlget(f'{base_url(server)}/hang')
+    # the timeout is retried before giving up
+    assert server.hits['/hang'] == 2
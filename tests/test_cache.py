@@ -0,0 +1,85 @@
+from cache import DiskCache, ScoreCache
+
+
+def stored_bytes(cache: DiskCache) -> int:
+    return cache.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+
+def test_total_bytes_tracks_puts_replacements_and_evictions(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache.sqlite'), max_bytes=25)
+    cache.put('a', 'x' * 10)
+    cache.put('b', 'x' * 10)
+    assert cache.total_bytes == stored_bytes(cache) == 20
+    cache.put('a', 'x' * 5)
+    assert cache.total_bytes == stored_bytes(cache) == 15
+    # b is now the least recently used entry
+    cache.put('c', 'x' * 15)
+    assert cache.get('b') is None
+    assert cache.total_bytes == stored_bytes(cache) == 20
+    cache.ttl = -1
+    cache.delete_expired()
+    assert len(cache) == 0
+    assert cache.total_bytes == 0
+
+
+def test_eviction_goes_down_to_the_low_water_mark(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache.sqlite'), max_bytes=100, evict_to=0.5)
+    for i in range(10):
+        cache.put(str(i), 'x' * 10)
+    assert len(cache) == 10
+    cache.put('10', 'x' * 10)
+    # evicted down to 50 bytes, keeping the most recent entries
+    assert cache.total_bytes == 50
+    assert [cache.get(str(i)) is not None for i in range(11)] == [False] * 6 + [True] * 5
+    # so the next 5 puts fit without evicting
+    for i in range(11, 16):
+        cache.put(str(i), 'x' * 10)
+    assert len(cache) == 10
+
+
+def test_get_only_touches_stale_access_times(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache.sqlite'), touch_interval=60)
+
+    def accessed(key):
+        return cache.connection.execute('SELECT accessed FROM entries WHERE key = ?', (key,)).fetchone()[0]
+
+    cache.put('a', 'value')
+    before = accessed('a')
+    assert cache.get('a') == 'value'
+    assert accessed('a') == before
+    cache.connection.execute('UPDATE entries SET accessed = accessed - 120')
+    cache.connection.commit()
+    assert cache.get('a') == 'value'
+    assert accessed('a') > before - 120
+
+
+def test_score_cache_keys():
+    key = ScoreCache.key(2, 'prompt', 'completion', 'document')
+    assert key == ScoreCache.key('2', 'prompt', 'completion', 'document')
+    # parts are separated, so moving text between them changes the key
+    assert key != ScoreCache.key(2, 'prompt', 'completiondocument', '')
+    assert key != ScoreCache.key(3, 'prompt', 'completion', 'document')
+
+
+def test_score_cache_evicts_least_recently_used():
+    cache = ScoreCache(max_entries=2)
+    cache.put('a', 1.0)
+    cache.put('b', -1.0)
+    assert cache.get('a') == 1.0
+    cache.put('c', 0.5)
+    assert cache.get('b') is None
+    assert cache.get('c') == 0.5
+    # a negative or zero score is a hit, not a miss
+    cache.put('d', 0.0)
+    assert cache.get('d') == 0.0
+    assert cache.stats() == {'hits': 3, 'misses': 1, 'entries': 2}
+
+
+def test_score_cache_spills_to_disk(tmp_path):
+    path = str(tmp_path / 'scores.sqlite')
+    ScoreCache(path=path).put('a', -0.5)
+    # another process, or a restart, reads it back from disk
+    cache = ScoreCache(max_entries=0, path=path)
+    assert cache.get('a') == -0.5
+    assert cache.get('b') is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'entries': 0}
@@ -0,0 +1,100 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from curler import Curler, HTTPCurler, SeleniumCurler
+from ddg_querier import iter_documents
+
+
+class SlowCurler(Curler):
+    """Curler with only a blocking urlget, like HTTPCurler and
+    SeleniumCurler, whose urls containing 404 fail."""
+
+    def __init__(self, delay: float = 0.1):
+        super().__init__()
+        self.delay = delay
+        self.threads = set()
+
+    def urlget(self, url: str) -> str:
+        self.threads.add(threading.get_ident())
+        time.sleep(self.delay)
+        if '404' in url:
+            raise RuntimeError(f'404 Not Found: {url}')
+        return f'<html>{url}</html>'
+
+
+def test_submit_runs_urlget_concurrently():
+    curler = SlowCurler()
+    urls = [f'https://example.org/{i}' for i in range(8)]
+    start = time.monotonic()
+    assert curler.map(urls) == [f'<html>{url}</html>' for url in urls]
+    assert time.monotonic() - start < 0.5
+    assert len(curler.threads) > 1
+    with pytest.raises(RuntimeError, match='404'):
+        curler.submit('https://example.org/404').result()
+
+
+def test_page_curlers_work_with_iter_documents(fake_extractor):
+    links = ['https://example.org/a', 'https://example.org/404', 'https://example.org/b']
+    documents = dict(iter_documents(links, curler=SlowCurler(), use_cache=False))
+    assert documents == {
+        'https://example.org/a': 'https://example.org/a',
+        'https://example.org/b': 'https://example.org/b',
+    }
+
+
+def test_http_curler_has_submit():
+    # HTTPCurler only implements urlget, and gets submit from Curler
+    assert HTTPCurler.submit is Curler.submit
+
+
+class FakeDriver:
+    """Webdriver stand-in that shows one page at a time, and takes a
+    moment to load it."""
+
+    def __init__(self):
+        self.url = None
+
+    def get(self, url: str):
+        self.url = url
+        time.sleep(0.01)
+
+    def execute_script(self, script: str):
+        return 'complete'
+
+    @property
+    def page_source(self) -> str:
+        return f'<html>{self.url}</html>'
+
+
+class FakeSeleniumCurler(SeleniumCurler):
+    def __init__(self):
+        super().__init__()
+        self.driver = FakeDriver()
+
+    @property
+    def selenium_webdriver(self):
+        return self.driver
+
+
+def test_selenium_curler_loads_one_page_at_a_time():
+    curler = FakeSeleniumCurler()
+    urls = [f'https://example.org/{i}' for i in range(8)]
+    results = {}
+
+    def load(i):
+        results[i] = curler.map(urls[i::2])
+
+    threads = [threading.Thread(target=load, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in range(2):
+        assert results[i] == [f'<html>{url}</html>' for url in urls[i::2]]
+    # urlget called directly from several threads is serialized too
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(executor.map(curler.urlget, urls)) == [f'<html>{url}</html>' for url in urls]
+    assert curler.pages_loaded == 16
@@ -0,0 +1,63 @@
+import pytest
+
+from curler import CurlerPool
+
+
+class FakeCurler:
+    """SeleniumCurler stand-in whose next `failed_starts` webdriver
+    starts raise."""
+
+    def __init__(self):
+        self.pages_loaded = 0
+        self.failed_starts = 0
+        self.running = True
+
+    @property
+    def is_running(self) -> bool:
+        return self.running
+
+    @property
+    def selenium_webdriver(self):
+        if self.failed_starts:
+            self.failed_starts -= 1
+            raise RuntimeError('chrome failed to start')
+        self.running = True
+        self.pages_loaded = 0
+        return self
+
+    def delete_webdriver(self):
+        self.running = False
+
+    def memory_usage_mb(self) -> float:
+        return 0.0
+
+    def urlget(self, url, buttons=(), ready_condition=None) -> str:
+        if not self.running:
+            self.selenium_webdriver
+        self.pages_loaded += 1
+        return f'<html>{url}</html>'
+
+
+def test_failed_restart_returns_curler_to_pool():
+    curler = FakeCurler()
+    pool = CurlerPool(size=1, max_pages=1, curler_factory=lambda: curler, acquire_timeout=5)
+    try:
+        # the restart after this page fails, which must not lose the curler
+        curler.failed_starts = 1
+        curler.pages_loaded = 1
+        assert pool.urlget('http://a') == '<html>http://a</html>'
+        assert pool.urlget('http://b') == '<html>http://b</html>'
+        assert curler.is_running
+    finally:
+        pool.close()
+
+
+def test_acquire_timeout():
+    pool = CurlerPool(size=1, curler_factory=FakeCurler, acquire_timeout=0.05)
+    try:
+        curler = pool._CurlerPool__free.get()
+        with pytest.raises(RuntimeError, match='No free curler'):
+            pool.urlget('http://a')
+        pool._CurlerPool__free.put(curler)
+    finally:
+        pool.close()
@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+from ddg_querier import DDGQuerier, NoResultsError, SearchCache
+from scheduler import Scheduler
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'serp')
+
+
+def read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def test_html_results_skip_ads_and_unwrap_redirects():
+    links = DDGQuerier(top_k=5).get_links_from_ddg_html_source(read_fixture('ddg_html_python.html'))
+    assert links == [
+        'https://en.wikipedia.org/wiki/List_comprehension',
+        'https://stackoverflow.com/questions/34835951/what-does-list-comprehension-mean-how-does-it-work-and-how-can-i-use-it',
+        'https://en.wikipedia.org/wiki/Python_syntax_and_semantics',
+    ]
+
+
+def test_html_results_respect_top_k():
+    links = DDGQuerier(top_k=1).get_links_from_ddg_html_source(read_fixture('ddg_html_python.html'))
+    assert links == ['https://en.wikipedia.org/wiki/List_comprehension']
+
+
+def test_html_results_without_results():
+    with pytest.raises(RuntimeError, match='no HTML results'):
+        DDGQuerier(top_k=5).get_links_from_ddg_html_source(
+            '<html><body><div class="no-results">No results.</div></body></html>')
+
+
+@pytest.mark.parametrize('href, url', [
+    ('//duckduckgo.com/l/?uddg=https%3A%2F%2Fen.wikipedia.org%2Fwiki%2FA%26B&rut=abc', 'https://en.wikipedia.org/wiki/A&B'),
+    ('https://duckduckgo.com/l/?uddg=https%3A%2F%2Fstackoverflow.com%2Fq%2F1', 'https://stackoverflow.com/q/1'),
+    ('https://en.wikipedia.org/wiki/Python', 'https://en.wikipedia.org/wiki/Python'),
+    ('//duckduckgo.com/l/?rut=abc', '//duckduckgo.com/l/?rut=abc'),
+])
+def test_unwrap_ddg_redirect(href, url):
+    assert DDGQuerier.unwrap_ddg_redirect(href) == url
+
+
+def js_serp(n_results: int) -> str:
+    results = ''.join(
+        f'<li data-layout="organic"><a data-testid="result-title-a" href="https://example.org/{i}">{i}</a></li>'
+        for i in range(n_results)
+    )
+    ad = '<li data-layout="ad"><a data-testid="result-title-a" href="https://ads.example/">ad</a></li>'
+    return f'<html><body><ul><li>nav</li></ul><ol class="react-results--main">{ad}{results}</ol></body></html>'
+
+
+def test_js_results_shorter_than_top_k_are_results():
+    querier = DDGQuerier(top_k=5)
+    assert querier.get_links_from_ddg_source(js_serp(2)) == ['https://example.org/0', 'https://example.org/1']
+    assert querier.get_links_from_ddg_source(js_serp(8)) == [f'https://example.org/{i}' for i in range(5)]
+    with pytest.raises(NoResultsError, match='no LIs'):
+        querier.get_links_from_ddg_source(js_serp(0))
+    with pytest.raises(NoResultsError, match='no OL'):
+        querier.get_links_from_ddg_source('<html><body></body></html>')
+
+
+def test_search_cache_normalizes_queries():
+    key = SearchCache.key('Python  Lists', True, 10)
+    assert SearchCache.key('python lists site:wikipedia.org OR site:stackoverflow.com', True, 10) == key
+    assert SearchCache.key(' PYTHON lists\n', True, 10) == key
+    assert SearchCache.key('python lists', False, 10) != key
+    assert SearchCache.key('python lists', True, 5) != key
+
+
+def test_search_cache_expires_and_evicts():
+    cache = SearchCache(max_entries=2, negative_ttl=-1)
+    cache.put('a', ['https://example.org/a'])
+    cache.put_error('b', 'No results found (no OL)')
+    assert cache.get('a') == (['https://example.org/a'], None)
+    # negative entries expire after negative_ttl
+    assert cache.get('b') is None
+    cache.put('c', [])
+    cache.put('d', [])
+    # a was the least recently used
+    assert cache.get('a') is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'entries': 2}
+
+
+class ScriptedQuerier(DDGQuerier):
+    """DDGQuerier whose searches find the results given for each site
+    searched, and fail for queries containing 'flaky'."""
+
+    def __init__(self, results: dict, **kwargs):
+        super().__init__(search_cache=SearchCache(), scheduler=Scheduler(policies={}), **kwargs)
+        self.results = results
+        self.searches = []
+
+    def search(self, query: str) -> list[str]:
+        self.searches.append(query)
+        if 'flaky' in query:
+            raise ConnectionError('search failed')
+        links = [link for site, links in self.results.items() if site in query for link in links]
+        if not links:
+            raise NoResultsError('No results found (no HTML results)')
+        return links
+
+
+def test_only_searches_without_results_are_cached():
+    querier = ScriptedQuerier({'wikipedia': ['https://en.wikipedia.org/wiki/Python']})
+    assert querier('python') == ['https://en.wikipedia.org/wiki/Python']
+    assert querier('  Python ') == ['https://en.wikipedia.org/wiki/Python']
+    assert len(querier.searches) == 1
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            querier('flaky python')
+    # failures are searched again
+    assert len(querier.searches) == 3
+
+    querier = ScriptedQuerier({})
+    for _ in range(2):
+        with pytest.raises(NoResultsError):
+            querier('nothing')
+    # no results is cached
+    assert len(querier.searches) == 1
+
+
+def test_one_site_without_results_is_not_a_failure():
+    querier = ScriptedQuerier({'stackoverflow': ['https://stackoverflow.com/q/1']}, ensemble_results=False)
+    assert querier('python') == ['https://stackoverflow.com/q/1']
+    assert querier('python') == ['https://stackoverflow.com/q/1']
+    assert len(querier.searches) == 2
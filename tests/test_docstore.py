@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+
+from docstore import DocumentStore
+
+ARTICLE = ' '.join(
+    f'Sentence {i} of the article says something about rivers, mountains and the sea.' for i in range(40)
+)
+
+
+def test_compressed_round_trip():
+    store = DocumentStore()
+    ref = store.put(ARTICLE)
+    assert ref.text == str(ref) == ARTICLE
+    assert len(ref) == len(ARTICLE)
+    assert len(ref.blob) < len(ARTICLE) / 4
+    assert store.get(ref.digest) is ref
+    assert store.put(ARTICLE) is ref
+    assert store.stats()['duplicates'] == 1
+    assert store.stats()['compression_ratio'] > 4
+
+
+def test_near_duplicates_collapse():
+    store = DocumentStore()
+    original = store.put(ARTICLE)
+    # a mirror with one word changed
+    mirror = store.put(ARTICLE.replace('Sentence 7 ', 'Line 7 '))
+    other = store.put(' '.join(f'Paragraph {i} is about databases and indexes.' for i in range(40)))
+    assert mirror.digest != original.digest
+    assert mirror.canonical == original.digest
+    assert other.canonical == other.digest
+    assert store.near_duplicates == 1
+    assert store.unique([ARTICLE, ARTICLE.replace('Sentence 7 ', 'Line 7 '), str(other)]) == [original, other]
+
+
+def test_signatures_are_the_same_in_every_process():
+    script = (
+        'import sys; sys.path.insert(0, sys.argv[1]); from docstore import DocumentStore; '
+        'print(DocumentStore().signature(sys.argv[2]).tolist())'
+    )
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    signatures = {
+        subprocess.run(
+            [sys.executable, '-c', script, src, ARTICLE[:500]],
+            env={**os.environ, 'PYTHONHASHSEED': seed}, capture_output=True, text=True, check=True,
+        ).stdout
+        for seed in ('1', '2')
+    }
+    assert len(signatures) == 1
+    assert signatures == {str(DocumentStore().signature(ARTICLE[:500]).tolist()) + '\n'}
+
+
+def test_store_is_bounded_by_compressed_bytes():
+    documents = [f'document {i} ' + os.urandom(500).hex() for i in range(10)]
+    store = DocumentStore(max_bytes=3000)
+    refs = [store.put(document) for document in documents]
+    assert 0 < store.stored_bytes <= 3000
+    assert len(store) < len(documents)
+    assert store.get(refs[0].digest) is None
+    assert store.get(refs[-1].digest) is refs[-1]
+    # refs handed out stay readable after eviction
+    assert refs[0].text == documents[0]
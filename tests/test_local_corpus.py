@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from local_corpus import (
+    POSTINGS_FILES, LocalCorpusQuerier, TermTable, build_index, decode_varints, encode_varints,
+)
+
+DOCUMENTS = [
+    ('https://en.wikipedia.org/wiki/River', 'A river is a natural flowing watercourse. Rivers flow to the sea.'),
+    ('https://en.wikipedia.org/wiki/Mountain', 'A mountain is an elevated portion of the crust.'),
+    ('https://stackoverflow.com/questions/1', 'How do I reverse a list in Python? Use reversed or a slice.'),
+    ('https://en.wikipedia.org/wiki/Python', 'Python is a programming language. Python lists are mutable.'),
+    ('https://stackoverflow.com/questions/2', 'Why does my river simulation in Python run slowly?'),
+    ('https://en.wikipedia.org/wiki/Caf%C3%A9', 'A café serves coffee; a naïve café still serves coffee.'),
+]
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    path = tmp_path / 'corpus.jsonl'
+    with open(path, 'w', encoding='utf-8') as f:
+        for url, text in DOCUMENTS:
+            f.write(json.dumps({'url': url, 'text': text}) + '\n')
+    return str(path)
+
+
+def test_blocked_build_matches_single_block(corpus, tmp_path):
+    single, blocked = str(tmp_path / 'single'), str(tmp_path / 'blocked')
+    build_index([corpus], single)
+    build_index([corpus], blocked, block_postings=5)
+    for name in POSTINGS_FILES:
+        with open(os.path.join(single, name), 'rb') as a, open(os.path.join(blocked, name), 'rb') as b:
+            assert a.read() == b.read(), name
+    # only the index itself is left behind
+    assert not [name for name in os.listdir(blocked) if name.startswith('blocks-')]
+
+
+def test_terms_are_sorted_and_found(corpus, tmp_path):
+    index_dir = str(tmp_path / 'index')
+    build_index([corpus], index_dir, block_postings=5)
+    terms = TermTable(index_dir)
+    listed = [terms[i] for i in range(len(terms))]
+    assert listed == sorted(listed)
+    assert terms[terms.find('café')] == 'café'.encode('utf-8')
+    assert terms.find('zzz') is None
+    assert terms.find('') is None
+
+
+def test_query_ranks_documents(corpus, tmp_path):
+    index_dir = str(tmp_path / 'index')
+    build_index([corpus], index_dir, block_postings=5)
+    querier = LocalCorpusQuerier(index_dir, top_k=2)
+    assert querier('python lists')[0] == 'https://en.wikipedia.org/wiki/Python'
+    assert querier('reverse a list')[0] == 'https://stackoverflow.com/questions/1'
+    assert querier('café coffee') == ['https://en.wikipedia.org/wiki/Caf%C3%A9']
+    assert querier('nothing matches this') == []
+    docs, scores = querier.scores('river')
+    assert sorted(np.asarray(docs).tolist()) == [0, 4]
+    assert querier.fetch_documents(['https://en.wikipedia.org/wiki/Mountain']) == [DOCUMENTS[1][1]]
+
+
+def test_varints_round_trip():
+    values = np.array([0, 1, 127, 128, 300, 2**14, 2**21 + 5, 2**28 + 7, 2**32 - 1], dtype=np.uint64)
+    encoded = encode_varints(values)
+    assert len(encoded) == 1 + 1 + 1 + 2 + 2 + 3 + 4 + 5 + 5
+    assert decode_varints(encoded).tolist() == values.tolist()
+    assert decode_varints(encode_varints([])).tolist() == []
+
+
+def test_postings_are_compressed(corpus, tmp_path):
+    index_dir = str(tmp_path / 'index')
+    build_index([corpus], index_dir)
+    querier = LocalCorpusQuerier(index_dir)
+    n_postings = int(querier.postings.term_offsets[-1])
+    # one byte per doc id gap and per term frequency on a small corpus
+    assert len(querier.postings.doc_gaps) == n_postings
+    assert len(querier.postings.tfs) == n_postings
+
+
+def test_common_terms_are_skipped(corpus, tmp_path):
+    index_dir = str(tmp_path / 'index')
+    build_index([corpus], index_dir)
+    # 'a' is in 5 of the 6 documents
+    assert LocalCorpusQuerier(index_dir, max_df=0.5)('a mountain') == ['https://en.wikipedia.org/wiki/Mountain']
+    assert len(LocalCorpusQuerier(index_dir, max_df=None)('a mountain')) == 5
+    # a query of only common terms still finds documents
+    assert len(LocalCorpusQuerier(index_dir, max_df=0.5)('a')) == 5
+
+
+def test_duplicate_urls_and_unknown_links(tmp_path):
+    path = tmp_path / 'corpus.jsonl'
+    with open(path, 'w', encoding='utf-8') as f:
+        for url, text in DOCUMENTS[:2] + [(DOCUMENTS[0][0], 'A later copy of the river page.')]:
+            f.write(json.dumps({'url': url, 'text': text}) + '\n')
+    index_dir = str(tmp_path / 'index')
+    build_index([str(path)], index_dir)
+    querier = LocalCorpusQuerier(index_dir)
+    assert querier.meta['n_docs'] == 2
+    assert querier.fetch_documents([DOCUMENTS[0][0]]) == [DOCUMENTS[0][1]]
+    assert querier('later copy') == []
+    # unknown links are left out, as DDGQuerier leaves out failed fetches
+    links = ['https://example.org/missing', DOCUMENTS[1][0]]
+    assert dict(querier.iter_documents(links)) == {DOCUMENTS[1][0]: DOCUMENTS[1][1]}
+
+
+def test_empty_corpus(tmp_path):
+    empty = tmp_path / 'empty.jsonl'
+    empty.write_text('')
+    index_dir = str(tmp_path / 'index')
+    build_index([str(empty)], index_dir)
+    assert LocalCorpusQuerier(index_dir)('anything') == []
@@ -0,0 +1,28 @@
+from metrics import Metrics
+
+
+def test_prometheus_exposition():
+    metrics = Metrics()
+    metrics.inc('requests_total', 2, host='say "hi"\\now')
+    metrics.observe('stage_seconds', 0.003, stage='fetch')
+    metrics.observe('stage_seconds', 2.0, stage='fetch')
+    lines = metrics.to_prometheus(prefix='test_').splitlines()
+    assert lines[:2] == [
+        '# TYPE test_requests_total counter',
+        'test_requests_total{host="say \\"hi\\"\\\\now"} 2',
+    ]
+    assert lines[2] == '# TYPE test_stage_seconds histogram'
+    assert 'test_stage_seconds_bucket{stage="fetch",le="0.0025"} 0' in lines
+    assert 'test_stage_seconds_bucket{stage="fetch",le="0.005"} 1' in lines
+    assert 'test_stage_seconds_bucket{stage="fetch",le="2.5"} 2' in lines
+    assert lines[-3:] == [
+        'test_stage_seconds_bucket{stage="fetch",le="+Inf"} 2',
+        'test_stage_seconds_sum{stage="fetch"} 2.003',
+        'test_stage_seconds_count{stage="fetch"} 2',
+    ]
+
+
+def test_newlines_in_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.inc('errors_total', error='line one\nline two')
+    assert metrics.to_prometheus(prefix='').splitlines()[1] == 'errors_total{error="line one\\nline two"} 1'
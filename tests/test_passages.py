@@ -0,0 +1,36 @@
+import hashlib
+
+from passages import BM25, PassageIndexCache, select_passages, split_passages
+
+DOCUMENT = '\n'.join(
+    f'Paragraph {i} is about {topic}. ' + ' '.join(f'filler{j}' for j in range(40))
+    for i, topic in enumerate(['rivers', 'mountains', 'python lists', 'deserts', 'python dicts'] * 4)
+)
+
+
+def test_document_is_indexed_once_per_digest():
+    cache = PassageIndexCache()
+    first = select_passages(DOCUMENT, 'python lists', token_budget=200, index_cache=cache)
+    digest = hashlib.sha256(DOCUMENT.encode('utf-8')).hexdigest()
+    second = select_passages(DOCUMENT, 'mountains', token_budget=200, digest=digest, index_cache=cache)
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'entries': 1}
+    assert 'python lists' in first and 'mountains' not in first
+    assert 'mountains' in second
+
+
+def test_cached_index_selects_the_same_passages():
+    passages = split_passages(DOCUMENT)
+    expected = BM25(passages).scores('python dicts')
+    cache = PassageIndexCache()
+    for _ in range(2):
+        cached_passages, index = cache.get(DOCUMENT)
+        assert cached_passages == passages
+        assert (index.scores('python dicts') == expected).all()
+
+
+def test_least_recently_used_index_is_evicted():
+    cache = PassageIndexCache(max_entries=1)
+    cache.get('a b c')
+    cache.get('d e f')
+    cache.get('a b c')
+    assert cache.stats() == {'hits': 0, 'misses': 3, 'entries': 1}
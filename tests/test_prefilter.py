@@ -0,0 +1,35 @@
+import pytest
+
+from prefilter import RelevanceFilter
+
+DOCUMENTS = [
+    'The Nile is the longest river in Africa and flows north into the Mediterranean Sea.',
+    'Python lists are mutable sequences, and list comprehensions build them from iterables.',
+]
+
+
+@pytest.mark.parametrize('method', ['overlap', 'cosine'])
+def test_irrelevant_documents_are_skipped(method):
+    relevance_filter = RelevanceFilter(threshold=0.2, method=method)
+    relevant = relevance_filter('The Nile river flows north through Africa.', DOCUMENTS)
+    assert relevant == [True, False]
+    assert relevance_filter.stats() == {'skipped': 1, 'escalated': 1, 'skip_rate': 0.5}
+
+
+@pytest.mark.parametrize('completion', ['', '   ', 'It is what it is, and that is that.'])
+def test_completion_without_content_terms_passes_everything(completion):
+    relevance_filter = RelevanceFilter(threshold=0.2)
+    assert relevance_filter(completion, DOCUMENTS) == [True, True]
+    assert relevance_filter.stats()['skipped'] == 0
+
+
+def test_similarities():
+    relevance_filter = RelevanceFilter()
+    similarities = relevance_filter.similarities('nile river africa', DOCUMENTS)
+    assert similarities[0] == 1.0 and similarities[1] == 0.0
+    assert relevance_filter('nile', []) == []
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        RelevanceFilter(method='jaccard')
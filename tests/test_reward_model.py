@@ -0,0 +1,206 @@
+import math
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from ddg_querier import NoResultsError, fetch_documents, iter_documents
+from docstore import DocumentStore
+from cache import ScoreCache
+from curler import Curler
+from reward_model import RewardModel, parse_score, parse_scores
+
+
+class FakeCurler:
+    """Curler whose pages are '<html>...' strings, and whose urls
+    containing 404 fail to fetch."""
+
+    def submit(self, url: str) -> Future:
+        future = Future()
+        if '404' in url:
+            future.set_exception(RuntimeError(f'404 Not Found: {url}'))
+        else:
+            future.set_result(f'<html>{url}</html>')
+        return future
+
+
+def test_iter_documents_skips_failed_links(fake_extractor):
+    links = [
+        'https://example.org/a',
+        'https://example.org/404',
+        'https://example.org/broken',
+        'https://unknown.example/b',
+        'https://example.org/c',
+    ]
+    documents = dict(iter_documents(links, curler=FakeCurler(), use_cache=False))
+    assert documents == {
+        'https://example.org/a': 'https://example.org/a',
+        'https://example.org/c': 'https://example.org/c',
+    }
+    assert fetch_documents(links, curler=FakeCurler(), use_cache=False) == [
+        'https://example.org/a', 'https://example.org/c',
+    ]
+
+
+class FakeQuerier:
+    """Querier with one link per query, whose searches for queries
+    containing 'boom' fail and for queries containing 'nothing' find
+    no results."""
+
+    def __call__(self, query: str) -> list[str]:
+        if 'boom' in query:
+            raise ConnectionError('search failed')
+        if 'nothing' in query:
+            raise NoResultsError('No results found (no HTML results)')
+        return [f'https://example.org/{query.split()[1]}']
+
+    def iter_documents(self, links: list[str], timeout: float = None):
+        return iter_documents(links, curler=FakeCurler(), use_cache=False, timeout=timeout)
+
+
+def failing_scorer(prompt: str) -> str:
+    if 'crash' in prompt:
+        raise ValueError('scorer crashed')
+    return '1'
+
+
+def test_failures_only_affect_their_own_sample(fake_extractor):
+    model = RewardModel(
+        doc_querier=FakeQuerier(),
+        generate=failing_scorer,
+        passage_token_budget=None,
+        document_store=DocumentStore(),
+    )
+    try:
+        rewards = model.get_rewards(
+            ['q a', 'q boom', 'q 404', 'q nothing', 'q b'],
+            [' ok', ' ok', ' ok', ' ok', ' crash'],
+        )
+    finally:
+        model.executor.shutdown()
+    # no documents score 0, failed searches and scoring are NaN
+    assert rewards[0] == 1.0
+    assert math.isnan(rewards[1])
+    assert rewards[2:4] == [0.0, 0.0]
+    assert math.isnan(rewards[4])
+
+
+@pytest.mark.parametrize('reply, score', [
+    ('1', 1.0),
+    ('-0.5', -0.5),
+    ('Score: -1', -1.0),
+    ('SCORE: [[0.5]]', 0.5),
+    ('-1\nThe response contradicts the document.', -1.0),
+    ('-1. The response contradicts the document.', -1.0),
+    ('0.5 - partially consistent', 0.5),
+    ('1.', 1.0),
+    ('The response is irrelevant. Score: 0', 0.0),
+    ('I cannot score inappropriate contents.', None),
+    ('5', None),
+    ('1/10', None),
+    ('', None),
+])
+def test_parse_score(reply, score):
+    assert parse_score(reply) == score
+
+
+@pytest.mark.parametrize('reply, scores', [
+    ('{"scores": [1, -1, 0.5]}', [1.0, -1.0, 0.5]),
+    ('Here you go: {"scores": [1, -1]} hope it helps', [1.0, -1.0, None]),
+    ('[0, "-0.5", 2]', [0.0, -0.5, None]),
+    ('{"scores": [1, 1, 1, 1]}', [1.0, 1.0, 1.0]),
+    ('{"scores": [true, null, "x"]}', [None, None, None]),
+    ('no scores here', [None, None, None]),
+])
+def test_parse_scores(reply, scores):
+    assert parse_scores(reply, 3) == scores
+
+
+class ScriptedScorer:
+    """LLM stand-in that answers scoring prompts with the replies given,
+    in order."""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    def __call__(self, prompt: str) -> str:
+        self.prompts.append(prompt)
+        return self.replies.pop(0)
+
+
+def scoring_model(scorer, score_cache=None) -> RewardModel:
+    return RewardModel(
+        generate=scorer, passage_token_budget=None, score_cache=score_cache or ScoreCache(),
+    )
+
+
+def test_unparseable_score_is_not_cached():
+    scorer = ScriptedScorer('I cannot help with that.', '-1. It contradicts the document.')
+    model = scoring_model(scorer)
+    assert model.score_document('q', 'a', 'doc') == 0.0
+    assert model.score_document('q', 'a', 'doc') == -1.0
+    assert model.score_document('q', 'a', 'doc') == -1.0
+    assert len(scorer.prompts) == 2
+
+
+def test_single_and_multi_document_scores_are_cached_apart():
+    score_cache = ScoreCache()
+    single = scoring_model(ScriptedScorer('1', '1'), score_cache)
+    assert single.score_document('q', 'a', 'doc 1') == 1.0
+    assert single.score_document('q', 'a', 'doc 2') == 1.0
+    # the same triples through the multi-document prompt are scored again
+    multi = scoring_model(ScriptedScorer('{"scores": [-1, 0]}'), score_cache)
+    assert multi.score_documents('q', 'a', ['doc 1', 'doc 2']) == [-1.0, 0.0]
+    assert single.score_document('q', 'a', 'doc 1') == 1.0
+
+
+class SlowCurler(Curler):
+    """Curler whose pages for urls containing 'slow' take 2 seconds."""
+
+    def urlget(self, url: str) -> str:
+        if 'slow' in url:
+            time.sleep(2)
+        return f'<html>{url}</html>'
+
+
+class ManyLinkQuerier(FakeQuerier):
+    """Querier with a link for every word of the query after the first."""
+
+    def __call__(self, query: str) -> list[str]:
+        return [f'https://example.org/{word}' for word in query.split()[1:]]
+
+    def iter_documents(self, links: list[str], timeout: float = None):
+        return iter_documents(links, curler=SlowCurler(), use_cache=False, timeout=timeout)
+
+
+def slow_scorer(prompt: str) -> str:
+    if 'sluggish' in prompt:
+        time.sleep(2)
+    return '1'
+
+
+def deadline_model(**kwargs) -> RewardModel:
+    return RewardModel(
+        doc_querier=ManyLinkQuerier(),
+        generate=slow_scorer,
+        passage_token_budget=None,
+        document_store=DocumentStore(),
+        **kwargs,
+    )
+
+
+def test_min_documents_stops_waiting_for_slow_pages(fake_extractor):
+    model = deadline_model(min_documents=1)
+    start = time.monotonic()
+    assert model.get_rewards(['q a slow1', 'q b slow2'], ['', '']) == [1.0, 1.0]
+    assert time.monotonic() - start < 1
+
+
+def test_deadline_bounds_slow_pages_and_slow_scoring(fake_extractor):
+    model = deadline_model(deadline=0.5)
+    start = time.monotonic()
+    rewards = model.get_rewards(['q a slow1', 'q sluggish', 'q a'], ['', ' sluggish', ''])
+    assert time.monotonic() - start < 1
+    # the slow page and the slow score are left out
+    assert rewards == [1.0, 0.0, 1.0]
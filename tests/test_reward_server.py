@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from reward_server import RewardBatcher, RewardClient, make_server
+from runner import ConstantRewardModel
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def batcher():
+    return RewardBatcher(ConstantRewardModel(reward=0.5), window=0.01)
+
+
+def check_client(client: RewardClient):
+    assert client.get_reward('prompt', 'completion') == 0.5
+    assert client.get_rewards(['a', 'b', 'c'], ['x', 'y', 'z']) == [0.5, 0.5, 0.5]
+    # the keep-alive connection is reused for the next request
+    assert client.get_rewards([], []) == []
+    with pytest.raises(RuntimeError, match=r'\(400\)'):
+        client.post('/get_rewards', {'prompts': ['a'], 'completions': []})
+
+
+def test_tcp(batcher):
+    server = make_server(batcher, port=0)
+    serve(server)
+    try:
+        check_client(RewardClient(f'http://127.0.0.1:{server.server_address[1]}', timeout=10))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_unix_socket(batcher, tmp_path):
+    path = str(tmp_path / 'reward.sock')
+    server = make_server(batcher, unix_socket=path)
+    serve(server)
+    try:
+        check_client(RewardClient(f'unix://{path}', timeout=10))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class FailingRewardModel(ConstantRewardModel):
+    """Fails every batch with a prompt of 'bad' in it."""
+
+    def __init__(self):
+        super().__init__(reward=1.0)
+        self.batches = []
+
+    def get_rewards(self, prompts, completions):
+        self.batches.append(list(prompts))
+        if 'bad' in prompts:
+            raise RuntimeError('bad prompt')
+        return super().get_rewards(prompts, completions)
+
+
+def test_failed_batch_only_fails_the_bad_request():
+    model = FailingRewardModel()
+    batcher = RewardBatcher(model, window=0.5)
+    good = batcher.submit(['good', 'also good'], ['x', 'y'])
+    bad = batcher.submit(['bad'], ['z'])
+    assert good.result(timeout=10) == [1.0, 1.0]
+    with pytest.raises(RuntimeError, match='bad prompt'):
+        bad.result(timeout=10)
+    # merged first, then retried per request
+    assert model.batches[0] == ['good', 'also good', 'bad']
+    assert sorted(model.batches[1:]) == [['bad'], ['good', 'also good']]
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from revise import revise_with_rewards
+from runner import CheckpointedRunner, ConstantRewardModel, read_done
+
+PROMPTS = [f'prompt {i}' for i in range(10)]
+
+
+class TinyModel:
+    """A deterministic 'language model' that runs on the CPU in no time:
+    it answers with the prompt's words reversed."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.generated = []
+        self.__lock = threading.Lock()
+
+    def answer(self, prompt: str) -> str:
+        return ' '.join(reversed(prompt.split()))
+
+    def generate(self, shard: list[str]) -> list[dict]:
+        time.sleep(self.latency)
+        with self.__lock:
+            self.generated += shard
+        return [{'answer': self.answer(prompt)} for prompt in shard]
+
+
+class FlakyScorer:
+    """Fake scorer that fails on the prompts in `failing`."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+
+    def __call__(self, prompt: str, result: dict) -> dict:
+        if prompt in self.failing:
+            raise RuntimeError('reward server unavailable')
+        return {**result, 'score': len(result['answer'])}
+
+
+def read_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_failed_scores_are_rescored_without_regenerating(tmp_path):
+    output = str(tmp_path / 'out' / 'revisions.jsonl')
+    model = TinyModel()
+    runner = CheckpointedRunner(output, model.generate, FlakyScorer({'prompt 3', 'prompt 7'}), shard_size=3)
+    assert runner.run(PROMPTS) == {'skipped': 0, 'written': 8, 'rescored': 0, 'failed': 2}
+    assert read_done(output) == set(PROMPTS) - {'prompt 3', 'prompt 7'}
+    assert os.path.exists(runner.generated_path)
+
+    model.generated = []
+    runner = CheckpointedRunner(output, model.generate, FlakyScorer(), shard_size=3)
+    assert runner.run(PROMPTS + ['prompt 10']) == {'skipped': 8, 'written': 3, 'rescored': 2, 'failed': 0}
+    assert model.generated == ['prompt 10']
+    assert read_done(output) == set(PROMPTS) | {'prompt 10'}
+    assert {line['prompt']: line['score'] for line in read_lines(output)}['prompt 7'] == len('7 prompt')
+    # everything is scored, so the sidecar is gone
+    assert not os.path.exists(runner.generated_path)
+
+
+def test_shards_are_generated_concurrently(tmp_path):
+    output = str(tmp_path / 'revisions.jsonl')
+    model = TinyModel(latency=0.1)
+    runner = CheckpointedRunner(output, model.generate, shard_size=3, generate_threads=4)
+    start = time.monotonic()
+    assert runner.run(PROMPTS) == {'skipped': 0, 'written': 10, 'rescored': 0, 'failed': 0}
+    assert time.monotonic() - start < 0.3
+    assert sorted(line['prompt'] for line in read_lines(output)) == sorted(PROMPTS)
+    assert not os.path.exists(runner.generated_path)
+
+
+def test_generation_failure_keeps_finished_shards(tmp_path):
+    output = str(tmp_path / 'revisions.jsonl')
+    model = TinyModel()
+
+    def generate(shard):
+        if 'prompt 4' in shard:
+            raise RuntimeError('out of memory')
+        return model.generate(shard)
+
+    runner = CheckpointedRunner(output, generate, FlakyScorer(), shard_size=2)
+    with pytest.raises(RuntimeError, match='out of memory'):
+        runner.run(PROMPTS)
+    assert read_done(output) == {'prompt 0', 'prompt 1', 'prompt 2', 'prompt 3'}
+    assert CheckpointedRunner(output, model.generate, FlakyScorer(), shard_size=2).run(PROMPTS)['written'] == 6
+
+
+def fake_revise(prompts, get_answer, get_critique, constitution, max_iterations, score_fn):
+    """autocrit.revise stand-in: revises each answer max_iterations times,
+    scoring every iteration with score_fn."""
+    revisions = []
+    for prompt in prompts:
+        answer = get_answer(prompt)
+        iterations = []
+        for _ in range(max_iterations):
+            iterations.append({'answer': answer, 'score': score_fn(prompt, answer)})
+            answer = get_critique(answer)
+        revisions.append({'iterations': iterations})
+    return revisions
+
+
+def test_revise_scores_every_iteration_with_the_reward_model(tmp_path):
+    output = str(tmp_path / 'revisions.jsonl')
+    model = TinyModel()
+    generate = revise_with_rewards(fake_revise, ConstantRewardModel(reward=0.25), model.answer, str.upper)
+    runner = CheckpointedRunner(output, generate, shard_size=4, generate_threads=2)
+    assert runner.run(PROMPTS)['written'] == 10
+    lines = {line['prompt']: line for line in read_lines(output)}
+    assert lines['prompt 1']['iterations'] == [
+        {'answer': '1 prompt', 'score': 0.25},
+        {'answer': '1 PROMPT', 'score': 0.25},
+    ]
+    assert runner.run(PROMPTS) == {'skipped': 10, 'written': 0, 'rescored': 0, 'failed': 0}
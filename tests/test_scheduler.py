@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from scheduler import ConcurrencyLimit, HostPolicy, Scheduler
+
+
+def scheduler(max_concurrency: int) -> Scheduler:
+    return Scheduler(policies={}, default_policy=HostPolicy(rate=None, max_concurrency=max_concurrency))
+
+
+def test_coroutine_is_woken_when_a_thread_releases():
+    s = scheduler(1)
+    released_at = []
+
+    def hold():
+        with s.slot('example.org'):
+            time.sleep(0.1)
+            released_at.append(time.monotonic())
+
+    async def wait():
+        async with s.aslot('example.org'):
+            return time.monotonic()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.02)
+    acquired_at = asyncio.run(wait())
+    holder.join()
+    # no polling interval between the release and the wakeup
+    assert 0 <= acquired_at - released_at[0] < 0.02
+
+
+def test_threads_and_coroutines_never_exceed_the_limit():
+    s = scheduler(2)
+    lock = threading.Lock()
+    active, peak, done = [0], [0], []
+
+    def enter():
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+
+    def leave(who):
+        with lock:
+            active[0] -= 1
+            done.append(who)
+
+    def thread_worker(i):
+        with s.slot('example.org'):
+            enter()
+            time.sleep(0.005)
+            leave(('thread', i))
+
+    async def coroutine_worker(i):
+        async with s.aslot('example.org'):
+            enter()
+            await asyncio.sleep(0.005)
+            leave(('coroutine', i))
+
+    async def coroutines():
+        await asyncio.gather(*(coroutine_worker(i) for i in range(20)))
+
+    threads = [threading.Thread(target=thread_worker, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    asyncio.run(coroutines())
+    for thread in threads:
+        thread.join()
+    assert len(done) == 40
+    assert peak[0] == 2
+
+
+def test_cancelled_waiter_does_not_keep_the_slot():
+    limit = ConcurrencyLimit(1)
+
+    async def main():
+        await limit.aacquire()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(limit.aacquire(), timeout=0.01)
+        limit.release()
+        await asyncio.wait_for(limit.aacquire(), timeout=1)
+        limit.release()
+
+    asyncio.run(main())
+
+
+def test_slot_handed_to_a_cancelled_waiter_is_passed_on():
+    limit = ConcurrencyLimit(1)
+
+    async def main():
+        await limit.aacquire()
+        cancelled = asyncio.ensure_future(limit.aacquire())
+        waiting = asyncio.ensure_future(limit.aacquire())
+        await asyncio.sleep(0)
+        # hand the slot to the first waiter, then cancel it before it wakes
+        limit.release()
+        cancelled.cancel()
+        await asyncio.wait_for(waiting, timeout=1)
+        assert cancelled.cancelled()
+        limit.release()
+
+    asyncio.run(main())
+
+
+def test_release_too_many_times():
+    limit = ConcurrencyLimit(1)
+    with pytest.raises(ValueError):
+        limit.release()
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from textractor import StackExchangeTextractor, WikipediaTextractor
+
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pages')
+
+
+def read_page(name: str) -> str:
+    # newline='' keeps the carriage returns of pages saved with them
+    with open(os.path.join(PAGES, name), encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def textractor_for(name: str):
+    if name.startswith('wikipedia'):
+        return WikipediaTextractor(use_cache=False)
+    return StackExchangeTextractor(use_cache=False)
+
+
+# pages on which the fast extractor deliberately differs from the soup
+# extractors, each checked by its own test below
+DEVIATIONS = {'stackoverflow_crlf.html', 'stackoverflow_nested_posts.html', 'wikipedia_cdata.html'}
+
+
+@pytest.mark.parametrize('name', sorted(set(os.listdir(PAGES)) - DEVIATIONS))
+def test_fast_extractor_matches_soup(name):
+    page_source = read_page(name)
+    textractor = textractor_for(name)
+    assert textractor.textract(page_source) == textractor.textract_soup(page_source)
+
+
+def test_wikipedia_drops_references_tables_and_see_also():
+    text = WikipediaTextractor(use_cache=False).textract(read_page('wikipedia_list_comprehension.html'))
+    assert 'A list comprehension is a syntactic construct' in text
+    assert '[2 * x for x in range(10) if x ** 2 > 3]' in text
+    for dropped in ('[1]', 'Functional', 'Not to be confused', 'Turner, David', 'Generators',
+                    'Everything from See also', 'infobox', 'NewPP'):
+        assert dropped not in text
+
+
+def test_wikipedia_heading_markup():
+    text = WikipediaTextractor(use_cache=False).textract(read_page('wikipedia_heading_markup.html'))
+    assert 'Design philosophy' in text
+    assert 'Python uses whitespace to delimit control flow blocks.' in text
+    assert 'Keyword' not in text
+    assert 'Python (programming language)' not in text
+
+
+def test_deviation_cdata_is_left_out():
+    textractor = WikipediaTextractor(use_cache=False)
+    page_source = read_page('wikipedia_cdata.html')
+    text = textractor.textract(page_source)
+    assert 'Character data written  is a comment' in text
+    assert 'label' not in text and 'fill' not in text
+    # bs4 keeps the text of CDATA sections
+    soup_text = textractor.textract_soup(page_source)
+    assert 'Character data written like this is a comment' in soup_text
+    assert text == soup_text.replace('like this', '').replace('\nlabel', '')
+
+
+def test_deviation_carriage_returns_are_read_as_newlines():
+    textractor = StackExchangeTextractor(use_cache=False)
+    page_source = read_page('stackoverflow_crlf.html')
+    text = textractor.textract(page_source)
+    assert '\r' not in text
+    assert '```line one\nline two\nline three\n```' in text
+    # bs4's html.parser keeps the carriage returns
+    soup_text = textractor.textract_soup(page_source)
+    assert '```line one\r\nline two\rline three\r\n```' in soup_text
+    assert text == soup_text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def test_deviation_nested_post_code_is_fenced_once():
+    textractor = StackExchangeTextractor(use_cache=False)
+    page_source = read_page('stackoverflow_nested_posts.html')
+    text = textractor.textract(page_source)
+    assert text.count('```z = x | y```') == 2
+    assert '``````' not in text
+    # bs4 fences the nested post's code once for each post it is in
+    soup_text = textractor.textract_soup(page_source)
+    assert '``````z = x | y``````' in soup_text
+    assert text == soup_text.replace('``````', '```')
+
+
+def test_deviation_cdata_with_gt_ends_at_gt():
+    # an HTML parser ends the bogus comment at the first '>'
+    page_source = (
+        '<div id="question-header"><a class="question-hyperlink">Title</a></div>'
+        '<div class="js-post-body">a<![CDATA[<b>]]>c</div>'
+    )
+    textractor = StackExchangeTextractor(use_cache=False)
+    assert textractor.textract(page_source) == 'Title\n\na]]>c'
+    assert textractor.textract_soup(page_source) == 'Title\n\na<b>c'